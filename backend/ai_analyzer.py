@@ -1,11 +1,11 @@
 import os
 import logging
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from pathlib import Path
-import PyPDF2
 from docx import Document
 from dotenv import load_dotenv
+from pdf_cache import pdf_reader_cache
 
 load_dotenv()
 
@@ -19,11 +19,12 @@ class AIAnalyzer:
         if not self.emergent_key:
             logger.warning("EMERGENT_LLM_KEY not found. AI analysis will use fallback mode.")
     
-    async def analyze_document(self, file_path: str, file_type: str, analysis_id: str) -> Dict[str, Any]:
-        """Analyze document and return legal insights"""
+    async def analyze_document(self, file_path: str, file_type: str, analysis_id: str,
+                               pages: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Analyze document (or only the given PDF pages) and return legal insights"""
         try:
             # Extract text from document
-            document_text = await self._extract_text(file_path, file_type)
+            document_text = await self._extract_text(file_path, file_type, pages)
             
             if not document_text or len(document_text.strip()) < 50:
                 raise Exception("Document text is too short or empty for analysis")
@@ -39,16 +40,15 @@ class AIAnalyzer:
             logger.error(f"Analysis error: {str(e)}")
             raise Exception(f"Failed to analyze document: {str(e)}")
     
-    async def _extract_text(self, file_path: str, file_type: str) -> str:
+    async def _extract_text(self, file_path: str, file_type: str, pages: Optional[List[int]] = None) -> str:
         """Extract text content from various file formats"""
         text = ""
         
         try:
             if file_type == "pdf":
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    for page in pdf_reader.pages:
-                        page_text = page.extract_text()
+                with pdf_reader_cache.reader(file_path) as pdf_reader:
+                    for page_num in pages or range(1, len(pdf_reader.pages) + 1):
+                        page_text = pdf_reader.pages[page_num - 1].extract_text()
                         if page_text:
                             text += page_text + "\n"
             
@@ -0,0 +1,257 @@
+"""
+Annotation geometry - bounding boxes, a per-page grid index for viewport queries, and
+drawing paths packed as quantized integer arrays. Packed paths are expanded back to
+{x, y} points only when they are returned, optionally simplified (Douglas-Peucker) so
+no point is dropped that would move the stroke by more than a fraction of a pixel.
+"""
+import os
+import base64
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Side of a grid cell in page units (PDF points)
+ANNOTATION_GRID_CELL = float(os.environ.get("ANNOTATION_GRID_CELL", "64"))
+# Annotations spanning more cells than this are kept in one list checked by every query
+ANNOTATION_GRID_MAX_CELLS = int(os.environ.get("ANNOTATION_GRID_MAX_CELLS", "256"))
+# Decimal places kept of drawing path coordinates
+ANNOTATION_PATH_PRECISION = int(os.environ.get("ANNOTATION_PATH_PRECISION", "2"))
+# Largest on-screen deviation, in pixels, allowed when simplifying a path for a zoom level
+ANNOTATION_SIMPLIFY_PIXELS = float(os.environ.get("ANNOTATION_SIMPLIFY_PIXELS", "0.5"))
+
+Bounds = Tuple[float, float, float, float]
+
+# Path spans longer than this are measured with numpy, shorter ones point by point
+_VECTOR_SPAN = 32
+
+
+def _number(value: Any) -> Optional[float]:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def intersects(a: Bounds, b: Bounds) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+# Drawing paths
+
+def pack_path(drawing_path: Any) -> Any:
+    """A drawing path with its points as one (n, 2) array of quantized integer coordinates
+
+    Paths whose points carry anything but numeric x and y are left as they are.
+    """
+    if not isinstance(drawing_path, dict):
+        return drawing_path
+    packed = drawing_path.get("packed_points")
+    if isinstance(packed, str):
+        # As read back from the journal or snapshot
+        values = np.frombuffer(base64.b64decode(packed), dtype="<i4").astype(np.int32).reshape(-1, 2)
+        return {**drawing_path, "packed_points": values}
+    points = drawing_path.get("points")
+    if packed is not None or not isinstance(points, list) or not points:
+        return drawing_path
+    coordinates = []
+    for point in points:
+        if not isinstance(point, dict) or len(point) != 2:
+            return drawing_path
+        x, y = _number(point.get("x")), _number(point.get("y"))
+        if x is None or y is None:
+            return drawing_path
+        coordinates.append((x, y))
+    scale = 10 ** ANNOTATION_PATH_PRECISION
+    scaled = np.rint(np.array(coordinates) * scale)
+    if not np.isfinite(scaled).all() or np.abs(scaled).max() > np.iinfo(np.int32).max:
+        return drawing_path
+    values = scaled.astype(np.int32)
+    low, high = values.min(axis=0) / scale, values.max(axis=0) / scale
+    packed_path = {key: value for key, value in drawing_path.items() if key != "points"}
+    packed_path.update({
+        "precision": ANNOTATION_PATH_PRECISION,
+        "packed_points": values,
+        "bounds": [float(low[0]), float(low[1]), float(high[0]), float(high[1])]
+    })
+    return packed_path
+
+
+def _simplify(values: np.ndarray, tolerance: float) -> np.ndarray:
+    """Indexes of the points kept by Douglas-Peucker simplification within tolerance"""
+    count = len(values)
+    if count <= 2 or tolerance <= 0:
+        return np.arange(count)
+    points = values.astype(np.float64)
+    xs, ys = values[:, 0].tolist(), values[:, 1].tolist()
+    keep = [0, count - 1]
+    limit = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        length = dx * dx + dy * dy
+        if last - first > _VECTOR_SPAN:
+            offsets = points[first + 1:last] - points[first]
+            if length:
+                cross = offsets[:, 0] * dy - offsets[:, 1] * dx
+                distances = cross * cross / length
+            else:
+                distances = (offsets * offsets).sum(axis=1)
+            farthest = int(distances.argmax())
+            distance = float(distances[farthest])
+            farthest += first + 1
+        else:
+            # Short spans are cheaper in plain Python than as numpy calls
+            farthest, distance = first, -1.0
+            for index in range(first + 1, last):
+                px, py = xs[index] - ax, ys[index] - ay
+                if length:
+                    cross = px * dy - py * dx
+                    d = cross * cross / length
+                else:
+                    d = px * px + py * py
+                if d > distance:
+                    farthest, distance = index, d
+        if distance > limit:
+            keep.append(farthest)
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return np.array(sorted(keep))
+
+
+def is_packed(drawing_path: Any) -> bool:
+    return isinstance(drawing_path, dict) and isinstance(drawing_path.get("packed_points"), np.ndarray)
+
+
+def simplified_points(drawing_path: Dict[str, Any], zoom: float) -> np.ndarray:
+    """Indexes of the points of a packed path still needed when it is drawn at zoom"""
+    tolerance = ANNOTATION_SIMPLIFY_PIXELS / zoom * 10 ** drawing_path["precision"]
+    return _simplify(drawing_path["packed_points"], tolerance)
+
+
+def unpack_path(drawing_path: Any, keep: Optional[np.ndarray] = None) -> Any:
+    """A packed drawing path as {x, y} points, only those at the keep indexes if given"""
+    if not is_packed(drawing_path):
+        return drawing_path
+    values = drawing_path["packed_points"]
+    scale = 10 ** drawing_path["precision"]
+    if keep is not None:
+        values = values[keep]
+    path = {key: value for key, value in drawing_path.items()
+            if key not in ("packed_points", "precision", "bounds")}
+    path["points"] = [{"x": x, "y": y} for x, y in (values / scale).tolist()]
+    return path
+
+
+def json_default(value: Any) -> Any:
+    """json.dumps fallback writing packed points as base64"""
+    if isinstance(value, np.ndarray):
+        return base64.b64encode(value.astype("<i4").tobytes()).decode("ascii")
+    return str(value)
+
+
+# Bounds and the grid index
+
+def annotation_bounds(annotation: Dict[str, Any]) -> Optional[Bounds]:
+    """Box an annotation covers on its page: its position box joined with its drawing path, if any"""
+    boxes = []
+    position = annotation.get("position")
+    if isinstance(position, dict):
+        x, y = _number(position.get("x")), _number(position.get("y"))
+        if x is not None and y is not None:
+            width, height = _number(position.get("width")) or 0, _number(position.get("height")) or 0
+            boxes.append((min(x, x + width), min(y, y + height), max(x, x + width), max(y, y + height)))
+    drawing_path = annotation.get("drawing_path")
+    if isinstance(drawing_path, dict):
+        box = drawing_path.get("bounds")
+        if box is None and isinstance(drawing_path.get("points"), list):
+            points = [(_number(p.get("x")), _number(p.get("y"))) for p in drawing_path["points"] if isinstance(p, dict)]
+            points = [p for p in points if p[0] is not None and p[1] is not None]
+            if points:
+                box = [min(p[0] for p in points), min(p[1] for p in points),
+                       max(p[0] for p in points), max(p[1] for p in points)]
+        if box is not None:
+            pad = (_number(drawing_path.get("stroke_width")) or 0) / 2
+            boxes.append((box[0] - pad, box[1] - pad, box[2] + pad, box[3] + pad))
+    if not boxes:
+        return None
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+class PageGrid:
+    """Uniform grid over one page mapping cells to the annotations overlapping them"""
+
+    def __init__(self, cell_size: float = ANNOTATION_GRID_CELL):
+        self.cell_size = cell_size
+        self._cells: Dict[Tuple[int, int], Dict[str, None]] = {}
+        self._bounds: Dict[str, Optional[Bounds]] = {}
+        self._order: Dict[str, int] = {}
+        self._large: Dict[str, None] = {}
+        # Annotations without coordinates (e.g. legacy page comments) belong to every viewport
+        self._unplaced: Dict[str, None] = {}
+        self._next = 0
+
+    def _cell_range(self, bounds: Bounds) -> Tuple[range, range]:
+        size = self.cell_size
+        return (range(int(bounds[0] // size), int(bounds[2] // size) + 1),
+                range(int(bounds[1] // size), int(bounds[3] // size) + 1))
+
+    def insert(self, annotation_id: str, bounds: Optional[Bounds]):
+        self._bounds[annotation_id] = bounds
+        self._order[annotation_id] = self._next
+        self._next += 1
+        if bounds is None:
+            self._unplaced[annotation_id] = None
+            return
+        columns, rows = self._cell_range(bounds)
+        if len(columns) * len(rows) > ANNOTATION_GRID_MAX_CELLS:
+            self._large[annotation_id] = None
+            return
+        for column in columns:
+            for row in rows:
+                self._cells.setdefault((column, row), {})[annotation_id] = None
+
+    def remove(self, annotation_id: str):
+        bounds = self._bounds.pop(annotation_id, None)
+        self._order.pop(annotation_id, None)
+        if annotation_id in self._unplaced:
+            del self._unplaced[annotation_id]
+            return
+        if annotation_id in self._large:
+            del self._large[annotation_id]
+            return
+        if bounds is None:
+            return
+        columns, rows = self._cell_range(bounds)
+        for column in columns:
+            for row in rows:
+                cell = self._cells.get((column, row))
+                if cell is not None:
+                    cell.pop(annotation_id, None)
+                    if not cell:
+                        del self._cells[(column, row)]
+
+    def move(self, annotation_id: str, bounds: Optional[Bounds]):
+        """Change an annotation's bounds, keeping its place in query order"""
+        order = self._order[annotation_id]
+        self.remove(annotation_id)
+        self.insert(annotation_id, bounds)
+        self._order[annotation_id] = order
+
+    def query(self, viewport: Bounds) -> List[str]:
+        """Ids of the annotations intersecting viewport, in the order they were inserted"""
+        found = set(self._unplaced)
+        found.update(i for i in self._large if intersects(self._bounds[i], viewport))
+        columns, rows = self._cell_range(viewport)
+        if len(columns) * len(rows) > len(self._cells):
+            cells: Iterable = (cell for key, cell in self._cells.items() if key[0] in columns and key[1] in rows)
+        else:
+            cells = (self._cells[key] for key in ((c, r) for c in columns for r in rows) if key in self._cells)
+        for cell in cells:
+            for annotation_id in cell:
+                if annotation_id not in found and intersects(self._bounds[annotation_id], viewport):
+                    found.add(annotation_id)
+        return sorted(found, key=self._order.__getitem__)
+
+    def __len__(self) -> int:
+        return len(self._bounds)
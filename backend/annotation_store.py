@@ -0,0 +1,463 @@
+"""
+Annotation repository - annotations indexed by id, by document, by (document, page)
+and by the comment they reply to, so lookups and page queries never scan other
+annotations. Every index keeps insertion order, matching the order annotations were added.
+Each page also has a grid index answering viewport queries, and drawing paths are held
+packed (see annotation_geometry) until they are returned.
+
+Changes are persisted write-behind: requests only queue a journal entry, and a writer
+thread appends each burst of entries with a single write and fsync. The journal is
+folded into a snapshot once it grows long. Workers sharing the directory append under
+a file lock and pick up each other's entries by tailing the journal.
+"""
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from annotation_geometry import (
+    PageGrid, Bounds, annotation_bounds, is_packed, pack_path, simplified_points, unpack_path, json_default
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process owns the journal
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# How long the writer waits after the first queued change to batch a burst into one fsync
+ANNOTATION_BATCH_WINDOW_MS = float(os.environ.get("ANNOTATION_BATCH_WINDOW_MS", "20"))
+# How often entries appended by other workers are picked up when this one is idle
+ANNOTATION_SYNC_INTERVAL = float(os.environ.get("ANNOTATION_SYNC_INTERVAL", "1"))
+# The journal is folded into the snapshot past this many entries (and more than one per annotation)
+ANNOTATION_COMPACT_ENTRIES = int(os.environ.get("ANNOTATION_COMPACT_ENTRIES", "10000"))
+# Drawing paths whose simplification for a zoom level is remembered
+ANNOTATION_SIMPLIFIED_CACHE_SIZE = int(os.environ.get("ANNOTATION_SIMPLIFIED_CACHE_SIZE", "8192"))
+
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.jsonl"
+
+
+def annotation_page(annotation: Dict[str, Any]) -> int:
+    """Page an annotation sits on: its position's page, the legacy top-level page, else 1"""
+    position = annotation.get("position")
+    if isinstance(position, dict) and "page" in position:
+        return position["page"]
+    return annotation.get("page", 1)
+
+
+def _fsync_directory(path: str):
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AnnotationStore:
+    """Annotations with id, per-file, per-page and reply indexes, journaled to disk once opened"""
+
+    def __init__(self):
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._by_file: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._by_page: Dict[Tuple[str, int], Dict[str, Dict[str, Any]]] = {}
+        self._replies: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._grids: Dict[Tuple[str, int], PageGrid] = {}
+        self._lock = threading.Lock()
+        # (annotation_id, zoom) -> (packed points, indexes kept at that zoom)
+        self._simplified: "OrderedDict[Tuple[str, float], Tuple[Any, Any]]" = OrderedDict()
+        self._simplified_lock = threading.Lock()
+        # Persistence, set up by open()
+        self.root = ""
+        self._writer_id = uuid.uuid4().hex[:12]
+        self._pending: List[Dict[str, Any]] = []
+        self._wake = threading.Event()
+        self._stopping = False
+        self._writer: Optional[threading.Thread] = None
+        self._io_lock = threading.Lock()
+        self._journal_fd: Optional[int] = None
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    # Indexes
+
+    def _index(self, annotation: Dict[str, Any]):
+        annotation_id, file_id = annotation["annotation_id"], annotation["file_id"]
+        if annotation.get("drawing_path") is not None:
+            annotation["drawing_path"] = pack_path(annotation["drawing_path"])
+        page = (file_id, annotation_page(annotation))
+        self._by_id[annotation_id] = annotation
+        self._by_file.setdefault(file_id, {})[annotation_id] = annotation
+        self._by_page.setdefault(page, {})[annotation_id] = annotation
+        self._grids.setdefault(page, PageGrid()).insert(annotation_id, annotation_bounds(annotation))
+        if annotation.get("reply_to"):
+            self._replies.setdefault(annotation["reply_to"], {})[annotation_id] = annotation
+
+    @staticmethod
+    def _drop(index: Dict, key: Any, annotation_id: str):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(annotation_id, None)
+            if not bucket:
+                del index[key]
+
+    def _drop_from_grid(self, page: Tuple[str, int], annotation_id: str):
+        grid = self._grids.get(page)
+        if grid is not None:
+            grid.remove(annotation_id)
+            if not len(grid):
+                del self._grids[page]
+
+    def _unindex(self, annotation: Dict[str, Any]):
+        annotation_id, file_id = annotation["annotation_id"], annotation["file_id"]
+        self._by_id.pop(annotation_id, None)
+        page = (file_id, annotation_page(annotation))
+        self._drop_from_grid(page, annotation_id)
+        for index, key in ((self._by_file, file_id), (self._by_page, page),
+                           (self._replies, annotation.get("reply_to"))):
+            self._drop(index, key, annotation_id)
+
+    def _reindex(self, annotation: Dict[str, Any], fields: Dict[str, Any]):
+        """Apply field changes in place, moving the annotation only out of the buckets whose key changed"""
+        annotation_id, file_id = annotation["annotation_id"], annotation["file_id"]
+        if fields.get("file_id", file_id) != file_id:
+            self._unindex(annotation)
+            annotation.update(fields)
+            self._index(annotation)
+            return
+        page, reply_to = (file_id, annotation_page(annotation)), annotation.get("reply_to")
+        annotation.update(fields)
+        if annotation.get("drawing_path") is not None:
+            annotation["drawing_path"] = pack_path(annotation["drawing_path"])
+        moved_to = (file_id, annotation_page(annotation))
+        bounds = annotation_bounds(annotation)
+        if moved_to == page:
+            self._grids[page].move(annotation_id, bounds)
+        else:
+            self._drop_from_grid(page, annotation_id)
+            self._drop(self._by_page, page, annotation_id)
+            self._by_page.setdefault(moved_to, {})[annotation_id] = annotation
+            self._grids.setdefault(moved_to, PageGrid()).insert(annotation_id, bounds)
+        if annotation.get("reply_to") != reply_to:
+            self._drop(self._replies, reply_to, annotation_id)
+            if annotation.get("reply_to"):
+                self._replies.setdefault(annotation["reply_to"], {})[annotation_id] = annotation
+
+    def _apply(self, entry: Dict[str, Any]) -> Any:
+        """Apply one change; every kind is idempotent, so replaying a journal twice is harmless
+
+        Returns the annotation changed, or for remove_file the annotations removed (None if none were).
+        """
+        op = entry["op"]
+        if op == "remove_file":
+            removed = list(self._by_file.get(entry["file_id"], {}).values())
+            for annotation in removed:
+                self._unindex(annotation)
+            return removed or None
+        if op == "put":
+            annotation = entry["annotation"]
+            previous = self._by_id.get(annotation["annotation_id"])
+            if previous is not None:
+                self._unindex(previous)
+            self._index(annotation)
+            return annotation
+        annotation = self._by_id.get(entry["id"])
+        if annotation is None:
+            return None
+        if op == "update":
+            self._reindex(annotation, entry["fields"])
+        else:
+            self._unindex(annotation)
+        return annotation
+
+    def _change(self, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply a change made by this process and queue it for the journal"""
+        with self._lock:
+            annotation = self._apply(entry)
+            if self.root and (annotation is not None or entry["op"] == "put"):
+                self._pending.append(entry)
+                self._wake.set()
+            return annotation
+
+    def add(self, annotation: Dict[str, Any]):
+        self._change({"op": "put", "annotation": annotation})
+
+    def add_many(self, annotations: Iterable[Dict[str, Any]]):
+        for annotation in annotations:
+            self._change({"op": "put", "annotation": annotation})
+
+    def get(self, annotation_id: str) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(annotation_id)
+
+    def update(self, annotation_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply field changes to an annotation, re-indexing it if it moved page; None if unknown"""
+        return self._change({"op": "update", "id": annotation_id, "fields": fields})
+
+    def delete(self, annotation_id: str) -> Optional[Dict[str, Any]]:
+        """Remove an annotation; its replies stay and still list under its id"""
+        return self._change({"op": "delete", "id": annotation_id})
+
+    def remove_file(self, file_id: str) -> int:
+        """Drop every annotation of a file once the file itself is gone; returns how many"""
+        removed = self._change({"op": "remove_file", "file_id": file_id})
+        return len(removed) if removed else 0
+
+    def _keep_at_zoom(self, annotation: Dict[str, Any], zoom: float):
+        """Indexes of a packed path kept at zoom, remembered while the path is unchanged"""
+        drawing_path = annotation["drawing_path"]
+        key = (annotation["annotation_id"], zoom)
+        with self._simplified_lock:
+            cached = self._simplified.get(key)
+            if cached is not None and cached[0] is drawing_path["packed_points"]:
+                self._simplified.move_to_end(key)
+                return cached[1]
+        keep = simplified_points(drawing_path, zoom)
+        with self._simplified_lock:
+            self._simplified[key] = (drawing_path["packed_points"], keep)
+            while len(self._simplified) > ANNOTATION_SIMPLIFIED_CACHE_SIZE:
+                self._simplified.popitem(last=False)
+        return keep
+
+    def _public(self, annotations: List[Dict[str, Any]], zoom: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Annotations as returned to clients, drawing paths expanded to points (simplified for zoom)"""
+        public = []
+        for annotation in annotations:
+            drawing_path = annotation.get("drawing_path")
+            if is_packed(drawing_path):
+                keep = self._keep_at_zoom(annotation, zoom) if zoom else None
+                annotation = {**annotation, "drawing_path": unpack_path(drawing_path, keep)}
+            public.append(annotation)
+        return public
+
+    def for_file(self, file_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            annotations = list(self._by_file.get(file_id, {}).values())
+        return self._public(annotations)
+
+    def for_page(self, file_id: str, page: int, zoom: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Every annotation on a page, drawing paths simplified for zoom if given"""
+        with self._lock:
+            annotations = list(self._by_page.get((file_id, page), {}).values())
+        return self._public(annotations, zoom)
+
+    def in_viewport(self, file_id: str, page: int, viewport: Bounds,
+                    zoom: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Annotations on a page intersecting the (x0, y0, x1, y1) viewport, from the page's grid"""
+        with self._lock:
+            grid = self._grids.get((file_id, page))
+            annotations = [self._by_id[i] for i in grid.query(viewport)] if grid is not None else []
+        return self._public(annotations, zoom)
+
+    def replies(self, annotation_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            annotations = list(self._replies.get(annotation_id, {}).values())
+        return self._public(annotations)
+
+    def thread(self, annotation_id: str) -> List[Dict[str, Any]]:
+        """Every reply below an annotation, depth first in the order they were added"""
+        with self._lock:
+            thread: List[Dict[str, Any]] = []
+            stack = list(reversed(list(self._replies.get(annotation_id, {}).values())))
+            seen = {annotation_id}
+            while stack:
+                reply = stack.pop()
+                if reply["annotation_id"] in seen:
+                    continue
+                seen.add(reply["annotation_id"])
+                thread.append(reply)
+                stack.extend(reversed(list(self._replies.get(reply["annotation_id"], {}).values())))
+        return self._public(thread)
+
+    def count(self, file_id: str) -> int:
+        return len(self._by_file.get(file_id, ()))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    # Persistence
+
+    def open(self, root: str):
+        """Recover annotations from the snapshot and journal under root and start the writer"""
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        with self._io_lock:
+            self._lock_journal()
+            try:
+                self._reload()
+            finally:
+                self._unlock_journal()
+        self._stopping = False
+        self._writer = threading.Thread(target=self._run_writer, name="annotation-writer", daemon=True)
+        self._writer.start()
+        if self._by_id:
+            logger.info(f"Recovered {len(self._by_id)} annotations")
+
+    def close(self):
+        """Write out queued changes and stop the writer"""
+        if self._writer is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._writer.join()
+        self._writer = None
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _lock_journal(self):
+        """Open the current journal and hold its lock, reopening if it was replaced meanwhile"""
+        while True:
+            if self._journal_fd is None:
+                self._journal_fd = os.open(self._path(JOURNAL_FILE), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(self._journal_fd, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self._path(JOURNAL_FILE)).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(self._journal_fd).st_ino:
+                return
+            # Another worker compacted the journal: everything is reloaded from the new files
+            self._unlock_journal()
+            os.close(self._journal_fd)
+            self._journal_fd = None
+            self._journal_offset = -1
+
+    def _unlock_journal(self):
+        if fcntl is not None and self._journal_fd is not None:
+            fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+
+    def _read_journal(self, offset: int) -> List[Dict[str, Any]]:
+        """Entries appended since offset; a torn tail left by a crash is cut off"""
+        size = os.fstat(self._journal_fd).st_size
+        data = b""
+        if size > offset:
+            os.lseek(self._journal_fd, offset, os.SEEK_SET)
+            while len(data) < size - offset:
+                chunk = os.read(self._journal_fd, size - offset - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logger.warning(f"Discarding {len(data) - end} bytes of torn annotation journal entry")
+            os.ftruncate(self._journal_fd, offset + end)
+        entries = []
+        for line in data[:end].splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping unreadable annotation journal entry")
+        self._journal_offset = offset + end
+        return entries
+
+    def _reload(self):
+        """Rebuild every index from the snapshot plus the journal (caller holds the journal lock)"""
+        annotations: List[Dict[str, Any]] = []
+        if os.path.exists(self._path(SNAPSHOT_FILE)):
+            with open(self._path(SNAPSHOT_FILE), "r", encoding="utf-8") as f:
+                annotations = json.load(f)["annotations"]
+        entries = self._read_journal(0)
+        with self._lock:
+            self._by_id, self._by_file, self._by_page, self._replies, self._grids = {}, {}, {}, {}, {}
+            for annotation in annotations:
+                self._index(annotation)
+            for entry in entries:
+                self._apply(entry)
+            # Changes of ours not yet written are reapplied on top of the reloaded state
+            for entry in self._pending:
+                self._apply(entry)
+        self._journal_entries = len(entries)
+
+    def _run_writer(self):
+        while True:
+            self._wake.wait(ANNOTATION_SYNC_INTERVAL)
+            if self._pending and not self._stopping:
+                # Let the rest of a burst (e.g. a drawing's strokes) arrive before syncing
+                time.sleep(ANNOTATION_BATCH_WINDOW_MS / 1000)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Annotation journal write failed: {e}")
+            if self._stopping:
+                return
+
+    def flush(self):
+        """Append queued changes with one write and fsync, after taking in other workers' changes"""
+        with self._io_lock:
+            self._lock_journal()
+            try:
+                if self._journal_offset < 0:
+                    self._reload()
+                else:
+                    foreign = [entry for entry in self._read_journal(self._journal_offset)
+                               if entry.get("writer") != self._writer_id]
+                    self._journal_entries += len(foreign)
+                    if foreign:
+                        with self._lock:
+                            for entry in foreign:
+                                self._apply(entry)
+                            # Keep journal order: our queued changes land after theirs
+                            for entry in self._pending:
+                                self._apply(entry)
+                with self._lock:
+                    batch, self._pending = self._pending, []
+                    payload = "".join(json.dumps({**entry, "writer": self._writer_id}, default=json_default) + "\n"
+                                      for entry in batch).encode("utf-8")
+                if payload:
+                    try:
+                        if os.write(self._journal_fd, payload) != len(payload):
+                            raise OSError("short write to annotation journal")
+                        os.fsync(self._journal_fd)
+                    except OSError:
+                        # Cut off whatever part landed and keep the batch queued for the next flush
+                        os.ftruncate(self._journal_fd, self._journal_offset)
+                        with self._lock:
+                            self._pending[:0] = batch
+                        raise
+                    self._journal_offset += len(payload)
+                    self._journal_entries += len(batch)
+                if self._journal_entries > max(ANNOTATION_COMPACT_ENTRIES, 2 * len(self._by_id)):
+                    self._compact()
+            finally:
+                self._unlock_journal()
+
+    def _compact(self):
+        """Fold the journal into a new snapshot and start an empty journal (caller holds the journal lock)"""
+        with self._lock:
+            # Updates replace field values rather than mutating them, so shallow copies are stable
+            annotations = [dict(annotation) for annotation in self._by_id.values()]
+        snapshot_path = self._path(SNAPSHOT_FILE)
+        with open(snapshot_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"annotations": annotations}, f, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        journal_path = self._path(JOURNAL_FILE)
+        fd = os.open(journal_path + ".tmp", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.fsync(fd)
+        os.close(fd)
+        # A crash between the two renames replays the old journal over the new snapshot, which is harmless
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        os.replace(journal_path + ".tmp", journal_path)
+        _fsync_directory(self.root)
+        # Waiters on the old journal's lock see it was replaced and reopen
+        self._unlock_journal()
+        os.close(self._journal_fd)
+        self._journal_fd = None
+        self._lock_journal()
+        self._journal_offset = 0
+        self._journal_entries = 0
+        logger.info(f"Compacted annotation journal into a snapshot of {len(annotations)} annotations")
+
+
+annotation_store = AnnotationStore()
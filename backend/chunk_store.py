@@ -0,0 +1,267 @@
+"""
+Content-addressed chunk store - files are split with content-defined chunking and
+kept as manifests of chunk digests, so bytes shared between documents and their
+versions are written and stored once. Reference counts are rebuilt from the
+manifests at startup and chunks no manifest references are garbage collected.
+"""
+import os
+import zlib
+import uuid
+import struct
+import bisect
+import logging
+import threading
+from typing import Dict, Any, Iterable, Iterator, List, Set, Tuple
+
+from content_chunking import iter_chunks, chunk_digest, mapped_file
+
+logger = logging.getLogger(__name__)
+
+CHUNK_STORE_AVG_SIZE = int(os.environ.get("CHUNK_STORE_AVG_SIZE", "8192"))
+
+_MANIFEST_MAGIC = b"LDCMANIFEST1\n"
+_MANIFEST_ENTRY = struct.Struct("<16sI")  # chunk digest, chunk length
+_RAW, _DEFLATED = b"\x00", b"\x01"
+
+
+class ManifestReader:
+    """Random-access reads over a stored file, decompressing only the chunks a range touches"""
+
+    def __init__(self, store: "ChunkStore", entries: List[Tuple[bytes, int]]):
+        self._store = store
+        self._digests = [digest for digest, _ in entries]
+        self._offsets = [0]
+        for _, length in entries:
+            self._offsets.append(self._offsets[-1] + length)
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    @property
+    def size(self) -> int:
+        return self._offsets[-1]
+
+    def _chunk(self, index: int) -> bytes:
+        # Copies out of one keyframe are mostly sequential, so the last chunk is kept
+        if self._cached[0] != index:
+            self._cached = (index, self._store.read_chunk(self._digests[index]))
+        return self._cached[1]
+
+    def iter_range(self, offset: int, length: int) -> Iterator[bytes]:
+        end = min(offset + length, self.size)
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        while offset < end:
+            start = self._offsets[index]
+            data = self._chunk(index)
+            piece = data[offset - start:end - start]
+            yield piece
+            offset += len(piece)
+            index += 1
+
+
+class ChunkStore:
+    """Chunk objects under objects/, one manifest per stored file under manifests/"""
+
+    def __init__(self, avg_size: int = CHUNK_STORE_AVG_SIZE):
+        self.avg_size = avg_size
+        self.root = ""
+        self._refcounts: Dict[bytes, int] = {}
+        self._stored_sizes: Dict[bytes, int] = {}
+        self._unreferenced: Set[bytes] = set()
+        self._logical_bytes = 0
+        self._manifests = 0
+        self._lock = threading.Lock()
+
+    def _object_path(self, digest: bytes) -> str:
+        name = digest.hex()
+        return os.path.join(self.root, "objects", name[:2], name[2:])
+
+    def _manifest_path(self, manifest_id: str) -> str:
+        return os.path.join(self.root, "manifests", f"{manifest_id}.manifest")
+
+    def load(self, root: str):
+        """Rebuild reference counts from the manifests on disk and collect orphaned chunks"""
+        self.root = root
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "manifests"), exist_ok=True)
+        refcounts: Dict[bytes, int] = {}
+        logical = manifests = 0
+
+        for entry in os.scandir(os.path.join(root, "manifests")):
+            if not entry.name.endswith(".manifest"):
+                os.remove(entry.path)  # interrupted write
+                continue
+            try:
+                entries = self._read_manifest_file(entry.path)
+            except ValueError as e:
+                logger.warning(f"Ignoring unreadable chunk manifest {entry.name}: {e}")
+                continue
+            for digest, length in entries:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+                logical += length
+            manifests += 1
+
+        stored_sizes: Dict[bytes, int] = {}
+        for shard in os.scandir(os.path.join(root, "objects")):
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+                    continue
+                stored_sizes[bytes.fromhex(shard.name + entry.name)] = entry.stat().st_size
+
+        with self._lock:
+            self._refcounts, self._stored_sizes = refcounts, stored_sizes
+            self._unreferenced = {digest for digest in stored_sizes if digest not in refcounts}
+            self._logical_bytes, self._manifests = logical, manifests
+        missing = sum(1 for digest in refcounts if digest not in stored_sizes)
+        if missing:
+            logger.error(f"Chunk store is missing {missing} referenced chunks")
+        freed = self.gc()
+        if manifests:
+            logger.info(f"Loaded chunk store: {manifests} manifests, {len(stored_sizes)} chunks, {freed} orphaned bytes freed")
+
+    def _write_object(self, digest: bytes, chunk) -> int:
+        compressed = zlib.compress(chunk, 1)
+        payload = _DEFLATED + compressed if len(compressed) < len(chunk) else _RAW + bytes(chunk)
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(payload)
+        os.replace(path + ".tmp", path)
+        return len(payload)
+
+    def read_chunk(self, digest: bytes) -> bytes:
+        with open(self._object_path(digest), "rb") as f:
+            payload = f.read()
+        return zlib.decompress(payload[1:]) if payload[:1] == _DEFLATED else payload[1:]
+
+    def _add_references(self, digest: bytes, chunk) -> int:
+        """Reference a chunk, writing it only if the store does not have it; returns bytes written"""
+        with self._lock:
+            if digest in self._stored_sizes:
+                self._refcounts[digest] = self._refcounts.get(digest, 0) + 1
+                self._unreferenced.discard(digest)
+                return 0
+            # New chunks are written under the lock so a concurrent put never references a half-written object
+            self._stored_sizes[digest] = self._write_object(digest, chunk)
+            self._refcounts[digest] = 1
+            return self._stored_sizes[digest]
+
+    def _drop_references(self, digests: Iterable[bytes]):
+        with self._lock:
+            for digest in digests:
+                count = self._refcounts.get(digest, 0) - 1
+                if count > 0:
+                    self._refcounts[digest] = count
+                else:
+                    self._refcounts.pop(digest, None)
+                    self._unreferenced.add(digest)
+
+    def put_file(self, source_path: str) -> Tuple[str, int]:
+        """Store a file; returns its manifest id and the bytes of new chunks actually written"""
+        manifest_id = uuid.uuid4().hex
+        entries: List[bytes] = []
+        referenced: List[bytes] = []
+        written = size = 0
+        try:
+            with mapped_file(source_path) as data:
+                size = len(data)
+                for _, chunk in iter_chunks(data, self.avg_size):
+                    digest = chunk_digest(chunk)
+                    written += self._add_references(digest, chunk)
+                    referenced.append(digest)
+                    entries.append(_MANIFEST_ENTRY.pack(digest, len(chunk)))
+                    chunk.release()
+            path = self._manifest_path(manifest_id)
+            with open(path + ".tmp", "wb") as f:
+                f.write(_MANIFEST_MAGIC)
+                f.write(b"".join(entries))
+            os.replace(path + ".tmp", path)
+        except Exception:
+            self._drop_references(referenced)
+            raise
+        with self._lock:
+            self._logical_bytes += size
+            self._manifests += 1
+        return manifest_id, written
+
+    @staticmethod
+    def _read_manifest_file(path: str) -> List[Tuple[bytes, int]]:
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_MANIFEST_MAGIC) or (len(data) - len(_MANIFEST_MAGIC)) % _MANIFEST_ENTRY.size:
+            raise ValueError(f"Not a chunk manifest: {path}")
+        return list(_MANIFEST_ENTRY.iter_unpack(data[len(_MANIFEST_MAGIC):]))
+
+    def has_manifest(self, manifest_id: str) -> bool:
+        return os.path.exists(self._manifest_path(manifest_id))
+
+    def open_manifest(self, manifest_id: str) -> ManifestReader:
+        return ManifestReader(self, self._read_manifest_file(self._manifest_path(manifest_id)))
+
+    def chunk_index(self, manifest_id: str) -> Dict[bytes, Tuple[int, int]]:
+        """Chunk digest -> (offset, length) within a stored file"""
+        index: Dict[bytes, Tuple[int, int]] = {}
+        offset = 0
+        for digest, length in self._read_manifest_file(self._manifest_path(manifest_id)):
+            index.setdefault(digest, (offset, length))
+            offset += length
+        return index
+
+    def iter_file(self, manifest_id: str) -> Iterator[bytes]:
+        """Stream a stored file back chunk by chunk"""
+        for digest, _ in self._read_manifest_file(self._manifest_path(manifest_id)):
+            yield self.read_chunk(digest)
+
+    def release(self, manifest_id: str) -> int:
+        """Drop a stored file and collect chunks nothing else references; returns bytes freed"""
+        path = self._manifest_path(manifest_id)
+        if not os.path.exists(path):
+            return 0
+        entries = self._read_manifest_file(path)
+        os.remove(path)
+        self._drop_references(digest for digest, _ in entries)
+        with self._lock:
+            self._logical_bytes -= sum(length for _, length in entries)
+            self._manifests -= 1
+        return self.gc()
+
+    def gc(self) -> int:
+        """Delete chunks with no references; returns bytes freed"""
+        freed = 0
+        with self._lock:
+            for digest in self._unreferenced:
+                if self._refcounts.get(digest):
+                    continue
+                size = self._stored_sizes.pop(digest, None)
+                if size is None:
+                    continue
+                try:
+                    os.remove(self._object_path(digest))
+                    freed += size
+                except FileNotFoundError:
+                    pass
+            self._unreferenced = set()
+        return freed
+
+    def stored_size(self, manifest_ids: Iterable[str]) -> int:
+        """Bytes on disk of the distinct chunks behind the given files"""
+        digests: Set[bytes] = set()
+        for manifest_id in manifest_ids:
+            if self.has_manifest(manifest_id):
+                digests.update(digest for digest, _ in self._read_manifest_file(self._manifest_path(manifest_id)))
+        with self._lock:
+            return sum(self._stored_sizes.get(digest, 0) for digest in digests)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stored = sum(self._stored_sizes.values())
+            return {
+                "files": self._manifests,
+                "chunks": len(self._stored_sizes),
+                "logical_bytes": self._logical_bytes,
+                "stored_bytes": stored,
+                "dedup_ratio": round(self._logical_bytes / stored, 3) if stored else None,
+                "average_chunk_size": self.avg_size
+            }
+
+
+chunk_store = ChunkStore()
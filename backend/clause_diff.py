@@ -0,0 +1,237 @@
+"""
+Clause-level document comparison that reports moved clauses separately from edits.
+Clauses are fingerprinted by normalized text and hashed word shingles; exact and
+near matches are found through hash lookups instead of pairwise comparison.
+"""
+import os
+import re
+import zlib
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from document_diff import refine_hunk
+
+SHINGLE_SIZE = int(os.environ.get("CLAUSE_SHINGLE_SIZE", "3"))
+# Minimum shingle Jaccard similarity for two clauses to count as the same clause
+CLAUSE_MATCH_THRESHOLD = float(os.environ.get("CLAUSE_MATCH_THRESHOLD", "0.5"))
+# Shingles shared by more clauses than this are boilerplate and ignored for candidate lookup
+MAX_SHINGLE_POSTINGS = int(os.environ.get("CLAUSE_MAX_SHINGLE_POSTINGS", "50"))
+
+_WORDS = re.compile(r"\w+")
+# A line starting with a clause number or heading opens a new clause
+_CLAUSE_START = re.compile(
+    r"^\s*(?:(?:section|article|clause|schedule|exhibit|annex)\s+[\w.]+"
+    r"|\d+(?:\.\d+)+\.?\s|\d+[.)]\s|\([a-z0-9]{1,4}\)\s|[ivxlc]+[.)]\s)",
+    re.IGNORECASE
+)
+
+
+def segment_clauses(text: str) -> List[Dict[str, Any]]:
+    """Split text into clauses at blank lines and numbered clause headings"""
+    clauses: List[Dict[str, Any]] = []
+    current: List[str] = []
+    start_line = 0
+
+    def close(end_line: int):
+        if current:
+            clauses.append({"text": "\n".join(current), "start_line": start_line + 1, "end_line": end_line})
+            current.clear()
+
+    for number, line in enumerate(text.splitlines()):
+        if not line.strip():
+            close(number)
+            continue
+        if current and _CLAUSE_START.match(line):
+            close(number)
+        if not current:
+            start_line = number
+        current.append(line)
+    close(len(text.splitlines()))
+
+    for index, clause in enumerate(clauses):
+        clause["index"] = index
+    return clauses
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> Set[int]:
+    """Hashes of every run of `size` consecutive words, stable across processes"""
+    # crc32 word ids rather than str hashes, which are salted per process
+    words = list(map(zlib.crc32, map(str.encode, _WORDS.findall(text.lower()))))
+    if len(words) <= size:
+        return {hash(tuple(words))} if words else set()
+    return set(map(hash, zip(*(words[offset:] for offset in range(size)))))
+
+
+def _clause_key(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class ClauseIndex:
+    """Clauses of one document keyed by normalized text, built once and reusable"""
+
+    def __init__(self, text: str):
+        self.clauses = segment_clauses(text)
+        self.by_key: Dict[str, List[int]] = {}
+        for clause in self.clauses:
+            self.by_key.setdefault(_clause_key(clause["text"]), []).append(clause["index"])
+
+    def shingles(self, index: int) -> Set[int]:
+        """Shingles of one clause, computed on first use since exact matches never need them"""
+        clause = self.clauses[index]
+        if "shingles" not in clause:
+            clause["shingles"] = shingle_hashes(clause["text"])
+        return clause["shingles"]
+
+
+def _increasing_subset(pairs: List[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+    """Largest set of pairs (sorted by original index) whose modified indexes also increase"""
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[pile] = j
+            tail_index[pile] = index
+        previous[index] = tail_index[pile - 1] if pile else -1
+
+    in_order = set()
+    index = tail_index[-1] if tail_index else -1
+    while index != -1:
+        in_order.add(pairs[index])
+        index = previous[index]
+    return in_order
+
+
+def match_clauses(baseline: ClauseIndex, candidate: ClauseIndex,
+                  threshold: float = CLAUSE_MATCH_THRESHOLD) -> Dict[int, Tuple[int, float]]:
+    """Map candidate clause index -> (baseline clause index, similarity)"""
+    matches: Dict[int, Tuple[int, float]] = {}
+    used: Set[int] = set()
+
+    # Identical clauses first, pairing repeated text in document order
+    for key, candidate_indexes in candidate.by_key.items():
+        for j, i in zip(candidate_indexes, baseline.by_key.get(key, ())):
+            matches[j] = (i, 1.0)
+            used.add(i)
+
+    # Lightly edited clauses: score only unmatched baseline clauses sharing a shingle
+    postings: Dict[int, List[int]] = {}
+    for clause in baseline.clauses:
+        if clause["index"] not in used:
+            for shingle in baseline.shingles(clause["index"]):
+                postings.setdefault(shingle, []).append(clause["index"])
+
+    scored: List[Tuple[float, int, int]] = []
+    for clause in candidate.clauses:
+        j = clause["index"]
+        if j in matches:
+            continue
+        shingles = candidate.shingles(j)
+        shared = Counter()
+        for shingle in shingles:
+            candidates = postings.get(shingle, ())
+            if len(candidates) <= MAX_SHINGLE_POSTINGS:
+                shared.update(candidates)
+        for i, common in shared.items():
+            union = len(shingles) + len(baseline.shingles(i)) - common
+            similarity = common / union
+            if similarity >= threshold:
+                scored.append((similarity, i, j))
+
+    for similarity, i, j in sorted(scored, key=lambda item: (-item[0], item[1], item[2])):
+        if i not in used and j not in matches:
+            matches[j] = (i, round(similarity, 3))
+            used.add(i)
+    return matches
+
+
+def diff_clauses(baseline: ClauseIndex, candidate: ClauseIndex, granularity: str = "word") -> Dict[str, Any]:
+    """Clause changes of candidate against baseline, with moves reported separately"""
+    matches = match_clauses(baseline, candidate)
+    pairs = sorted((i, j) for j, (i, _) in matches.items())
+    in_order = _increasing_subset(pairs)
+    matched_baseline = {i for i, _ in pairs}
+
+    counts = {"moves": 0, "moved_blocks": 0, "modifications": 0, "insertions": 0, "deletions": 0, "unchanged": 0}
+    ordered: List[Tuple[float, Dict[str, Any]]] = []
+    last_move: Optional[Tuple[int, int]] = None
+
+    for clause in candidate.clauses:
+        j = clause["index"]
+        location = f"line {clause['start_line']}"
+        if j not in matches:
+            counts["insertions"] += 1
+            ordered.append((j, {"type": "insertion", "location": location, "modified_clause": j,
+                                "text": clause["text"].strip()}))
+            continue
+
+        i, similarity = matches[j]
+        original = baseline.clauses[i]
+        moved = (i, j) not in in_order
+        if not moved and similarity == 1.0:
+            counts["unchanged"] += 1
+            continue
+
+        change = {
+            "type": "move" if moved else "modification",
+            "location": location,
+            "original_location": f"line {original['start_line']}",
+            "original_clause": i,
+            "modified_clause": j,
+            "similarity": similarity,
+            "text": clause["text"].strip()
+        }
+        if similarity < 1.0:
+            change["original_text"] = original["text"].strip()
+            if granularity != "line":
+                change["segments"] = refine_hunk(original["text"], clause["text"], granularity)
+        if moved:
+            # Consecutive clauses moved together (a relocated section) share one block number
+            if last_move != (i - 1, j - 1):
+                counts["moved_blocks"] += 1
+            change["move_block"] = counts["moved_blocks"]
+            last_move = (i, j)
+        counts["moves" if moved else "modifications"] += 1
+        ordered.append((j, change))
+
+    # Deleted clauses sit just after the candidate clause matching their nearest in-order predecessor
+    anchor = -1
+    in_order_by_baseline = {i: j for i, j in in_order}
+    for clause in baseline.clauses:
+        i = clause["index"]
+        if i in in_order_by_baseline:
+            anchor = in_order_by_baseline[i]
+        if i in matched_baseline:
+            continue
+        counts["deletions"] += 1
+        ordered.append((anchor + 0.5, {"type": "deletion", "location": f"line {clause['start_line']}",
+                                       "original_clause": i, "text": clause["text"].strip()}))
+
+    ordered.sort(key=lambda item: item[0])
+    counts["total_changes"] = counts["moves"] + counts["modifications"] + counts["insertions"] + counts["deletions"]
+    total = max(len(baseline.clauses), len(candidate.clauses))
+    return {
+        "changes": [change for _, change in ordered],
+        "differences": counts,
+        "similarity": round(sum(similarity for _, similarity in matches.values()) / total, 3) if total else 1.0,
+        "original_clauses": len(baseline.clauses),
+        "modified_clauses": len(candidate.clauses)
+    }
+
+
+def clause_summary(changes: List[Dict[str, Any]], max_lines: Optional[int] = None) -> List[str]:
+    """One readable line per clause change"""
+    lines = []
+    for change in changes[:max_lines]:
+        preview = change["text"].splitlines()[0][:80] if change["text"] else ""
+        if change["type"] == "move":
+            lines.append(f"~ moved {change['original_location']} -> {change['location']}: {preview}")
+        else:
+            marker = {"insertion": "+", "deletion": "-", "modification": "!"}[change["type"]]
+            lines.append(f"{marker} {change['type']} {change['location']}: {preview}")
+    return lines
@@ -0,0 +1,85 @@
+"""
+Content-defined chunking - chunk boundaries are picked from the bytes around them,
+so an edit only changes the chunks it touches and identical content always splits
+the same way, wherever it sits in a file
+"""
+import mmap
+import hashlib
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+import numpy as np
+
+# Bytes in the rolling window that decides whether a position is a boundary
+CHUNK_WINDOW = 48
+_SEGMENT = 1 << 20
+
+# Fixed seed: boundaries (and so chunk fingerprints) must be identical across processes and restarts
+_GEAR = np.random.RandomState(20240715).randint(0, 2 ** 32, size=256, dtype=np.uint64)
+
+
+def chunk_boundaries(data, avg_size: int = 8192) -> List[int]:
+    """End offsets of the chunks of `data` (bytes-like); avg_size must be a power of two"""
+    size = len(data)
+    if not size:
+        return []
+    mask = np.uint64(avg_size - 1)
+    min_size, max_size = avg_size // 4, avg_size * 8
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    # Rolling sum of per-byte random values over the window, vectorized a segment at a time
+    candidates: List[int] = []
+    for start in range(0, size, _SEGMENT):
+        low = max(0, start - CHUNK_WINDOW)
+        sums = np.cumsum(_GEAR[buffer[low:start + _SEGMENT]], dtype=np.uint64)
+        if len(sums) <= CHUNK_WINDOW:
+            continue
+        window = sums[CHUNK_WINDOW:] - sums[:-CHUNK_WINDOW]
+        ends = np.flatnonzero((window & mask) == 0) + low + CHUNK_WINDOW + 1
+        candidates.extend(ends[ends > start].tolist())
+
+    boundaries: List[int] = []
+    last = 0
+    for end in candidates:
+        while end - last > max_size:
+            last += max_size
+            boundaries.append(last)
+        if end - last >= min_size:
+            boundaries.append(end)
+            last = end
+    while size - last > max_size:
+        last += max_size
+        boundaries.append(last)
+    if last < size:
+        boundaries.append(size)
+    return boundaries
+
+
+def iter_chunks(data, avg_size: int = 8192) -> Iterator[Tuple[int, memoryview]]:
+    """(offset, chunk) pairs covering `data` without copying it"""
+    view = memoryview(data)
+    offset = 0
+    try:
+        for end in chunk_boundaries(data, avg_size):
+            yield offset, view[offset:end]
+            offset = end
+    finally:
+        # Release the export so a memory-mapped source can be closed
+        view.release()
+
+
+def chunk_digest(chunk) -> bytes:
+    return hashlib.blake2b(chunk, digest_size=16).digest()
+
+
+@contextmanager
+def mapped_file(file_path: str):
+    """Read-only memory map of a file (empty bytes for an empty file)"""
+    with open(file_path, "rb") as f:
+        if not f.seek(0, 2):
+            yield b""
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
@@ -0,0 +1,70 @@
+"""
+One-to-many comparison - a baseline document is split and indexed once, then
+each candidate is diffed against that index (typically in the PDF worker pool).
+The index is pickled to a file once per batch; each worker loads it on first use.
+"""
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Dict, Any
+
+from document_diff import diff_lines
+from clause_diff import ClauseIndex, diff_clauses
+
+# Baselines each worker process keeps loaded, by the path they were saved to
+BASELINE_CACHE_SIZE = int(os.environ.get("BASELINE_CACHE_SIZE", "4"))
+
+_loaded_baselines: "OrderedDict[str, BaselineIndex]" = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+class BaselineIndex:
+    """Baseline lines or clauses, prepared once and shipped to every candidate diff"""
+
+    def __init__(self, text: str, mode: str = "clauses"):
+        self.mode = mode
+        self.lines = text.splitlines() if mode == "lines" else None
+        self.clauses = ClauseIndex(text) if mode == "clauses" else None
+        if self.clauses is not None:
+            # Fingerprint every clause now so workers don't each redo it
+            for clause in self.clauses.clauses:
+                self.clauses.shingles(clause["index"])
+
+
+def compare_candidate(baseline: BaselineIndex, candidate_text: str, granularity: str = "word",
+                      ignore_whitespace: bool = False) -> Dict[str, Any]:
+    """Diff one candidate document against a prepared baseline"""
+    if baseline.mode == "clauses":
+        return diff_clauses(baseline.clauses, ClauseIndex(candidate_text), granularity)
+    return diff_lines(baseline.lines, candidate_text.splitlines(), granularity, ignore_whitespace)
+
+
+def save_baseline(baseline: BaselineIndex, path: str):
+    """Pickle a prepared baseline once so workers can load it instead of receiving it per task"""
+    with open(path, "wb") as f:
+        pickle.dump(baseline, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_baseline(path: str) -> BaselineIndex:
+    """A saved baseline, unpickled once per process"""
+    with _loaded_lock:
+        baseline = _loaded_baselines.get(path)
+        if baseline is not None:
+            _loaded_baselines.move_to_end(path)
+            return baseline
+    with open(path, "rb") as f:
+        baseline = pickle.load(f)
+    with _loaded_lock:
+        _loaded_baselines[path] = baseline
+        while len(_loaded_baselines) > BASELINE_CACHE_SIZE:
+            _loaded_baselines.popitem(last=False)
+    return baseline
+
+
+def compare_candidate_file(baseline_path: str, candidate_text: str, granularity: str = "word",
+                           ignore_whitespace: bool = False) -> Dict[str, Any]:
+    """compare_candidate against a baseline saved with save_baseline, less the baseline lines the caller holds"""
+    diff = compare_candidate(load_baseline(baseline_path), candidate_text, granularity, ignore_whitespace)
+    diff.pop("original_lines", None)
+    return diff
@@ -0,0 +1,382 @@
+"""
+Document diff engine for /api/compare - patience diff over hashed lines with a
+Myers O(ND) fallback, then word- or character-level refinement inside changed hunks
+"""
+import os
+import re
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+# Regions without unique anchor lines fall back to Myers; past this edit cost
+# the region is reported as one replacement instead of searching further
+DIFF_MAX_EDIT_COST = int(os.environ.get("DIFF_MAX_EDIT_COST", "1000"))
+# Replaced hunks longer than this (in tokens) are not refined below line level
+DIFF_MAX_REFINE_TOKENS = int(os.environ.get("DIFF_MAX_REFINE_TOKENS", "20000"))
+MAX_STORED_COMPARISONS = int(os.environ.get("MAX_STORED_COMPARISONS", "50"))
+# Batch comparisons are kept whole, so a large batch never evicts its own results
+MAX_STORED_COMPARISON_BATCHES = int(os.environ.get("MAX_STORED_COMPARISON_BATCHES", "4"))
+
+GRANULARITIES = ("line", "word", "char")
+COMPARE_MODES = ("lines", "clauses")
+_WORD_TOKENS = re.compile(r"\w+|\s+|[^\w\s]")
+
+Opcode = Tuple[str, int, int, int, int]
+
+
+def intern_sequences(a: Sequence[str], b: Sequence[str], normalize=None) -> Tuple[List[int], List[int]]:
+    """Map items to small ints so the diff compares integers instead of strings"""
+    table: Dict[str, int] = {}
+    key = normalize or (lambda item: item)
+    a_ids = [table.setdefault(key(item), len(table)) for item in a]
+    b_ids = [table.setdefault(key(item), len(table)) for item in b]
+    return a_ids, b_ids
+
+
+def _unique_anchors(a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int) -> List[Tuple[int, int]]:
+    """Longest increasing run of items that occur exactly once on each side (patience sorting)"""
+    counts: Dict[int, List[int]] = {}
+    for i in range(alo, ahi):
+        entry = counts.setdefault(a[i], [0, i, 0, -1])
+        entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted((i, j) for count_a, i, count_b, j in counts.values() if count_a == 1 and count_b == 1)
+    if not pairs:
+        return []
+
+    # Patience sort on the modified-side positions; back-pointers rebuild the LIS
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous: List[int] = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[pile] = j
+            tail_index[pile] = index
+        previous[index] = tail_index[pile - 1] if pile else -1
+
+    anchors = []
+    index = tail_index[-1]
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _myers_matches(a: List[int], b: List[int], alo: int, ahi: int, blo: int, bhi: int,
+                   max_cost: int) -> Optional[List[Tuple[int, int]]]:
+    """Matched (i, j) pairs of a shortest edit script, or None when it costs more than max_cost"""
+    n, m = ahi - alo, bhi - blo
+    max_d = min(n + m, max_cost)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace: List[List[int]] = []
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                trace.append(v[offset - d:offset + d + 1])
+                return _myers_backtrack(trace, n, m, alo, blo)
+        trace.append(v[offset - d:offset + d + 1])
+    return None
+
+
+def _myers_backtrack(trace: List[List[int]], n: int, m: int, alo: int, blo: int) -> List[Tuple[int, int]]:
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        previous = trace[d - 1]  # covers diagonals -(d - 1)..(d - 1)
+        k = x - y
+        if k == -d or (k != d and previous[k - 1 + d - 1] < previous[k + 1 + d - 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = previous[prev_k + d - 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = prev_x, prev_y
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((alo + x, blo + y))
+    matches.reverse()
+    return matches
+
+
+def diff_sequences(a: List[int], b: List[int], max_cost: int = DIFF_MAX_EDIT_COST) -> List[Opcode]:
+    """SequenceMatcher-style opcodes for two interned sequences"""
+    matches: List[Tuple[int, int]] = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        # Common prefix and suffix never need searching
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            start_a, start_b = alo, blo
+            for i, j in anchors:
+                matches.append((i, j))
+                regions.append((start_a, i, start_b, j))
+                start_a, start_b = i + 1, j + 1
+            regions.append((start_a, ahi, start_b, bhi))
+        else:
+            matches.extend(_myers_matches(a, b, alo, ahi, blo, bhi, max_cost) or ())
+
+    matches.sort()
+    opcodes: List[Opcode] = []
+    i = j = 0
+    for mi, mj in matches + [(len(a), len(b))]:
+        if i < mi or j < mj:
+            tag = "replace" if i < mi and j < mj else ("delete" if i < mi else "insert")
+            opcodes.append((tag, i, mi, j, mj))
+        if mi < len(a):
+            if opcodes and opcodes[-1][0] == "equal":
+                _, ei1, _, ej1, _ = opcodes[-1]
+                opcodes[-1] = ("equal", ei1, mi + 1, ej1, mj + 1)
+            else:
+                opcodes.append(("equal", mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+
+def _tokenize(text: str, granularity: str) -> List[str]:
+    return list(text) if granularity == "char" else _WORD_TOKENS.findall(text)
+
+
+def refine_hunk(original: str, modified: str, granularity: str = "word") -> Optional[List[Dict[str, str]]]:
+    """Equal/delete/insert segments between two texts; None when the hunk is too large to refine"""
+    a_tokens, b_tokens = _tokenize(original, granularity), _tokenize(modified, granularity)
+    if len(a_tokens) + len(b_tokens) > DIFF_MAX_REFINE_TOKENS:
+        return None
+    a_ids, b_ids = intern_sequences(a_tokens, b_tokens)
+
+    segments: List[Dict[str, str]] = []
+
+    def emit(op: str, text: str):
+        if not text:
+            return
+        if segments and segments[-1]["op"] == op:
+            segments[-1]["text"] += text
+        else:
+            segments.append({"op": op, "text": text})
+
+    for tag, i1, i2, j1, j2 in diff_sequences(a_ids, b_ids):
+        if tag == "equal":
+            emit("equal", "".join(a_tokens[i1:i2]))
+            continue
+        emit("delete", "".join(a_tokens[i1:i2]))
+        emit("insert", "".join(b_tokens[j1:j2]))
+    return segments
+
+
+def build_changes(original_lines: List[str], modified_lines: List[str], opcodes: List[Opcode],
+                  granularity: str = "word") -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """One change record per hunk; a replaced hunk pairs its lines into modifications"""
+    changes: List[Dict[str, Any]] = []
+    counts = {"insertions": 0, "deletions": 0, "modifications": 0}
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            continue
+        change: Dict[str, Any] = {
+            "location": f"line {i1 + 1}",
+            "original_lines": [i1 + 1, i2],
+            "modified_lines": [j1 + 1, j2]
+        }
+        if tag == "insert":
+            counts["insertions"] += j2 - j1
+            change.update(type="insertion", text="\n".join(modified_lines[j1:j2]).strip())
+        elif tag == "delete":
+            counts["deletions"] += i2 - i1
+            change.update(type="deletion", text="\n".join(original_lines[i1:i2]).strip())
+        else:
+            paired = min(i2 - i1, j2 - j1)
+            counts["modifications"] += paired
+            counts["deletions"] += (i2 - i1) - paired
+            counts["insertions"] += (j2 - j1) - paired
+            original_text = "\n".join(original_lines[i1:i2])
+            modified_text = "\n".join(modified_lines[j1:j2])
+            change.update(type="modification", text=modified_text.strip(), original_text=original_text.strip())
+            if granularity != "line":
+                change["segments"] = refine_hunk(original_text, modified_text, granularity)
+        changes.append(change)
+
+    counts["total_changes"] = counts["insertions"] + counts["deletions"] + counts["modifications"]
+    return changes, counts
+
+
+def _grouped_opcodes(opcodes: List[Opcode], context: int):
+    """Changed hunks with surrounding context, grouped the way difflib does"""
+    codes = list(opcodes)
+    if not codes:
+        return
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+
+    group: List[Opcode] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _unified_range(start: int, stop: int) -> str:
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return f"{start if not length else start + 1},{length}"
+
+
+def unified_diff(original_lines: List[str], modified_lines: List[str], opcodes: List[Opcode],
+                 fromfile: str = "", tofile: str = "", context: int = 3, max_lines: Optional[int] = None) -> List[str]:
+    """Unified diff lines (difflib's format) built from precomputed opcodes"""
+    output: List[str] = []
+    for group in _grouped_opcodes(opcodes, context):
+        if not output:
+            output.extend([f"--- {fromfile}", f"+++ {tofile}"])
+        first, last = group[0], group[-1]
+        output.append(f"@@ -{_unified_range(first[1], last[2])} +{_unified_range(first[3], last[4])} @@")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                output.extend(" " + line for line in original_lines[i1:i2])
+                continue
+            output.extend("-" + line for line in original_lines[i1:i2])
+            output.extend("+" + line for line in modified_lines[j1:j2])
+        if max_lines is not None and len(output) >= max_lines:
+            return output[:max_lines]
+    return output
+
+
+def diff_lines(original_lines: List[str], modified_lines: List[str], granularity: str = "word",
+               ignore_whitespace: bool = False) -> Dict[str, Any]:
+    """Line diff of two split documents, refined inside changed hunks"""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    normalize = (lambda line: " ".join(line.split())) if ignore_whitespace else None
+    a_ids, b_ids = intern_sequences(original_lines, modified_lines, normalize)
+    opcodes = diff_sequences(a_ids, b_ids)
+    changes, counts = build_changes(original_lines, modified_lines, opcodes, granularity)
+    matched = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+    total = len(original_lines) + len(modified_lines)
+    return {
+        "original_lines": original_lines,
+        "modified_lines": modified_lines,
+        "opcodes": opcodes,
+        "changes": changes,
+        "differences": counts,
+        "similarity": round(2 * matched / total, 3) if total else 1.0
+    }
+
+
+def diff_documents(original_text: str, modified_text: str, granularity: str = "word",
+                   ignore_whitespace: bool = False) -> Dict[str, Any]:
+    """Line diff of two texts, refined inside changed hunks"""
+    return diff_lines(original_text.splitlines(), modified_text.splitlines(), granularity, ignore_whitespace)
+
+
+# Recent comparisons, kept so their full change lists can be paged through
+comparison_results: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_comparisons_lock = threading.Lock()
+
+
+def remember_comparison(comparison_id: str, comparison: Dict[str, Any]):
+    with _comparisons_lock:
+        comparison_results[comparison_id] = comparison
+        while len(comparison_results) > MAX_STORED_COMPARISONS:
+            comparison_results.popitem(last=False)
+
+
+# batch_id -> (baseline lines shared by the batch, {comparison_id: comparison without them}),
+# plus the batch each stored comparison belongs to
+comparison_batches: "OrderedDict[str, Tuple[Optional[List[str]], Dict[str, Dict[str, Any]]]]" = OrderedDict()
+_comparison_batch_ids: Dict[str, str] = {}
+
+
+def remember_comparison_batch(batch_id: str, comparisons: Dict[str, Dict[str, Any]],
+                              original_lines: Optional[List[str]] = None):
+    """Keep every comparison of a batch until the batch as a whole is evicted, the baseline lines only once"""
+    with _comparisons_lock:
+        comparison_batches[batch_id] = (original_lines, comparisons)
+        _comparison_batch_ids.update((comparison_id, batch_id) for comparison_id in comparisons)
+        while len(comparison_batches) > MAX_STORED_COMPARISON_BATCHES:
+            _, (_, evicted) = comparison_batches.popitem(last=False)
+            for comparison_id in evicted:
+                _comparison_batch_ids.pop(comparison_id, None)
+
+
+def get_comparison(comparison_id: str) -> Optional[Dict[str, Any]]:
+    with _comparisons_lock:
+        comparison = comparison_results.get(comparison_id)
+        if comparison is not None:
+            comparison_results.move_to_end(comparison_id)
+            return comparison
+        batch_id = _comparison_batch_ids.get(comparison_id)
+        if batch_id is None:
+            return None
+        comparison_batches.move_to_end(batch_id)
+        original_lines, comparisons = comparison_batches[batch_id]
+        comparison = comparisons[comparison_id]
+        return comparison if original_lines is None else {**comparison, "original_lines": original_lines}
+
+
+def parse_page_limit(value: Any) -> Optional[int]:
+    """Page size from a request body (ints or numeric strings), None when invalid or below 1"""
+    if isinstance(value, bool):
+        return None
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit >= 1 else None
+
+
+def page_changes(changes: List[Dict[str, Any]], offset: int, limit: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Pagination metadata and the requested slice of a change list"""
+    page = changes[offset:offset + limit]
+    next_offset = offset + len(page)
+    return {
+        "offset": offset,
+        "limit": limit,
+        "total": len(changes),
+        "next_offset": next_offset if next_offset < len(changes) else None
+    }, page
@@ -3,11 +3,11 @@ import tempfile
 import subprocess
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 import pypandoc
 from docx import Document
-import PyPDF2
 from io import BytesIO
+from pdf_cache import pdf_reader_cache
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +20,9 @@ class FileConverter:
         self.temp_dir = os.path.join(storage_base, "conversions")
         os.makedirs(self.temp_dir, exist_ok=True)
     
-    async def convert_file(self, input_path: str, input_format: str, output_format: str, conversion_id: str) -> str:
-        """Convert file from input format to output format"""
+    async def convert_file(self, input_path: str, input_format: str, output_format: str, conversion_id: str,
+                           pages: Optional[List[int]] = None) -> str:
+        """Convert file from input format to output format, optionally only the given PDF pages"""
         try:
             output_filename = f"{conversion_id}_converted.{output_format}"
             output_path = os.path.join(self.temp_dir, output_filename)
@@ -29,17 +30,17 @@ class FileConverter:
             # Route to appropriate conversion method
             if input_format == "pdf":
                 if output_format in ["txt", "html"]:
-                    await self._convert_pdf_to_text_based(input_path, output_path, output_format)
+                    await self._convert_pdf_to_text_based(input_path, output_path, output_format, pages)
                 elif output_format == "docx":
-                    await self._convert_pdf_to_docx(input_path, output_path)
+                    await self._convert_pdf_to_docx(input_path, output_path, pages)
                 elif output_format == "pdfa":
                     # PDF to PDF/A conversion
-                    await self._convert_to_pdfa(input_path, output_path)
+                    await self._convert_to_pdfa(input_path, output_path, pages)
                 else:
                     # For other formats, convert PDF → TXT → target format
                     # Since pandoc can't read PDFs
                     temp_txt_path = os.path.join(self.temp_dir, f"{conversion_id}_temp.txt")
-                    await self._convert_pdf_to_text_based(input_path, temp_txt_path, "txt")
+                    await self._convert_pdf_to_text_based(input_path, temp_txt_path, "txt", pages)
                     await self._convert_with_pandoc(temp_txt_path, output_path, "txt", output_format)
             
             elif input_format in ["docx", "doc"]:
@@ -134,15 +135,22 @@ class FileConverter:
             except subprocess.CalledProcessError as e:
                 raise Exception(f"Pandoc conversion failed: {e.stderr}")
     
-    async def _convert_pdf_to_text_based(self, input_path: str, output_path: str, output_format: str):
+    @staticmethod
+    def _extract_pdf_text(input_path: str, pages: Optional[List[int]] = None) -> str:
+        """Extract text from the selected 1-based pages only - other pages' content is never parsed"""
+        with pdf_reader_cache.reader(input_path) as pdf_reader:
+            page_numbers = pages or range(1, len(pdf_reader.pages) + 1)
+            text = ""
+            for page_num in page_numbers:
+                text += pdf_reader.pages[page_num - 1].extract_text() + "\n"
+        return text
+    
+    async def _convert_pdf_to_text_based(self, input_path: str, output_path: str, output_format: str,
+                                         pages: Optional[List[int]] = None):
         """Convert PDF to text-based formats"""
         try:
             # Extract text from PDF
-            with open(input_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
+            text = self._extract_pdf_text(input_path, pages)
             
             if output_format == "txt":
                 with open(output_path, 'w', encoding='utf-8') as f:
@@ -164,15 +172,11 @@ class FileConverter:
         except Exception as e:
             raise Exception(f"PDF to text conversion failed: {str(e)}")
     
-    async def _convert_pdf_to_docx(self, input_path: str, output_path: str):
+    async def _convert_pdf_to_docx(self, input_path: str, output_path: str, pages: Optional[List[int]] = None):
         """Convert PDF to DOCX"""
         try:
             # Extract text from PDF
-            with open(input_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
+            text = self._extract_pdf_text(input_path, pages)
             
             # Create DOCX document
             doc = Document()
@@ -226,7 +230,7 @@ class FileConverter:
         except Exception as e:
             raise Exception(f"Text conversion failed: {str(e)}")
     
-    async def _convert_to_pdfa(self, input_path: str, output_path: str):
+    async def _convert_to_pdfa(self, input_path: str, output_path: str, pages: Optional[List[int]] = None):
         """Convert PDF to PDF/A archival format"""
         try:
             # Try using ghostscript for PDF/A conversion
@@ -247,6 +251,8 @@ class FileConverter:
                     f"-sOutputFile={output_path}",
                     input_path
                 ]
+                if pages:
+                    cmd.insert(-1, f"-sPageList={','.join(str(p) for p in pages)}")
                 result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
                 
                 if result.returncode == 0 and os.path.exists(output_path):
@@ -266,9 +272,9 @@ class FileConverter:
             reader = PdfReader(input_path)
             writer = PdfWriter()
             
-            # Copy all pages
-            for page in reader.pages:
-                writer.add_page(page)
+            # Copy the selected pages (all by default)
+            for page_num in pages or range(1, len(reader.pages) + 1):
+                writer.add_page(reader.pages[page_num - 1])
             
             # Add PDF/A-like metadata
             writer.add_metadata({
@@ -0,0 +1,319 @@
+"""
+PDF incremental updates - append changed and new objects plus a cross-reference
+section to the original bytes instead of re-serializing the whole document.
+Earlier revisions (and any signatures over them) are left untouched.
+"""
+import io
+import os
+import re
+import struct
+import hashlib
+import logging
+from typing import Dict, Any, Optional, Tuple
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (
+    ArrayObject, BooleanObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject,
+    IndirectObject, NameObject, NumberObject, StreamObject, TextStringObject
+)
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+_STARTXREF = re.compile(rb"startxref\s+(\d+)")
+
+
+class IncrementalUpdateUnsupported(Exception):
+    """The source PDF cannot take an incremental update (e.g. it is encrypted)"""
+
+
+def _find_startxref(file_path: str) -> int:
+    """Offset of the last cross-reference section, read from the file tail"""
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 2048))
+        tail = f.read()
+    matches = _STARTXREF.findall(tail)
+    if not matches:
+        raise IncrementalUpdateUnsupported("startxref not found")
+    return int(matches[-1])
+
+
+def _uses_xref_stream(file_path: str, offset: int) -> bool:
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return not f.read(4).startswith(b"xref")
+
+
+class IncrementalUpdate:
+    """Collects new and modified objects for a PDF and appends them as an update"""
+
+    def __init__(self, reader: PdfReader, source_path: str):
+        if reader.is_encrypted:
+            raise IncrementalUpdateUnsupported("encrypted PDFs are rewritten in full")
+        self.reader = reader
+        self.source_path = source_path
+        self.prev_startxref = _find_startxref(source_path)
+        self.xref_stream = _uses_xref_stream(source_path, self.prev_startxref)
+        self._next_number = self._object_count(reader)
+        self._objects: Dict[int, Tuple[int, Any]] = {}
+
+    @staticmethod
+    def _object_count(reader: PdfReader) -> int:
+        """Trailer /Size, falling back to the parsed xref (PyPDF2 drops it for xref streams)"""
+        known = [n for entries in reader.xref.values() for n in entries] + list(reader.xref_objStm)
+        size = int(reader.trailer["/Size"]) if "/Size" in reader.trailer else 0
+        return max([size] + [n + 1 for n in known])
+
+    def _reserve(self) -> IndirectObject:
+        ref = IndirectObject(self._next_number, 0, self.reader)
+        self._next_number += 1
+        return ref
+
+    def add_object(self, obj) -> IndirectObject:
+        """Add a new object and return a reference to it"""
+        ref = self._reserve()
+        self._objects[ref.idnum] = (0, obj)
+        return ref
+
+    def update_object(self, ref: IndirectObject, obj=None):
+        """Replace an existing object (by default with its in-memory, modified state)"""
+        self._objects[ref.idnum] = (ref.generation, obj if obj is not None else ref.get_object())
+
+    def import_object(self, obj, _memo: Optional[Dict] = None):
+        """Deep-copy an object graph from another PDF, giving its indirect objects new numbers"""
+        memo = {} if _memo is None else _memo
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            if key not in memo:
+                ref = self._reserve()
+                memo[key] = ref
+                self._objects[ref.idnum] = (0, self.import_object(obj.get_object(), memo))
+            return memo[key]
+        if isinstance(obj, StreamObject):
+            copy = EncodedStreamObject() if isinstance(obj, EncodedStreamObject) else DecodedStreamObject()
+            copy._data = obj._data
+            for key, value in obj.items():
+                copy[NameObject(key)] = self.import_object(value, memo)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for key, value in obj.items():
+                copy[NameObject(key)] = self.import_object(value, memo)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([self.import_object(value, memo) for value in obj])
+        return obj
+
+    def _trailer_entries(self) -> DictionaryObject:
+        trailer = DictionaryObject()
+        source = self.reader.trailer
+        for key in ("/Root", "/Info", "/ID"):
+            if key in source:
+                trailer[NameObject(key)] = source.raw_get(key)
+        trailer[NameObject("/Prev")] = NumberObject(self.prev_startxref)
+        return trailer
+
+    @staticmethod
+    def _subsections(numbers):
+        """Group sorted object numbers into (first, count) runs"""
+        runs = []
+        for number in numbers:
+            if runs and runs[-1][0] + runs[-1][1] == number:
+                runs[-1][1] += 1
+            else:
+                runs.append([number, 1])
+        return runs
+
+    def write(self, output_path: str) -> str:
+        """Write original bytes plus the update to output_path and return its SHA-256"""
+        digest = hashlib.sha256()
+
+        with open(self.source_path, 'rb') as src, open(output_path, 'wb') as out:
+            last_byte = b""
+            for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b""):
+                out.write(chunk)
+                digest.update(chunk)
+                last_byte = chunk[-1:]
+
+            update = io.BytesIO()
+            base_offset = out.tell()
+            if last_byte not in (b"\n", b"\r"):
+                update.write(b"\n")
+
+            offsets = {}
+            for number in sorted(self._objects):
+                generation, obj = self._objects[number]
+                offsets[number] = (base_offset + update.tell(), generation)
+                update.write(f"{number} {generation} obj\n".encode())
+                obj.write_to_stream(update, None)
+                update.write(b"\nendobj\n")
+
+            trailer = self._trailer_entries()
+            if self.xref_stream:
+                xref_number = self._reserve().idnum
+                offsets[xref_number] = (base_offset + update.tell(), 0)
+                numbers = sorted(offsets)
+                rows = b"".join(struct.pack(">BIH", 1, offsets[n][0], offsets[n][1]) for n in numbers)
+                xref = DecodedStreamObject()
+                xref.set_data(rows)
+                xref.update(trailer)
+                xref[NameObject("/Type")] = NameObject("/XRef")
+                xref[NameObject("/Size")] = NumberObject(self._next_number)
+                xref[NameObject("/W")] = ArrayObject([NumberObject(1), NumberObject(4), NumberObject(2)])
+                xref[NameObject("/Index")] = ArrayObject(
+                    [NumberObject(v) for run in self._subsections(numbers) for v in run]
+                )
+                startxref = offsets[xref_number][0]
+                update.write(f"{xref_number} 0 obj\n".encode())
+                xref.write_to_stream(update, None)
+                update.write(b"\nendobj\n")
+            else:
+                startxref = base_offset + update.tell()
+                # Lead with the free-list head; some readers expect every table to start at 0
+                update.write(b"xref\n0 1\n0000000000 65535 f \n")
+                for first, count in self._subsections(sorted(offsets)):
+                    update.write(f"{first} {count}\n".encode())
+                    for number in range(first, first + count):
+                        offset, generation = offsets[number]
+                        update.write(f"{offset:010d} {generation:05d} n \n".encode())
+                trailer[NameObject("/Size")] = NumberObject(self._next_number)
+                update.write(b"trailer\n")
+                trailer.write_to_stream(update, None)
+                update.write(b"\n")
+
+            update.write(f"startxref\n{startxref}\n%%EOF\n".encode())
+            data = update.getvalue()
+            out.write(data)
+            digest.update(data)
+
+        return digest.hexdigest()
+
+
+def _content_stream(data: bytes) -> DecodedStreamObject:
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return stream
+
+
+def stamp_overlay_incremental(input_path: str, output_path: str, overlay_pdf: bytes, page_index: int) -> str:
+    """Paint the first page of overlay_pdf on one page via an incremental update"""
+    reader = PdfReader(input_path)
+    update = IncrementalUpdate(reader, input_path)
+
+    if not 0 <= page_index < len(reader.pages):
+        return update.write(output_path)
+
+    overlay_page = PdfReader(io.BytesIO(overlay_pdf)).pages[0]
+    overlay_contents = overlay_page.get_contents()
+
+    # Wrap the overlay as a form XObject so its resources stay separate from the page's
+    form = _content_stream(overlay_contents.get_data() if overlay_contents is not None else b"")
+    form[NameObject("/Type")] = NameObject("/XObject")
+    form[NameObject("/Subtype")] = NameObject("/Form")
+    form[NameObject("/BBox")] = ArrayObject([NumberObject(int(float(v))) for v in overlay_page.mediabox])
+    if "/Resources" in overlay_page:
+        form[NameObject("/Resources")] = update.import_object(overlay_page.raw_get("/Resources"))
+    form_ref = update.add_object(form)
+
+    page = reader.pages[page_index]
+    resources = DictionaryObject()
+    if "/Resources" in page:
+        resources.update(page["/Resources"].get_object())
+    xobjects = DictionaryObject()
+    if "/XObject" in resources:
+        xobjects.update(resources["/XObject"].get_object())
+    form_name = f"/LDCStamp{len(xobjects)}"
+    while form_name in xobjects:
+        form_name += "_"
+    xobjects[NameObject(form_name)] = form_ref
+    resources[NameObject("/XObject")] = xobjects
+    page[NameObject("/Resources")] = resources
+
+    # Isolate the existing content's graphics state, then paint the overlay on top
+    contents = page.raw_get("/Contents") if "/Contents" in page else None
+    if isinstance(contents, IndirectObject) and isinstance(contents.get_object(), ArrayObject):
+        contents = contents.get_object()
+    existing = list(contents) if isinstance(contents, ArrayObject) else ([contents] if contents is not None else [])
+    page[NameObject("/Contents")] = ArrayObject(
+        [update.add_object(_content_stream(b"q\n"))]
+        + existing
+        + [update.add_object(_content_stream(f"\nQ\nq {form_name} Do Q\n".encode()))]
+    )
+    update.update_object(page.indirect_reference, page)
+
+    return update.write(output_path)
+
+
+def _button_state(field, value) -> NameObject:
+    """Map a requested checkbox/radio value onto one of the widget's appearance states"""
+    if isinstance(value, bool) or str(value).lower() in ("true", "false", "on", "off"):
+        checked = value if isinstance(value, bool) else str(value).lower() in ("true", "on")
+        if not checked:
+            return NameObject("/Off")
+        widgets = [kid.get_object() for kid in field.get("/Kids", [])] or [field]
+        for widget in widgets:
+            normal = widget.get("/AP", {}).get("/N", {})
+            for state in normal.get_object().keys() if normal else []:
+                if state != "/Off":
+                    return NameObject(state)
+        return NameObject("/Yes")
+    value = str(value)
+    return NameObject(value if value.startswith("/") else f"/{value}")
+
+
+def fill_form_incremental(input_path: str, output_path: str, field_values: Dict[str, Any]) -> Tuple[int, str]:
+    """Set AcroForm field values via an incremental update; returns (fields_filled, sha256)"""
+    reader = PdfReader(input_path)
+    update = IncrementalUpdate(reader, input_path)
+
+    root_ref = reader.trailer.raw_get("/Root")
+    catalog = root_ref.get_object()
+    acro_form_ref = catalog.raw_get("/AcroForm") if "/AcroForm" in catalog else None
+    if acro_form_ref is None:
+        return 0, update.write(output_path)
+    acro_form = acro_form_ref.get_object()
+
+    filled = set()
+
+    def visit(ref, parent_name: str, inherited_type, holder_ref):
+        field = ref.get_object()
+        own_ref = ref if isinstance(ref, IndirectObject) else holder_ref
+        partial_name = field.get("/T")
+        name = parent_name if partial_name is None else (f"{parent_name}.{partial_name}" if parent_name else str(partial_name))
+        field_type = field.get("/FT", inherited_type)
+
+        if partial_name is not None and name in field_values:
+            value = field_values[name]
+            if field_type == "/Btn":
+                state = _button_state(field, value)
+                field[NameObject("/V")] = state
+                widgets = list(field.get("/Kids", [])) or [ref]
+                for widget_ref in widgets:
+                    widget = widget_ref.get_object()
+                    if "/Subtype" in widget or widget is field:
+                        appearances = widget.get("/AP", {}).get("/N", {})
+                        on_states = appearances.get_object().keys() if appearances else []
+                        widget[NameObject("/AS")] = state if state in on_states else NameObject("/Off")
+                        if isinstance(widget_ref, IndirectObject):
+                            update.update_object(widget_ref, widget)
+            else:
+                field[NameObject("/V")] = TextStringObject(str(value))
+            update.update_object(own_ref, own_ref.get_object())
+            filled.add(name)
+
+        for kid in field.get("/Kids", []):
+            if "/T" in kid.get_object():
+                visit(kid, name, field_type, own_ref)
+
+    for field_ref in acro_form.get("/Fields", []):
+        visit(field_ref, "", None, acro_form_ref if isinstance(acro_form_ref, IndirectObject) else root_ref)
+
+    # Ask viewers to regenerate appearance streams for the new values
+    acro_form[NameObject("/NeedAppearances")] = BooleanObject(True)
+    if isinstance(acro_form_ref, IndirectObject):
+        update.update_object(acro_form_ref, acro_form)
+    else:
+        update.update_object(root_ref, catalog)
+
+    return len(filled), update.write(output_path)
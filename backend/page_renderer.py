@@ -0,0 +1,248 @@
+"""
+On-demand PDF page rendering for the viewer - single pages at a requested scale,
+optional tiles, a size-bounded memory + disk cache and neighbour prefetch
+"""
+import io
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+from PIL import Image
+from pdf2image import convert_from_path
+
+logger = logging.getLogger(__name__)
+
+RENDER_CACHE_DIR = os.environ.get(
+    "RENDER_CACHE_DIR", os.path.join(os.path.dirname(__file__), "storage", "render_cache")
+)
+RENDER_MEMORY_CACHE_MB = int(os.environ.get("RENDER_MEMORY_CACHE_MB", "64"))
+RENDER_DISK_CACHE_MB = int(os.environ.get("RENDER_DISK_CACHE_MB", "512"))
+RENDER_PREFETCH_WORKERS = int(os.environ.get("RENDER_PREFETCH_WORKERS", "2"))
+
+MIN_SCALE = 0.1
+MAX_SCALE = 4.0
+# Named presets accepted in place of a numeric scale
+SCALE_PRESETS = {"thumbnail": 0.25, "1x": 1.0, "2x": 2.0}
+RENDER_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg")}
+JPEG_QUALITY = 85
+
+
+def parse_scale(value: str) -> Optional[float]:
+    """Resolve a preset name or number to a render scale, None when out of bounds"""
+    if value in SCALE_PRESETS:
+        return SCALE_PRESETS[value]
+    try:
+        scale = float(value)
+    except (TypeError, ValueError):
+        return None
+    return scale if MIN_SCALE <= scale <= MAX_SCALE else None
+
+
+def render_page(file_path: str, page_number: int, scale: float) -> Image.Image:
+    """Rasterize a single 1-based page; poppler is asked for that page only"""
+    images = convert_from_path(
+        file_path, dpi=int(72 * scale), first_page=page_number, last_page=page_number
+    )
+    if not images:
+        raise ValueError(f"Page {page_number} could not be rendered")
+    return images[0]
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    pil_format = RENDER_FORMATS[fmt][0]
+    if pil_format == "JPEG":
+        image.convert("RGB").save(buffer, pil_format, quality=JPEG_QUALITY)
+    else:
+        image.save(buffer, pil_format, optimize=False)
+    return buffer.getvalue()
+
+
+class PageRenderCache:
+    """Rendered images in a byte-bounded memory LRU backed by a byte-bounded disk cache"""
+
+    def __init__(self, cache_dir: str = RENDER_CACHE_DIR,
+                 memory_bytes: int = RENDER_MEMORY_CACHE_MB * 1024 * 1024,
+                 disk_bytes: int = RENDER_DISK_CACHE_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_total = 0
+        self._disk_total: Optional[int] = None
+        self._lock = threading.RLock()
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._prefetcher = ThreadPoolExecutor(max_workers=RENDER_PREFETCH_WORKERS, thread_name_prefix="render-prefetch")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(file_path: str, page_number: int, scale: float, fmt: str, tile: Optional[Tuple[int, int, int]] = None) -> str:
+        """Key on the file's (mtime, size) stamp so edited files never serve stale images"""
+        stat = os.stat(file_path)
+        parts = [os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, page_number, f"{scale:.3f}", fmt, tile]
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _disk_path(self, key: str, fmt: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{fmt}")
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_total += len(data)
+            while self._memory_total > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_total -= len(evicted)
+
+    def get(self, key: str, fmt: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return data
+
+        path = self._disk_path(key, fmt)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Disk eviction goes by last use
+        except OSError:
+            return None
+        self._remember(key, data)
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, fmt: str, data: bytes):
+        self._remember(key, data)
+        path = self._disk_path(key, fmt)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write render cache entry: {e}")
+            return
+        with self._lock:
+            if self._disk_total is None:
+                self._disk_total = self._scan_disk_usage()
+            else:
+                self._disk_total += len(data)
+            if self._disk_total > self.disk_bytes:
+                self._evict_disk()
+
+    def _scan_disk_usage(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def _evict_disk(self):
+        """Delete least recently used files until the cache is back under 90% of its bound"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_total = total
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._inflight.setdefault(key, threading.Lock())
+
+    def _get_or_create(self, key: str, fmt: str, produce) -> Tuple[bytes, bool]:
+        """Return (data, cache_hit); concurrent requests for one key render it once"""
+        data = self.get(key, fmt)
+        if data is not None:
+            return data, True
+        lock = self._key_lock(key)
+        with lock:
+            data = self.get(key, fmt)
+            if data is not None:
+                return data, True
+            with self._lock:
+                self.misses += 1
+            data = produce()
+            self.put(key, fmt, data)
+        with self._lock:
+            self._inflight.pop(key, None)
+        return data, False
+
+    def page_image(self, file_path: str, page_number: int, scale: float, fmt: str = "png") -> Tuple[bytes, bool]:
+        """Encoded image of a whole page"""
+        key = self.cache_key(file_path, page_number, scale, fmt)
+        return self._get_or_create(key, fmt, lambda: _encode(render_page(file_path, page_number, scale), fmt))
+
+    def tile_image(self, file_path: str, page_number: int, scale: float, fmt: str,
+                   tile_size: int, tile_x: int, tile_y: int) -> Tuple[bytes, bool]:
+        """Encoded tile_size square (clipped at the edges) of a page rendered at scale"""
+        key = self.cache_key(file_path, page_number, scale, fmt, (tile_size, tile_x, tile_y))
+
+        def produce():
+            # Tiles are cut from the cached full-page render rather than rasterizing again
+            page_data, _ = self.page_image(file_path, page_number, scale, "png")
+            with Image.open(io.BytesIO(page_data)) as page:
+                left, top = tile_x * tile_size, tile_y * tile_size
+                if tile_x < 0 or tile_y < 0 or left >= page.width or top >= page.height:
+                    raise ValueError("Tile is outside the page")
+                box = (left, top, min(left + tile_size, page.width), min(top + tile_size, page.height))
+                return _encode(page.crop(box), fmt)
+
+        return self._get_or_create(key, fmt, produce)
+
+    def prefetch(self, file_path: str, page_numbers, scale: float, fmt: str = "png"):
+        """Render pages in the background so paging through the document hits the cache"""
+        for page_number in page_numbers:
+            self._prefetcher.submit(self._prefetch_one, file_path, page_number, scale, fmt)
+
+    def _prefetch_one(self, file_path: str, page_number: int, scale: float, fmt: str):
+        try:
+            self.page_image(file_path, page_number, scale, fmt)
+        except Exception as e:
+            logger.debug(f"Prefetch of page {page_number} failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_total,
+                "disk_bytes": self._disk_total,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def shutdown(self):
+        self._prefetcher.shutdown(wait=False, cancel_futures=True)
+
+
+page_render_cache = PageRenderCache()
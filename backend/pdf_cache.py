@@ -0,0 +1,121 @@
+"""
+Process-wide LRU cache of parsed PdfReader handles for read-only PDF access
+"""
+import os
+import io
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any
+from PyPDF2 import PdfReader
+
+logger = logging.getLogger(__name__)
+
+# Cache bounds - entry count and estimated memory footprint
+PDF_READER_CACHE_ENTRIES = int(os.environ.get("PDF_READER_CACHE_ENTRIES", "32"))
+PDF_READER_CACHE_MB = int(os.environ.get("PDF_READER_CACHE_MB", "256"))
+
+# Parsed object graphs typically weigh about as much as the raw bytes we keep
+MEMORY_OVERHEAD_FACTOR = 2
+
+
+class _CacheEntry:
+    def __init__(self, stamp, reader: PdfReader, size_estimate: int):
+        self.stamp = stamp
+        self.reader = reader
+        self.size_estimate = size_estimate
+        # PdfReader is not thread-safe, so callers hold this while using it
+        self.lock = threading.Lock()
+
+
+class PdfReaderCache:
+    """LRU of parsed readers keyed by file path and its (mtime, size) stamp"""
+
+    def __init__(self, max_entries: int = PDF_READER_CACHE_ENTRIES, max_bytes: int = PDF_READER_CACHE_MB * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stamp(file_path: str):
+        stat = os.stat(file_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _get_entry(self, file_path: str) -> _CacheEntry:
+        key = os.path.abspath(file_path)
+        stamp = self._stamp(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stamp == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+
+        # Parse outside the cache lock so other documents are not blocked
+        with open(key, "rb") as f:
+            data = f.read()
+        entry = _CacheEntry(stamp, PdfReader(io.BytesIO(data)), len(data) * MEMORY_OVERHEAD_FACTOR)
+
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None and existing.stamp == stamp:
+                # Another thread parsed the same file meanwhile - keep theirs
+                self._entries.move_to_end(key)
+                return existing
+            if existing is not None:
+                self._remove(key)
+            if entry.size_estimate <= self.max_bytes:
+                self._entries[key] = entry
+                self._total_bytes += entry.size_estimate
+                self._evict()
+        return entry
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry.size_estimate
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.size_estimate
+
+    @contextmanager
+    def reader(self, file_path: str):
+        """Yield a parsed reader for the file, exclusive to the caller while in use"""
+        entry = self._get_entry(file_path)
+        with entry.lock:
+            yield entry.reader
+
+    def invalidate(self, file_path: str):
+        """Drop the cached reader for a file that was overwritten in place"""
+        with self._lock:
+            self._remove(os.path.abspath(file_path))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "estimated_bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+pdf_reader_cache = PdfReaderCache()
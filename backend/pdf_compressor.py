@@ -0,0 +1,292 @@
+"""
+Image-aware PDF compression - downsamples and re-encodes embedded images per
+quality profile, deduplicates identical image streams and drops unused images
+"""
+import io
+import os
+import re
+import hashlib
+import logging
+from typing import Dict, Any, Optional, Tuple
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import NameObject, NumberObject, IndirectObject
+
+logger = logging.getLogger(__name__)
+
+# Target resolution and JPEG quality per requested output quality
+QUALITY_PROFILES = {
+    "low": {"target_dpi": 72, "jpeg_quality": 40},
+    "medium": {"target_dpi": 150, "jpeg_quality": 60},
+    "high": {"target_dpi": 200, "jpeg_quality": 80},
+}
+
+# Images smaller than this are not worth a round trip to the worker pool
+MIN_IMAGE_BYTES = 8 * 1024
+
+_DO_OPERATOR = re.compile(rb"/([^\s/\[\]<>(){}%]+)\s+Do\b")
+
+
+def _resolve(obj):
+    return obj.get_object() if obj is not None else None
+
+
+def _image_components(image) -> Optional[int]:
+    """Number of colour components for the colour spaces we can re-encode"""
+    color_space = _resolve(image.get("/ColorSpace"))
+    if color_space == "/DeviceGray":
+        return 1
+    if color_space == "/DeviceRGB":
+        return 3
+    if isinstance(color_space, list) and len(color_space) == 2 and color_space[0] == "/ICCBased":
+        components = _resolve(color_space[1]).get("/N")
+        return int(components) if components in (1, 3) else None
+    return None
+
+
+# ASCII armouring that may wrap the real image codec (reportlab emits these)
+ASCII_FILTERS = ("/ASCII85Decode", "/ASCIIHexDecode")
+
+
+def _image_filters(image) -> Tuple[list, Optional[str]]:
+    """Split the filter chain into ASCII pre-filters and the image codec"""
+    filters = _resolve(image.get("/Filter"))
+    if filters is None:
+        return [], None
+    if not isinstance(filters, list):
+        filters = [filters]
+    filters = [str(f) for f in filters]
+    pre_filters = [f for f in filters if f in ASCII_FILTERS]
+    codecs = [f for f in filters if f not in ASCII_FILTERS]
+    if len(codecs) > 1 or filters[:len(pre_filters)] != pre_filters:
+        return pre_filters, "unsupported"
+    return pre_filters, codecs[0] if codecs else None
+
+
+def _plain_decode_parms(image) -> Optional[Dict[str, int]]:
+    """DecodeParms as a plain picklable dict"""
+    parms = _resolve(image.get("/DecodeParms"))
+    if isinstance(parms, list):
+        parms = _resolve(parms[0]) if parms else None
+    if not parms:
+        return None
+    return {str(k): int(v) for k, v in parms.items() if isinstance(_resolve(v), int)}
+
+
+def _stream_fingerprint(image) -> str:
+    digest = hashlib.sha256(image._data)
+    for key in ("/Filter", "/Width", "/Height", "/ColorSpace", "/BitsPerComponent", "/DecodeParms", "/SMask", "/Mask", "/Decode"):
+        digest.update(f"{key}={image.get(key)!r}".encode())
+    return digest.hexdigest()
+
+
+def recompress_image(job: Dict[str, Any]) -> Optional[Tuple[bytes, int, int, int]]:
+    """Decode, downsample and JPEG-encode one image (runs in the worker pool)"""
+    from PIL import Image
+    import numpy as np
+
+    width, height = job["width"], job["height"]
+    target_width, target_height = job["target_width"], job["target_height"]
+
+    data = job["data"]
+    for pre_filter in job["pre_filters"]:
+        if pre_filter == "/ASCII85Decode":
+            from PyPDF2.filters import ASCII85Decode
+            data = ASCII85Decode.decode(data)
+        else:
+            from PyPDF2.filters import ASCIIHexDecode
+            data = ASCIIHexDecode.decode(data)
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+
+    if job["filter"] == "/DCTDecode":
+        image = Image.open(io.BytesIO(data))
+        # Let libjpeg scale down during decode - much cheaper than a full decode
+        image.draft(image.mode, (target_width, target_height))
+    else:
+        if job["filter"] == "/FlateDecode":
+            from PyPDF2.filters import FlateDecode
+            raw = FlateDecode.decode(data, job["decode_parms"])
+        else:
+            raw = data
+        mode = "L" if job["components"] == 1 else "RGB"
+        if len(raw) < width * height * job["components"]:
+            return None
+        image = Image.frombytes(mode, (width, height), raw)
+
+    if image.mode not in ("L", "RGB"):
+        return None
+
+    if image.size != (target_width, target_height):
+        image = image.resize((target_width, target_height), Image.Resampling.LANCZOS)
+
+    # Scans are often grey content stored as RGB - store one channel instead of three
+    if image.mode == "RGB":
+        sample = np.asarray(image)[::4, ::4].astype(np.int16)
+        if sample.size and int((sample.max(axis=2) - sample.min(axis=2)).max()) <= 8:
+            image = image.convert("L")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=job["jpeg_quality"], optimize=True)
+    encoded = buffer.getvalue()
+    if len(encoded) >= len(job["data"]):
+        return None
+    return encoded, image.size[0], image.size[1], 1 if image.mode == "L" else 3
+
+
+def _collect_page_images(page) -> Tuple[Any, Dict[str, Any], bool]:
+    """Return the page's XObject dict, its image entries and whether it has form XObjects"""
+    resources = _resolve(page.get("/Resources"))
+    if not resources or "/XObject" not in resources:
+        return None, {}, False
+    xobjects = _resolve(resources["/XObject"])
+    images = {}
+    has_forms = False
+    for name, ref in xobjects.items():
+        xobject = _resolve(ref)
+        subtype = xobject.get("/Subtype")
+        if subtype == "/Image" and isinstance(ref, IndirectObject):
+            images[name] = ref
+        elif subtype == "/Form":
+            has_forms = True
+    return xobjects, images, has_forms
+
+
+def _used_xobject_names(page) -> Optional[set]:
+    try:
+        contents = page.get_contents()
+        if contents is None:
+            return set()
+        return {"/" + m.decode("latin-1") for m in _DO_OPERATOR.findall(contents.get_data())}
+    except Exception:
+        return None
+
+
+def compress_pdf_file(input_path: str, output_path: str, quality: str = "medium", executor=None) -> Dict[str, Any]:
+    """Write a compressed copy of a PDF and return compression statistics"""
+    profile = QUALITY_PROFILES[quality]
+    reader = PdfReader(input_path)
+
+    canonical_refs: Dict[str, IndirectObject] = {}
+    candidates: Dict[int, Dict[str, Any]] = {}
+    stats = {"images_found": 0, "images_recompressed": 0, "duplicate_images": 0, "unused_images_removed": 0}
+
+    # Pages often share one XObject dict, so a name is unused only if no page sharing it paints it
+    page_images = []
+    used_by_dict: Dict[int, Optional[set]] = {}
+    for page in reader.pages:
+        xobjects, images, has_forms = _collect_page_images(page)
+        if not images:
+            continue
+        page_images.append((page, xobjects, images))
+        used_names = None if has_forms else _used_xobject_names(page)
+        key = id(xobjects)
+        if key not in used_by_dict:
+            used_by_dict[key] = used_names
+        elif used_by_dict[key] is not None:
+            used_by_dict[key] = None if used_names is None else used_by_dict[key] | used_names
+
+    visited = set()
+    for page, xobjects, images in page_images:
+        used_names = used_by_dict[id(xobjects)]
+        page_width_inches = float(page.mediabox.width) / 72 or 1
+
+        for name, ref in images.items():
+            if (id(xobjects), name) in visited:
+                # Already handled through another page sharing this dict
+                if name not in xobjects or xobjects.raw_get(name).idnum != ref.idnum:
+                    continue
+            else:
+                visited.add((id(xobjects), name))
+                if used_names is not None and name not in used_names:
+                    # Drop image resources that no page content paints
+                    del xobjects[name]
+                    stats["unused_images_removed"] += 1
+                    continue
+
+                stats["images_found"] += 1
+                fingerprint = _stream_fingerprint(ref.get_object())
+                canonical = canonical_refs.setdefault(fingerprint, ref)
+                if canonical.idnum != ref.idnum:
+                    # Point every page at one copy of identical image streams
+                    xobjects[NameObject(name)] = canonical
+                    stats["duplicate_images"] += 1
+                    continue
+
+            image = ref.get_object()
+
+            # Estimate resolution assuming the image spans the page width
+            width, height = int(image["/Width"]), int(image["/Height"])
+            effective_dpi = width / page_width_inches
+            candidate = candidates.get(ref.idnum)
+            if candidate is None or effective_dpi < candidate["effective_dpi"]:
+                candidates[ref.idnum] = {"ref": ref, "effective_dpi": effective_dpi}
+
+    jobs = []
+    for candidate in candidates.values():
+        image = candidate["ref"].get_object()
+        pre_filters, image_filter = _image_filters(image)
+        components = _image_components(image)
+        if (image_filter not in ("/DCTDecode", "/FlateDecode", None) or components is None
+                or image.get("/BitsPerComponent") != 8 or "/Decode" in image
+                or len(image._data) < MIN_IMAGE_BYTES):
+            continue
+
+        width, height = int(image["/Width"]), int(image["/Height"])
+        scale = min(1.0, profile["target_dpi"] / candidate["effective_dpi"]) if candidate["effective_dpi"] else 1.0
+        jobs.append((candidate["ref"], {
+            "data": image._data,
+            "pre_filters": pre_filters,
+            "filter": image_filter,
+            "decode_parms": _plain_decode_parms(image),
+            "width": width,
+            "height": height,
+            "components": components,
+            "target_width": max(1, int(width * scale)),
+            "target_height": max(1, int(height * scale)),
+            "jpeg_quality": profile["jpeg_quality"]
+        }))
+
+    if executor is not None and len(jobs) > 1:
+        results = list(executor.map(recompress_image, [job for _, job in jobs]))
+    else:
+        results = [recompress_image(job) for _, job in jobs]
+
+    for (ref, _), result in zip(jobs, results):
+        if result is None:
+            continue
+        encoded, new_width, new_height, components = result
+        image = ref.get_object()
+        image._data = encoded
+        image.decoded_self = None
+        image[NameObject("/Filter")] = NameObject("/DCTDecode")
+        image[NameObject("/Width")] = NumberObject(new_width)
+        image[NameObject("/Height")] = NumberObject(new_height)
+        image[NameObject("/ColorSpace")] = NameObject("/DeviceGray" if components == 1 else "/DeviceRGB")
+        image[NameObject("/BitsPerComponent")] = NumberObject(8)
+        for key in ("/DecodeParms", "/Interpolate"):
+            if key in image:
+                del image[key]
+        stats["images_recompressed"] += 1
+
+    # Only objects reachable from the copied pages are written out
+    writer = PdfWriter()
+    for page in reader.pages:
+        page.compress_content_streams()
+        writer.add_page(page)
+    try:
+        if reader.metadata:
+            writer.add_metadata(reader.metadata)
+    except Exception as e:
+        logger.warning(f"Could not carry PDF metadata over: {e}")
+
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+    original_size = os.path.getsize(input_path)
+    if os.path.getsize(output_path) >= original_size:
+        # Never hand back something larger than what we were given
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            dst.write(src.read())
+        stats["kept_original"] = True
+
+    return stats
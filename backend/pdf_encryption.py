@@ -0,0 +1,257 @@
+"""
+AES-256 PDF encryption (standard security handler V5/R6). Objects are read from
+the source and written straight to the output file under their original numbers,
+so no page tree is copied and references need no rewriting.
+"""
+import io
+import os
+import codecs
+import hashlib
+import logging
+from typing import Dict, Any, Optional
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from PyPDF2 import PdfReader
+from PyPDF2.generic._base import encode_pdfdocencoding
+from PyPDF2.generic import (
+    ArrayObject, BooleanObject, ByteStringObject, DictionaryObject, IndirectObject, NameObject,
+    NumberObject, StreamObject, TextStringObject
+)
+
+logger = logging.getLogger(__name__)
+
+# Permission bits (1-based, ISO 32000-2 table 22) granted per API permission name
+PERMISSION_BITS = {
+    "print": (3, 12),
+    "modify": (4, 6, 9, 11),
+    "copy": (5,),
+    "extract": (5, 10),
+}
+# Bits 7-8 and 13-32 are reserved and must be set
+RESERVED_PERMISSION_BITS = (7, 8) + tuple(range(13, 33))
+
+
+def permission_flags(permissions: Dict[str, bool]) -> int:
+    """Signed 32-bit /P value for a {"print": True, ...} permissions dict"""
+    bits = set(RESERVED_PERMISSION_BITS)
+    for name, allowed in permissions.items():
+        if allowed:
+            bits.update(PERMISSION_BITS.get(name, ()))
+    value = sum(1 << (bit - 1) for bit in bits)
+    return value - (1 << 32) if value >= 1 << 31 else value
+
+
+def _aes_cbc(key: bytes, iv: bytes, data: bytes) -> bytes:
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+
+def _aes_ecb(key: bytes, data: bytes) -> bytes:
+    encryptor = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+
+def _password_bytes(password: str) -> bytes:
+    return password.encode("utf-8")[:127]
+
+
+def _hash_r6(password: bytes, salt: bytes, user_key: bytes = b"") -> bytes:
+    """Hardened password hash of ISO 32000-2 algorithm 2.B"""
+    k = hashlib.sha256(password + salt + user_key).digest()
+    round_number = 0
+    while True:
+        k1 = (password + k + user_key) * 64
+        e = _aes_cbc(k[:16], k[16:32], k1)
+        k = (hashlib.sha256, hashlib.sha384, hashlib.sha512)[sum(e[:16]) % 3](e).digest()
+        round_number += 1
+        if round_number >= 64 and e[-1] <= round_number - 32:
+            return k[:32]
+
+
+def build_encrypt_dict(file_key: bytes, user_password: str, owner_password: str, p_value: int) -> DictionaryObject:
+    """Standard security handler dictionary for AES-256 (R6)"""
+    user_pw, owner_pw = _password_bytes(user_password), _password_bytes(owner_password)
+
+    user_validation_salt, user_key_salt = os.urandom(8), os.urandom(8)
+    u_value = _hash_r6(user_pw, user_validation_salt) + user_validation_salt + user_key_salt
+    ue_value = _aes_cbc(_hash_r6(user_pw, user_key_salt), b"\x00" * 16, file_key)
+
+    owner_validation_salt, owner_key_salt = os.urandom(8), os.urandom(8)
+    o_value = _hash_r6(owner_pw, owner_validation_salt, u_value) + owner_validation_salt + owner_key_salt
+    oe_value = _aes_cbc(_hash_r6(owner_pw, owner_key_salt, u_value), b"\x00" * 16, file_key)
+
+    perms = (p_value & 0xFFFFFFFF).to_bytes(4, "little") + b"\xff\xff\xff\xff" + b"Tadb" + os.urandom(4)
+
+    crypt_filter = DictionaryObject({
+        NameObject("/AuthEvent"): NameObject("/DocOpen"),
+        NameObject("/CFM"): NameObject("/AESV3"),
+        NameObject("/Length"): NumberObject(32),
+    })
+    return DictionaryObject({
+        NameObject("/Filter"): NameObject("/Standard"),
+        NameObject("/V"): NumberObject(5),
+        NameObject("/R"): NumberObject(6),
+        NameObject("/Length"): NumberObject(256),
+        NameObject("/CF"): DictionaryObject({NameObject("/StdCF"): crypt_filter}),
+        NameObject("/StmF"): NameObject("/StdCF"),
+        NameObject("/StrF"): NameObject("/StdCF"),
+        NameObject("/O"): ByteStringObject(o_value),
+        NameObject("/U"): ByteStringObject(u_value),
+        NameObject("/OE"): ByteStringObject(oe_value),
+        NameObject("/UE"): ByteStringObject(ue_value),
+        NameObject("/Perms"): ByteStringObject(_aes_ecb(file_key, perms)),
+        NameObject("/P"): NumberObject(p_value),
+        NameObject("/EncryptMetadata"): BooleanObject(True),
+    })
+
+
+def _string_bytes(value) -> bytes:
+    """Encoded bytes of a PDF string, matching how PyPDF2 would serialize it"""
+    if not isinstance(value, TextStringObject):
+        return bytes(value)
+    try:
+        return value.get_original_bytes()
+    except Exception:
+        try:
+            return encode_pdfdocencoding(value)
+        except UnicodeEncodeError:
+            return codecs.BOM_UTF16_BE + value.encode("utf-16be")
+
+
+class _ObjectEncryptor:
+    """Encrypts strings and stream data with the file key (AESV3 uses no per-object key)"""
+
+    def __init__(self, file_key: bytes):
+        self.file_key = file_key
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        padder = padding.PKCS7(128).padder()
+        iv = os.urandom(16)
+        return iv + _aes_cbc(self.file_key, iv, padder.update(data) + padder.finalize())
+
+    def encrypt_object(self, obj):
+        """Return an encrypted copy of a direct object; the source object is left alone"""
+        if isinstance(obj, (TextStringObject, ByteStringObject)):
+            return ByteStringObject(self.encrypt_bytes(_string_bytes(obj)))
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({key: self.encrypt_object(value) for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([self.encrypt_object(value) for value in obj])
+        return obj
+
+
+def _source_objects(reader: PdfReader):
+    """(object number, generation) of every object the source's cross-reference declares"""
+    numbers = {}
+    for generation, entries in reader.xref.items():
+        for idnum in entries:
+            numbers[idnum] = generation
+    for idnum in reader.xref_objStm:
+        numbers.setdefault(idnum, 0)
+    numbers.pop(0, None)
+    return sorted(numbers.items())
+
+
+def encrypt_pdf_file(input_path: str, output_path: str, user_password: str,
+                     owner_password: Optional[str] = None,
+                     permissions: Optional[Dict[str, bool]] = None) -> Dict[str, Any]:
+    """Write an AES-256 encrypted copy of a PDF and return its size and object count"""
+    reader = PdfReader(input_path)
+    if reader.is_encrypted:
+        raise ValueError("PDF is already encrypted")
+
+    file_key = os.urandom(32)
+    encryptor = _ObjectEncryptor(file_key)
+    p_value = permission_flags(permissions or {})
+    root_ref = reader.trailer.raw_get("/Root")
+
+    offsets: Dict[int, tuple] = {}
+    digest = hashlib.sha256()
+
+    with open(output_path, "wb") as out:
+        def write(data: bytes):
+            out.write(data)
+            digest.update(data)
+
+        # AES-256 is a PDF 2.0 feature (Adobe extension level 8 for 1.7 readers)
+        write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+        for idnum, generation in _source_objects(reader):
+            try:
+                obj = reader.get_object(IndirectObject(idnum, generation, reader))
+            except Exception as e:
+                logger.warning(f"Skipping unreadable object {idnum}: {e}")
+                continue
+            if obj is None:
+                continue
+            if isinstance(obj, StreamObject) and obj.get("/Type") in ("/XRef", "/ObjStm"):
+                # Cross-reference and object streams are replaced by the new plain xref table
+                continue
+
+            if isinstance(obj, StreamObject):
+                encrypted = encryptor.encrypt_object(DictionaryObject(obj))
+                data = encryptor.encrypt_bytes(obj._data)
+                encrypted[NameObject("/Length")] = NumberObject(len(data))
+            else:
+                encrypted = encryptor.encrypt_object(obj)
+                data = None
+
+            if idnum == root_ref.idnum and isinstance(encrypted, DictionaryObject):
+                encrypted[NameObject("/Extensions")] = DictionaryObject({
+                    NameObject("/ADBE"): DictionaryObject({
+                        NameObject("/BaseVersion"): NameObject("/1.7"),
+                        NameObject("/ExtensionLevel"): NumberObject(8),
+                    })
+                })
+
+            offsets[idnum] = (out.tell(), generation)
+            buffer = io.BytesIO()
+            buffer.write(f"{idnum} {generation} obj\n".encode())
+            encrypted.write_to_stream(buffer, None)
+            if data is not None:
+                buffer.write(b"\nstream\n")
+                buffer.write(data)
+                buffer.write(b"\nendstream")
+            buffer.write(b"\nendobj\n")
+            write(buffer.getvalue())
+
+        encrypt_number = max(offsets, default=0) + 1
+        offsets[encrypt_number] = (out.tell(), 0)
+        buffer = io.BytesIO()
+        buffer.write(f"{encrypt_number} 0 obj\n".encode())
+        build_encrypt_dict(file_key, user_password, owner_password or user_password, p_value).write_to_stream(buffer, None)
+        buffer.write(b"\nendobj\n")
+        write(buffer.getvalue())
+
+        size = encrypt_number + 1
+        xref_offset = out.tell()
+        free_numbers = [n for n in range(1, size) if n not in offsets]
+        next_free = dict(zip([0] + free_numbers, free_numbers + [0]))
+        lines = [f"xref\n0 {size}\n"]
+        for number in range(size):
+            if number in offsets:
+                offset, generation = offsets[number]
+                lines.append(f"{offset:010d} {generation:05d} n \n")
+            else:
+                lines.append(f"{next_free[number]:010d} {65535 if number == 0 else 1:05d} f \n")
+        write("".join(lines).encode())
+
+        # Keep the document's permanent identifier, issue a new changing one
+        source_id = reader.trailer.get("/ID")
+        first_id = _string_bytes(source_id[0]) if source_id else os.urandom(16)
+        trailer = DictionaryObject({
+            NameObject("/Size"): NumberObject(size),
+            NameObject("/Root"): root_ref,
+            NameObject("/Encrypt"): IndirectObject(encrypt_number, 0, reader),
+            NameObject("/ID"): ArrayObject([ByteStringObject(first_id), ByteStringObject(os.urandom(16))]),
+        })
+        if "/Info" in reader.trailer:
+            trailer[NameObject("/Info")] = reader.trailer.raw_get("/Info")
+        buffer = io.BytesIO()
+        buffer.write(b"trailer\n")
+        trailer.write_to_stream(buffer, None)
+        buffer.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        write(buffer.getvalue())
+
+    return {"objects": len(offsets), "file_size": os.path.getsize(output_path), "sha256": digest.hexdigest()}
+
@@ -0,0 +1,200 @@
+"""
+Structural PDF index - page count, page boxes, rotation, text/form presence,
+encryption state and metadata, computed once and stored with the file record
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from PyPDF2 import PdfReader
+from pdf_cache import pdf_reader_cache
+
+logger = logging.getLogger(__name__)
+
+# Bump when the index layout changes so stale records get rebuilt
+PDF_INDEX_VERSION = 1
+
+METADATA_KEYS = {
+    "title": "/Title",
+    "author": "/Author",
+    "subject": "/Subject",
+    "creator": "/Creator",
+    "producer": "/Producer",
+    "creation_date": "/CreationDate",
+    "modification_date": "/ModDate",
+}
+
+
+def _box_to_list(box) -> list:
+    return [float(v) for v in box]
+
+
+def _page_has_text_layer(page) -> bool:
+    """A page carries a text layer when its resources declare fonts"""
+    try:
+        resources = page.get("/Resources")
+        if resources is None:
+            return False
+        resources = resources.get_object()
+        fonts = resources.get("/Font")
+        return bool(fonts.get_object()) if fonts is not None else False
+    except Exception:
+        return False
+
+
+def _source_stamp(file_path: str) -> Dict[str, Any]:
+    stat = os.stat(file_path)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def build_pdf_index(file_path: str, reader: Optional[PdfReader] = None) -> Dict[str, Any]:
+    """Parse a PDF once and return its compact structural index"""
+    if reader is None:
+        # Indexing warms the shared reader cache for the requests that follow
+        with pdf_reader_cache.reader(file_path) as cached_reader:
+            return build_pdf_index(file_path, cached_reader)
+
+    stamp = _source_stamp(file_path)
+    index = {
+        "version": PDF_INDEX_VERSION,
+        "is_encrypted": reader.is_encrypted,
+        "page_count": None,
+        "pages": [],
+        "has_text_layer": False,
+        "has_forms": False,
+        "metadata": {key: "N/A" for key in METADATA_KEYS},
+        "indexed_at": datetime.utcnow().isoformat(),
+        **stamp
+    }
+
+    if reader.is_encrypted:
+        # Owner-only protected files open with an empty user password
+        try:
+            if not reader.decrypt(""):
+                return index
+        except Exception:
+            return index
+
+    metadata = reader.metadata
+    if metadata:
+        index["metadata"] = {
+            key: str(metadata.get(pdf_key, "N/A")) for key, pdf_key in METADATA_KEYS.items()
+        }
+
+    pages = []
+    for i, page in enumerate(reader.pages):
+        media_box = page.mediabox
+        pages.append({
+            "page_number": i + 1,
+            "width": float(media_box.width),
+            "height": float(media_box.height),
+            "mediabox": _box_to_list(media_box),
+            "cropbox": _box_to_list(page.cropbox),
+            "rotation": int(page.get("/Rotate", 0)),
+            "has_text": _page_has_text_layer(page)
+        })
+
+    root = reader.trailer["/Root"].get_object()
+    acro_form = root.get("/AcroForm")
+    if acro_form is not None:
+        fields = acro_form.get_object().get("/Fields")
+        index["has_forms"] = bool(fields.get_object()) if fields is not None else False
+
+    index["page_count"] = len(pages)
+    index["pages"] = pages
+    index["has_text_layer"] = any(p["has_text"] for p in pages)
+    return index
+
+
+def is_index_current(index: Optional[Dict[str, Any]], file_path: str) -> bool:
+    """Check a stored index still describes the file on disk"""
+    if not index or index.get("version") != PDF_INDEX_VERSION:
+        return False
+    try:
+        stamp = _source_stamp(file_path)
+    except OSError:
+        return False
+    return (index.get("source_size") == stamp["source_size"]
+            and index.get("source_mtime") == stamp["source_mtime"])
+
+
+async def get_pdf_index(file_info: Dict[str, Any], save: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+    """Return the stored index for a PDF record, rebuilding it in the executor if missing or stale
+
+    A rebuilt index is stored on the record and persisted with save, so it survives a restart.
+    """
+    index = file_info.get("pdf_index")
+    if is_index_current(index, file_info["file_path"]):
+        return index
+
+    loop = asyncio.get_running_loop()
+    index = await loop.run_in_executor(None, build_pdf_index, file_info["file_path"])
+    file_info["pdf_index"] = index
+    if save is not None:
+        save()
+    return index
+
+
+def validate_page_numbers(index: Dict[str, Any], page_numbers) -> Optional[str]:
+    """Return an error message for 1-based page numbers outside the document, else None"""
+    total_pages = index.get("page_count")
+    if total_pages is None:
+        return None
+    for page_num in page_numbers:
+        if not isinstance(page_num, int) or page_num < 1 or page_num > total_pages:
+            return f"Invalid page number: {page_num}. PDF has {total_pages} pages."
+    return None
+
+
+def parse_page_ranges(spec, total_pages: int) -> List[int]:
+    """Expand a page selection such as "1-5, 8, 40-" or [1, 2, "10-12"] into sorted 1-based page numbers"""
+    if isinstance(spec, (str, int)):
+        parts = str(spec).split(",")
+    else:
+        parts = [str(part) for part in spec]
+
+    pages = set()
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if "-" in part:
+                start, end = (p.strip() for p in part.split("-", 1))
+                first = int(start) if start else 1
+                last = int(end) if end else total_pages
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part}")
+        if first < 1 or last > total_pages or first > last:
+            raise ValueError(f"Invalid page range: {part}. PDF has {total_pages} pages.")
+        pages.update(range(first, last + 1))
+
+    if not pages:
+        raise ValueError("No pages selected")
+    return sorted(pages)
+
+
+def page_runs(page_numbers: List[int]) -> List[Tuple[int, int]]:
+    """Group sorted page numbers into contiguous (first, last) runs"""
+    runs = []
+    for page_num in page_numbers:
+        if runs and runs[-1][1] == page_num - 1:
+            runs[-1] = (runs[-1][0], page_num)
+        else:
+            runs.append((page_num, page_num))
+    return runs
+
+
+async def select_pages(file_info: Dict[str, Any], spec, save: Optional[Callable[[], Any]] = None) -> Optional[List[int]]:
+    """Resolve an optional page selection for a PDF record; None means every page"""
+    if spec is None or spec == "" or spec == []:
+        return None
+    if file_info["file_type"].lower() != "pdf":
+        raise ValueError("Page selection is only supported for PDF files")
+    index = await get_pdf_index(file_info, save)
+    if index["page_count"] is None:
+        raise ValueError("Page selection is not available for encrypted PDFs")
+    return parse_page_ranges(spec, index["page_count"])
@@ -0,0 +1,100 @@
+"""
+In-memory registry for long-running PDF batch jobs with per-file results and progress
+"""
+import os
+import uuid
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs beyond this count are forgotten, oldest first
+MAX_TRACKED_JOBS = int(os.environ.get("PDF_MAX_TRACKED_JOBS", "500"))
+
+pdf_jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def create_job(job_type: str, total: int) -> Dict[str, Any]:
+    """Register a new job and return its record"""
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "job_type": job_type,
+        "status": "queued",
+        "total": total,
+        "completed": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "progress": 0.0,
+        "results": [],
+        "created_at": datetime.utcnow().isoformat(),
+        "finished_at": None
+    }
+    with _jobs_lock:
+        pdf_jobs[job["job_id"]] = job
+        _prune_finished_jobs()
+    return job
+
+
+def _prune_finished_jobs():
+    excess = len(pdf_jobs) - MAX_TRACKED_JOBS
+    for job_id in [jid for jid, job in pdf_jobs.items() if job["finished_at"]][:max(0, excess)]:
+        del pdf_jobs[job_id]
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    return pdf_jobs.get(job_id)
+
+
+def start_job(job: Dict[str, Any]):
+    job["status"] = "processing"
+
+
+def record_result(job: Dict[str, Any], result: Dict[str, Any]):
+    """Add one file's outcome and update the job's counters"""
+    with _jobs_lock:
+        job["results"].append(result)
+        job["completed"] += 1
+        if result.get("status") == "success":
+            job["succeeded"] += 1
+        else:
+            job["failed"] += 1
+        job["progress"] = round(job["completed"] / job["total"] * 100, 1) if job["total"] else 100.0
+
+
+def finish_job(job: Dict[str, Any], error: Optional[str] = None):
+    """Mark a job done; it fails only when nothing succeeded or it aborted"""
+    if error:
+        job["status"] = "failed"
+        job["error"] = error
+    else:
+        job["status"] = "failed" if job["total"] and not job["succeeded"] else "completed"
+    job["finished_at"] = datetime.utcnow().isoformat()
+
+
+async def run_job_tasks(job: Dict[str, Any], tasks: List[Dict[str, Any]],
+                        run_task: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                        on_finished: Optional[Callable[[], None]] = None):
+    """Run a job's per-file tasks concurrently, recording each result as it completes"""
+    start_job(job)
+
+    async def run_one(task):
+        try:
+            record_result(job, await run_task(task))
+        except Exception as e:
+            logger.error(f"{job['job_type']} job {job['job_id']} failed for {task['file_id']}: {str(e)}")
+            record_result(job, {"file_id": task["file_id"], "status": "error", "error": str(e)})
+
+    try:
+        await asyncio.gather(*(run_one(task) for task in tasks))
+        if on_finished:
+            on_finished()
+        finish_job(job)
+        logger.info(f"{job['job_type']} job {job['job_id']}: {job['succeeded']}/{job['total']} files succeeded")
+    except Exception as e:
+        logger.error(f"{job['job_type']} job {job['job_id']} error: {str(e)}")
+        finish_job(job, error=str(e))
@@ -0,0 +1,66 @@
+"""
+Optional linearization ("fast web view") of PDF outputs so viewers can show
+page 1 from the first byte ranges. Uses the qpdf binary when it is installed.
+"""
+import os
+import shutil
+import logging
+import subprocess
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Server-wide default, overridable per request with "linearize": true/false
+PDF_LINEARIZE_OUTPUTS = os.environ.get("PDF_LINEARIZE_OUTPUTS", "false").lower() in ("1", "true", "yes")
+QPDF_BINARY = os.environ.get("QPDF_BINARY", "qpdf")
+LINEARIZE_TIMEOUT_SECONDS = int(os.environ.get("PDF_LINEARIZE_TIMEOUT", "120"))
+
+# qpdf exits with 3 when it succeeded but repaired something along the way
+QPDF_OK_EXIT_CODES = (0, 3)
+
+
+def linearization_available() -> bool:
+    return shutil.which(QPDF_BINARY) is not None
+
+
+def should_linearize(requested: Optional[bool]) -> bool:
+    """Per-request flag when given, otherwise the server default"""
+    return PDF_LINEARIZE_OUTPUTS if requested is None else bool(requested)
+
+
+def is_linearized(file_path: str) -> bool:
+    """The linearization dictionary must be the first object in the file"""
+    with open(file_path, 'rb') as f:
+        return b"/Linearized" in f.read(1024)
+
+
+def linearize_pdf(file_path: str) -> bool:
+    """Rewrite a PDF in place as linearized; returns False and leaves it untouched on failure"""
+    if not linearization_available():
+        logger.warning("Linearization requested but qpdf is not installed")
+        return False
+
+    tmp_path = f"{file_path}.linearized.tmp"
+    try:
+        result = subprocess.run(
+            [QPDF_BINARY, "--linearize", "--object-streams=preserve", file_path, tmp_path],
+            capture_output=True, timeout=LINEARIZE_TIMEOUT_SECONDS
+        )
+        if result.returncode not in QPDF_OK_EXIT_CODES or not os.path.exists(tmp_path):
+            logger.warning(f"qpdf could not linearize {os.path.basename(file_path)}: {result.stderr.decode(errors='replace').strip()}")
+            return False
+        os.replace(tmp_path, file_path)
+        return True
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Linearization failed: {e}")
+        return False
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def finalize_pdf_output(file_path: str, requested: Optional[bool] = None) -> bool:
+    """Apply the linearization stage to a freshly written PDF; returns whether it is linearized"""
+    if should_linearize(requested):
+        return linearize_pdf(file_path)
+    return False
@@ -0,0 +1,46 @@
+"""
+Shared process pool for CPU-heavy PDF work (image recompression, batch jobs)
+"""
+import os
+import asyncio
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKER_PROCESSES = int(os.environ.get("PDF_WORKER_PROCESSES", str(os.cpu_count() or 2)))
+
+_pdf_worker_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pdf_worker_pool() -> ProcessPoolExecutor:
+    """Return the shared PDF worker pool, starting it on first use"""
+    global _pdf_worker_pool
+    with _pool_lock:
+        if _pdf_worker_pool is None:
+            # Spawn rather than fork - the server process runs threads and an event loop
+            _pdf_worker_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.info(f"Started PDF worker pool with {PDF_WORKER_PROCESSES} processes")
+        return _pdf_worker_pool
+
+
+async def run_in_pdf_worker(func, *args, **kwargs):
+    """Run a picklable function in the PDF worker pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pdf_worker_pool(), partial(func, *args, **kwargs))
+
+
+def shutdown_pdf_worker_pool():
+    """Stop the worker pool on application shutdown"""
+    global _pdf_worker_pool
+    with _pool_lock:
+        if _pdf_worker_pool is not None:
+            _pdf_worker_pool.shutdown(wait=False, cancel_futures=True)
+            _pdf_worker_pool = None
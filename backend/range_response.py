@@ -0,0 +1,78 @@
+"""
+HTTP byte-range (206 Partial Content) file responses for downloads, so viewers
+can fetch the first pages of a linearized PDF without the whole file
+"""
+import os
+import re
+from typing import Optional, Tuple
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+RANGE_CHUNK_SIZE = 64 * 1024
+_BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def file_etag(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive (start, end) for a single byte range; None when unsatisfiable"""
+    match = _BYTE_RANGE.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            return None
+        return max(0, file_size - length), file_size - 1
+    start = int(start)
+    end = file_size - 1 if end == "" else min(int(end), file_size - 1)
+    if start >= file_size or end < start:
+        return None
+    return start, end
+
+
+def _iter_file_range(file_path: str, start: int, end: int):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(file_path: str, filename: str, media_type: str,
+                         range_header: Optional[str] = None, if_range: Optional[str] = None) -> Response:
+    """Full response, or 206 for a single satisfiable byte range"""
+    etag = file_etag(file_path)
+    headers = {"Accept-Ranges": "bytes", "ETag": etag}
+
+    # Multiple ranges and stale If-Range validators get the whole file, which RFC 7233 allows
+    if not range_header or "," in range_header or (if_range and if_range != etag):
+        return FileResponse(path=file_path, filename=filename, media_type=media_type, headers=headers)
+
+    file_size = os.path.getsize(file_path)
+    byte_range = parse_range(range_header, file_size)
+    if byte_range is None:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{file_size}"})
+
+    start, end = byte_range
+    # Reuse FileResponse's Content-Disposition encoding for the filename
+    disposition = FileResponse(path=file_path, filename=filename).headers["content-disposition"]
+    return StreamingResponse(
+        _iter_file_range(file_path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            **headers,
+            "Content-Range": f"bytes {start}-{end}/{file_size}",
+            "Content-Length": str(end - start + 1),
+            "Content-Disposition": disposition
+        }
+    )
@@ -0,0 +1,268 @@
+"""
+Redline documents for line-mode comparisons - DOCX with tracked changes, HTML and
+PDF with highlighted insertions and deletions. Paragraphs are generated from the
+diff opcodes and written out one at a time, so no full document model is built.
+reportlab keeps a canvas's pages until it is saved, so PDFs are rendered in windows of
+REDLINE_PDF_CHUNK_PAGES pages, each saved to its own file, and the windows merged at the end.
+"""
+import os
+import re
+import zipfile
+from datetime import datetime
+from html import escape as html_escape
+from typing import Dict, Any, Iterator, List, Tuple
+from xml.sax.saxutils import escape as xml_escape
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+REDLINE_FORMATS = {
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "html": "text/html",
+    "pdf": "application/pdf",
+}
+
+Run = Tuple[str, str]  # (op, text) with op in equal / insert / delete
+_XML_INVALID = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def redline_paragraphs(comparison: Dict[str, Any]) -> Iterator[List[Run]]:
+    """Runs of each redline paragraph, in modified-document order"""
+    original_lines, modified_lines = comparison["original_lines"], comparison["modified_lines"]
+    changes = iter(comparison["changes"])
+
+    for tag, i1, i2, j1, j2 in comparison["opcodes"]:
+        if tag == "equal":
+            for line in modified_lines[j1:j2]:
+                yield [("equal", line)]
+            continue
+
+        change = next(changes)
+        segments = change.get("segments")
+        if tag == "replace" and segments:
+            # Word-level segments span lines; newlines inside them start new paragraphs
+            paragraph: List[Run] = []
+            for segment in segments:
+                pieces = segment["text"].split("\n")
+                for index, piece in enumerate(pieces):
+                    if index:
+                        yield paragraph
+                        paragraph = []
+                    if piece:
+                        paragraph.append((segment["op"], piece))
+            yield paragraph
+            continue
+
+        for line in original_lines[i1:i2]:
+            yield [("delete", line)]
+        for line in modified_lines[j1:j2]:
+            yield [("insert", line)]
+
+
+def _xml_text(text: str) -> str:
+    return xml_escape(_XML_INVALID.sub("", text))
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+_PACKAGE_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+
+def write_docx_redline(paragraphs: Iterator[List[Run]], output_path: str, author: str = "Comparison") -> int:
+    """DOCX whose insertions and deletions are Word tracked changes; returns the paragraph count"""
+    revision = f'w:author="{xml_escape(author, {chr(34): "&quot;"})}" w:date="{datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}"'
+    change_id = 0
+    count = 0
+
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        package.writestr("_rels/.rels", _PACKAGE_RELS)
+        # The main part is streamed into the archive paragraph by paragraph
+        with package.open("word/document.xml", "w", force_zip64=True) as part:
+            part.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            )
+            for runs in paragraphs:
+                xml = ["<w:p>"]
+                ops = {op for op, _ in runs}
+                if len(ops) == 1 and ops != {"equal"}:
+                    # A wholly inserted/deleted paragraph also tracks its paragraph mark
+                    change_id += 1
+                    mark = "ins" if ops == {"insert"} else "del"
+                    xml.append(f'<w:pPr><w:rPr><w:{mark} w:id="{change_id}" {revision}/></w:rPr></w:pPr>')
+                for op, text in runs:
+                    text = _xml_text(text)
+                    if op == "equal":
+                        xml.append(f'<w:r><w:t xml:space="preserve">{text}</w:t></w:r>')
+                    elif op == "insert":
+                        change_id += 1
+                        xml.append(f'<w:ins w:id="{change_id}" {revision}><w:r>'
+                                   f'<w:t xml:space="preserve">{text}</w:t></w:r></w:ins>')
+                    else:
+                        change_id += 1
+                        xml.append(f'<w:del w:id="{change_id}" {revision}><w:r>'
+                                   f'<w:delText xml:space="preserve">{text}</w:delText></w:r></w:del>')
+                xml.append("</w:p>")
+                part.write("".join(xml).encode("utf-8"))
+                count += 1
+            part.write(b"</w:body></w:document>")
+    return count
+
+
+_HTML_HEAD = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: Georgia, serif; max-width: 52em; margin: 2em auto; line-height: 1.5; }}
+p {{ margin: 0 0 .4em; white-space: pre-wrap; }}
+ins {{ color: #1a5fb4; background: #e8f0fe; text-decoration: underline; }}
+del {{ color: #c01c28; background: #fdecea; text-decoration: line-through; }}
+</style></head><body>
+<h1>{title}</h1>
+"""
+
+
+def write_html_redline(paragraphs: Iterator[List[Run]], output_path: str, title: str) -> int:
+    """HTML with <ins>/<del> markup; returns the paragraph count"""
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as out:
+        out.write(_HTML_HEAD.format(title=html_escape(title)))
+        for runs in paragraphs:
+            html = []
+            for op, text in runs:
+                text = html_escape(text)
+                html.append(text if op == "equal" else f"<{op[:3]}>{text}</{op[:3]}>")
+            out.write(f"<p>{''.join(html) or '&nbsp;'}</p>\n")
+            count += 1
+        out.write("</body></html>\n")
+    return count
+
+
+# Pages rendered per reportlab canvas before it is saved and a new one started
+REDLINE_PDF_CHUNK_PAGES = int(os.environ.get("REDLINE_PDF_CHUNK_PAGES", "50"))
+PDF_FONT = "Helvetica"
+PDF_FONT_SIZE = 10
+PDF_LEADING = 13
+PDF_MARGIN = 54
+_RUN_COLORS = {"equal": colors.black, "insert": colors.HexColor("#1a5fb4"), "delete": colors.HexColor("#c01c28")}
+_WORD_PIECES = re.compile(r"\S+\s*|\s+")
+
+
+def _layout_lines(runs: List[Run], max_width: float) -> Iterator[List[Tuple[str, str, float]]]:
+    """Wrap a paragraph into lines of (op, text, width) fragments, merging same-op words"""
+    line: List[Tuple[str, str, float]] = []
+    x = 0.0
+    for op, text in runs:
+        for piece in _WORD_PIECES.findall(text):
+            piece_width = stringWidth(piece, PDF_FONT, PDF_FONT_SIZE)
+            if x + piece_width > max_width and x > 0:
+                yield line
+                line, x = [], 0.0
+                piece = piece.lstrip()
+                piece_width = stringWidth(piece, PDF_FONT, PDF_FONT_SIZE)
+            if line and line[-1][0] == op:
+                line[-1] = (op, line[-1][1] + piece, line[-1][2] + piece_width)
+            else:
+                line.append((op, piece, piece_width))
+            x += piece_width
+    yield line
+
+
+def _merge_pdf_chunks(chunk_paths: List[str], output_path: str, title: str):
+    from PyPDF2 import PdfMerger
+
+    merger = PdfMerger()
+    try:
+        for path in chunk_paths:
+            merger.append(path)
+        merger.add_metadata({"/Title": title})
+        merger.write(output_path)
+    finally:
+        merger.close()
+
+
+def write_pdf_redline(paragraphs: Iterator[List[Run]], output_path: str, title: str) -> int:
+    """PDF with coloured, underlined insertions and struck-through deletions; returns the page count"""
+    width, height = letter
+    chunk_paths: List[str] = []
+
+    def start_chunk() -> canvas.Canvas:
+        chunk_paths.append(f"{output_path}.part{len(chunk_paths)}")
+        chunk = canvas.Canvas(chunk_paths[-1], pagesize=letter, pageCompression=1)
+        chunk.setTitle(title)
+        chunk.setFont(PDF_FONT, PDF_FONT_SIZE)
+        return chunk
+
+    try:
+        pdf = start_chunk()
+        pages = chunk_pages = 1
+        y = height - PDF_MARGIN
+
+        pdf.setFont(f"{PDF_FONT}-Bold", 12)
+        pdf.drawString(PDF_MARGIN, y, title[:100])
+        y -= PDF_LEADING * 2
+        pdf.setFont(PDF_FONT, PDF_FONT_SIZE)
+
+        for runs in paragraphs:
+            for line in _layout_lines(runs, width - 2 * PDF_MARGIN):
+                if y < PDF_MARGIN:
+                    if chunk_pages >= REDLINE_PDF_CHUNK_PAGES:
+                        # reportlab holds every page of a canvas until save(), so bound it per window
+                        pdf.save()
+                        pdf = start_chunk()
+                        chunk_pages = 0
+                    else:
+                        pdf.showPage()
+                        pdf.setFont(PDF_FONT, PDF_FONT_SIZE)
+                    pages += 1
+                    chunk_pages += 1
+                    y = height - PDF_MARGIN
+                x = PDF_MARGIN
+                for op, text, text_width in line:
+                    color = _RUN_COLORS[op]
+                    pdf.setFillColor(color)
+                    pdf.drawString(x, y, text)
+                    if op != "equal":
+                        pdf.setStrokeColor(color)
+                        offset = PDF_FONT_SIZE * 0.3 if op == "delete" else -1.5
+                        pdf.line(x, y + offset, x + text_width, y + offset)
+                    x += text_width
+                y -= PDF_LEADING
+
+        pdf.save()
+        if len(chunk_paths) == 1:
+            os.replace(chunk_paths[0], output_path)
+        else:
+            _merge_pdf_chunks(chunk_paths, output_path, title)
+    finally:
+        for path in chunk_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return pages
+
+
+def write_redline(comparison: Dict[str, Any], output_path: str, fmt: str, title: str, author: str = "Comparison") -> int:
+    """Render a stored line-mode comparison as a redline in the given format"""
+    paragraphs = redline_paragraphs(comparison)
+    if fmt == "docx":
+        return write_docx_redline(paragraphs, output_path, author)
+    if fmt == "html":
+        return write_html_redline(paragraphs, output_path, title)
+    if fmt == "pdf":
+        return write_pdf_redline(paragraphs, output_path, title)
+    raise ValueError(f"format must be one of {', '.join(REDLINE_FORMATS)}")
@@ -10,20 +10,21 @@ import json
 import logging
 import aiofiles
 from datetime import datetime
+from pdf_signing import file_sha256
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Annotations"])
 
 # Storage - will be injected
-annotation_storage = {}
+annotation_store = None
 file_storage = {}
 CONVERSIONS_DIR = ""
 
-def init_annotation_routes(ann_storage, f_storage, conv_dir, save_func):
+def init_annotation_routes(ann_store, f_storage, conv_dir, save_func):
     """Initialize routes with shared dependencies"""
-    global annotation_storage, file_storage, CONVERSIONS_DIR, save_storage
-    annotation_storage = ann_storage
+    global annotation_store, file_storage, CONVERSIONS_DIR, save_storage
+    annotation_store = ann_store
     file_storage = f_storage
     CONVERSIONS_DIR = conv_dir
     save_storage = save_func
@@ -84,9 +85,6 @@ async def add_annotation(request: dict):
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="File not found")
         
-        if file_id not in annotation_storage:
-            annotation_storage[file_id] = []
-        
         annotation_id = str(uuid.uuid4())
         annotation_data = {
             "annotation_id": annotation_id,
@@ -101,7 +99,7 @@ async def add_annotation(request: dict):
             "author": annotation.get("author", "Anonymous")
         }
         
-        annotation_storage[file_id].append(annotation_data)
+        annotation_store.add(annotation_data)
         
         logger.info(f"Annotation added to file {file_id}: {annotation_data['type']}")
         
@@ -127,9 +125,6 @@ async def add_visual_annotation(annotation: VisualAnnotation):
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="File not found")
         
-        if file_id not in annotation_storage:
-            annotation_storage[file_id] = []
-        
         annotation_id = str(uuid.uuid4())
         
         # Convert to dict and add metadata
@@ -149,7 +144,7 @@ async def add_visual_annotation(annotation: VisualAnnotation):
             "is_visual": True  # Flag for enhanced annotations
         }
         
-        annotation_storage[file_id].append(annotation_data)
+        annotation_store.add(annotation_data)
         
         logger.info(f"Visual annotation added: {annotation.type} on page {annotation.position.page}")
         
@@ -171,7 +166,7 @@ async def add_visual_annotation(annotation: VisualAnnotation):
 async def get_annotations(file_id: str):
     """Get all annotations for a document"""
     try:
-        annotations = annotation_storage.get(file_id, [])
+        annotations = annotation_store.for_file(file_id)
         
         return {
             "file_id": file_id,
@@ -185,16 +180,13 @@ async def get_annotations(file_id: str):
 
 
 @router.get("/annotations/{file_id}/page/{page_num}")
-async def get_page_annotations(file_id: str, page_num: int):
-    """Get annotations for a specific page"""
+async def get_page_annotations(file_id: str, page_num: int, zoom: Optional[float] = None):
+    """Get annotations for a specific page, drawing paths simplified for zoom if given"""
     try:
-        all_annotations = annotation_storage.get(file_id, [])
+        if zoom is not None and zoom <= 0:
+            raise HTTPException(status_code=400, detail="zoom must be positive")
         
-        # Filter by page
-        page_annotations = [
-            ann for ann in all_annotations 
-            if ann.get("position", {}).get("page", ann.get("page", 1)) == page_num
-        ]
+        page_annotations = annotation_store.for_page(file_id, page_num, zoom)
         
         return {
             "file_id": file_id,
@@ -203,35 +195,75 @@ async def get_page_annotations(file_id: str, page_num: int):
             "total": len(page_annotations)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get page annotations error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get page annotations: {str(e)}")
 
 
+@router.get("/annotations/{file_id}/page/{page_num}/viewport")
+async def get_viewport_annotations(file_id: str, page_num: int, x: float, y: float, width: float, height: float,
+                                   zoom: Optional[float] = None):
+    """Get the annotations on a page that intersect a viewport, in page coordinates"""
+    try:
+        if width < 0 or height < 0:
+            raise HTTPException(status_code=400, detail="width and height must not be negative")
+        if zoom is not None and zoom <= 0:
+            raise HTTPException(status_code=400, detail="zoom must be positive")
+        
+        annotations = annotation_store.in_viewport(file_id, page_num, (x, y, x + width, y + height), zoom)
+        
+        return {
+            "file_id": file_id,
+            "page": page_num,
+            "viewport": {"x": x, "y": y, "width": width, "height": height},
+            "zoom": zoom,
+            "annotations": annotations,
+            "total": len(annotations)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get viewport annotations error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get viewport annotations: {str(e)}")
+
+
+@router.get("/annotations/{annotation_id}/replies")
+async def get_annotation_replies(annotation_id: str, nested: bool = False):
+    """Get the replies to a comment (the whole thread below it when nested)"""
+    try:
+        replies = annotation_store.thread(annotation_id) if nested else annotation_store.replies(annotation_id)
+        if not replies and annotation_store.get(annotation_id) is None:
+            raise HTTPException(status_code=404, detail="Annotation not found")
+        
+        return {
+            "annotation_id": annotation_id,
+            "replies": replies,
+            "total": len(replies)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get annotation replies error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to get annotation replies: {str(e)}")
+
+
 @router.put("/annotations/{annotation_id}")
 async def update_annotation(annotation_id: str, update_data: dict):
     """Update an existing annotation"""
     try:
-        for file_id, annotations in annotation_storage.items():
-            for i, ann in enumerate(annotations):
-                if ann["annotation_id"] == annotation_id:
-                    # Update allowed fields
-                    if "text" in update_data:
-                        ann["text"] = update_data["text"]
-                    if "color" in update_data:
-                        ann["color"] = update_data["color"]
-                    if "position" in update_data:
-                        ann["position"] = update_data["position"]
-                    if "opacity" in update_data:
-                        ann["opacity"] = update_data["opacity"]
-                    
-                    ann["updated_at"] = datetime.utcnow().isoformat()
-                    annotation_storage[file_id][i] = ann
-                    
-                    logger.info(f"Annotation {annotation_id} updated")
-                    return {"annotation_id": annotation_id, "status": "updated"}
-        
-        raise HTTPException(status_code=404, detail="Annotation not found")
+        # Update allowed fields
+        fields = {key: update_data[key] for key in ("text", "color", "position", "opacity") if key in update_data}
+        fields["updated_at"] = datetime.utcnow().isoformat()
+        
+        if annotation_store.update(annotation_id, fields) is None:
+            raise HTTPException(status_code=404, detail="Annotation not found")
+        
+        logger.info(f"Annotation {annotation_id} updated")
+        return {"annotation_id": annotation_id, "status": "updated"}
         
     except HTTPException:
         raise
@@ -244,14 +276,12 @@ async def update_annotation(annotation_id: str, update_data: dict):
 async def delete_annotation(annotation_id: str):
     """Delete a specific annotation"""
     try:
-        for file_id, annotations in annotation_storage.items():
-            for i, annotation in enumerate(annotations):
-                if annotation["annotation_id"] == annotation_id:
-                    del annotation_storage[file_id][i]
-                    logger.info(f"Annotation {annotation_id} deleted from file {file_id}")
-                    return {"annotation_id": annotation_id, "status": "deleted"}
+        annotation = annotation_store.delete(annotation_id)
+        if annotation is None:
+            raise HTTPException(status_code=404, detail="Annotation not found")
         
-        raise HTTPException(status_code=404, detail="Annotation not found")
+        logger.info(f"Annotation {annotation_id} deleted from file {annotation['file_id']}")
+        return {"annotation_id": annotation_id, "status": "deleted"}
         
     except HTTPException:
         raise
@@ -270,7 +300,7 @@ async def export_annotations(request: dict):
         if not file_id:
             raise HTTPException(status_code=400, detail="file_id is required")
         
-        annotations = annotation_storage.get(file_id, [])
+        annotations = annotation_store.for_file(file_id)
         
         if not annotations:
             raise HTTPException(status_code=404, detail="No annotations found for this file")
@@ -317,6 +347,7 @@ async def export_annotations(request: dict):
             "file_path": export_path,
             "file_type": export_format,
             "file_size": os.path.getsize(export_path),
+            "sha256": file_sha256(export_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -349,17 +380,13 @@ async def import_annotations(request: dict):
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="Target file not found")
         
-        if file_id not in annotation_storage:
-            annotation_storage[file_id] = []
-        
-        imported_count = 0
+        imported_at = datetime.utcnow().isoformat()
         for ann in annotations_data:
-            annotation_id = str(uuid.uuid4())
-            ann["annotation_id"] = annotation_id
+            ann["annotation_id"] = str(uuid.uuid4())
             ann["file_id"] = file_id
-            ann["imported_at"] = datetime.utcnow().isoformat()
-            annotation_storage[file_id].append(ann)
-            imported_count += 1
+            ann["imported_at"] = imported_at
+        annotation_store.add_many(annotations_data)
+        imported_count = len(annotations_data)
         
         logger.info(f"Imported {imported_count} annotations to file {file_id}")
         
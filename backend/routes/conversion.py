@@ -9,6 +9,7 @@ import uuid
 import logging
 import aiofiles
 from datetime import datetime
+from pdf_signing import file_sha256
 
 logger = logging.getLogger(__name__)
 
@@ -100,6 +101,7 @@ async def convert_file(request: ConversionRequest):
             "file_path": output_path,
             "file_type": target_format,
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -2,8 +2,9 @@
 OCR (Optical Character Recognition) routes for scanned documents
 """
 from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Union
 import os
 import uuid
 import logging
@@ -12,8 +13,13 @@ from datetime import datetime
 from PIL import Image
 import pytesseract
 from pdf2image import convert_from_path
+from pdf_linearizer import finalize_pdf_output
+from pdf_index import select_pages, page_runs, get_pdf_index
+from pdf_signing import file_sha256
 import io
 import tempfile
+import json
+import asyncio
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +42,7 @@ class OCRRequest(BaseModel):
     language: str = "eng"  # Tesseract language code
     enhance_image: bool = True
     output_format: str = "txt"  # txt, docx, pdf
+    pages: Optional[Union[str, List[Union[int, str]]]] = None  # PDF only, e.g. "40-55"
 
 
 class OCRResult(BaseModel):
@@ -92,11 +99,25 @@ def perform_ocr_on_image(image: Image.Image, language: str = "eng", enhance: boo
     }
 
 
-def perform_ocr_on_pdf(pdf_path: str, language: str = "eng", enhance: bool = True) -> Dict[str, Any]:
-    """Perform OCR on a PDF file"""
+def render_pdf_pages(pdf_path: str, pages: Optional[List[int]] = None, dpi: int = 300) -> List[tuple]:
+    """Rasterize the selected 1-based pages (all by default) as (page_number, image) pairs"""
+    if not pages:
+        return list(enumerate(convert_from_path(pdf_path, dpi=dpi), start=1))
+    
+    # One poppler call per contiguous run; pages outside the selection are never rasterized
+    rendered = []
+    for first, last in page_runs(pages):
+        images = convert_from_path(pdf_path, dpi=dpi, first_page=first, last_page=last)
+        rendered.extend(zip(range(first, last + 1), images))
+    return rendered
+
+
+def perform_ocr_on_pdf(pdf_path: str, language: str = "eng", enhance: bool = True,
+                       pages: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Perform OCR on a PDF file, optionally only on the given pages"""
     # Convert PDF to images
     try:
-        images = convert_from_path(pdf_path, dpi=300)
+        images = render_pdf_pages(pdf_path, pages)
     except Exception as e:
         logger.error(f"Failed to convert PDF to images: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to convert PDF: {str(e)}")
@@ -105,9 +126,9 @@ def perform_ocr_on_pdf(pdf_path: str, language: str = "eng", enhance: bool = Tru
     total_words = 0
     total_confidence = 0
     
-    for i, image in enumerate(images):
+    for page_number, image in images:
         result = perform_ocr_on_image(image, language, enhance)
-        all_text.append(f"--- Page {i + 1} ---\n{result['text']}")
+        all_text.append(f"--- Page {page_number} ---\n{result['text']}")
         total_words += result['word_count']
         total_confidence += result['confidence']
     
@@ -141,6 +162,11 @@ async def extract_text_ocr(request: OCRRequest):
                 detail=f"Unsupported file type for OCR. Supported: {', '.join(supported_types)}"
             )
         
+        try:
+            pages = await select_pages(file_info, request.pages, save_storage)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         ocr_id = str(uuid.uuid4())
         
         # Update job status
@@ -155,7 +181,8 @@ async def extract_text_ocr(request: OCRRequest):
             result = perform_ocr_on_pdf(
                 file_info["file_path"], 
                 request.language, 
-                request.enhance_image
+                request.enhance_image,
+                pages
             )
         else:
             # Image file
@@ -182,6 +209,7 @@ async def extract_text_ocr(request: OCRRequest):
             "file_path": output_path,
             "file_type": "txt",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow(),
             "ocr_source": file_id
         }
@@ -202,6 +230,7 @@ async def extract_text_ocr(request: OCRRequest):
             "status": "completed",
             "text": result['text'][:5000] if len(result['text']) > 5000 else result['text'],  # Truncate for response
             "text_truncated": len(result['text']) > 5000,
+            "text_url": f"/api/ocr/result/{ocr_id}?offset=5000" if len(result['text']) > 5000 else None,
             "full_text_length": len(result['text']),
             "pages": result['pages'],
             "word_count": result['word_count'],
@@ -220,6 +249,97 @@ async def extract_text_ocr(request: OCRRequest):
         raise HTTPException(status_code=500, detail=f"OCR failed: {str(e)}")
 
 
+@router.get("/ocr/extract/{file_id}/stream")
+async def stream_ocr_text(file_id: str, page_start: int = 1, limit: Optional[int] = None,
+                          language: str = "eng", enhance_image: bool = True):
+    """Stream OCR results as NDJSON, one line per page as soon as it is recognised"""
+    if file_id not in file_storage:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    file_info = file_storage[file_id]
+    file_type = file_info["file_type"].lower()
+    supported_types = ['pdf', 'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'gif']
+    if file_type not in supported_types:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported file type for OCR. Supported: {', '.join(supported_types)}"
+        )
+    
+    if file_type == 'pdf':
+        pdf_index = await get_pdf_index(file_info, save_storage)
+        if pdf_index["page_count"] is None:
+            raise HTTPException(status_code=400, detail="Encrypted PDFs cannot be processed")
+        total_pages = pdf_index["page_count"]
+    else:
+        total_pages = 1
+    
+    if page_start < 1 or page_start > total_pages:
+        raise HTTPException(status_code=400, detail=f"Invalid page_start: {page_start}. Document has {total_pages} pages.")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    end = total_pages if limit is None else min(total_pages, page_start + limit - 1)
+    next_page_start = end + 1 if end < total_pages else None
+    file_path = file_info["file_path"]
+    
+    def recognise_page(page_number: int) -> Dict[str, Any]:
+        if file_type == 'pdf':
+            # Rasterize just this page so the first result does not wait for the whole document
+            image = render_pdf_pages(file_path, [page_number])[0][1]
+        else:
+            image = Image.open(file_path)
+        return perform_ocr_on_image(image, language, enhance_image)
+    
+    async def generate():
+        loop = asyncio.get_running_loop()
+        for page_number in range(page_start, end + 1):
+            try:
+                result = await loop.run_in_executor(None, recognise_page, page_number)
+            except Exception as e:
+                logger.error(f"Streamed OCR failed on page {page_number}: {str(e)}")
+                yield json.dumps({"type": "error", "page_number": page_number, "error": str(e)}) + "\n"
+                return
+            yield json.dumps({
+                "type": "page",
+                "page_number": page_number,
+                "text": result['text'],
+                "word_count": result['word_count'],
+                "confidence": round(result['confidence'], 2)
+            }, ensure_ascii=False) + "\n"
+        yield json.dumps({
+            "type": "summary",
+            "pages_returned": end - page_start + 1,
+            "total_pages": total_pages,
+            "next_page_start": next_page_start
+        }) + "\n"
+    
+    headers = {"X-Total-Pages": str(total_pages)}
+    if next_page_start is not None:
+        headers["X-Next-Page-Start"] = str(next_page_start)
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=headers)
+
+
+@router.get("/ocr/result/{ocr_id}")
+async def get_ocr_text(ocr_id: str, offset: int = 0, limit: int = 5000):
+    """Page through the full text of a completed OCR result"""
+    if ocr_id not in file_storage or "ocr_source" not in file_storage[ocr_id]:
+        raise HTTPException(status_code=404, detail="OCR result not found")
+    if offset < 0 or not 1 <= limit <= 100000:
+        raise HTTPException(status_code=400, detail="offset must be >= 0 and limit between 1 and 100000")
+    
+    async with aiofiles.open(file_storage[ocr_id]["file_path"], 'r', encoding='utf-8') as f:
+        text = await f.read()
+    
+    chunk = text[offset:offset + limit]
+    next_offset = offset + len(chunk)
+    return {
+        "ocr_id": ocr_id,
+        "offset": offset,
+        "text": chunk,
+        "full_text_length": len(text),
+        "next_offset": next_offset if next_offset < len(text) else None
+    }
+
+
 @router.get("/ocr/status/{ocr_id}")
 async def get_ocr_status(ocr_id: str):
     """Get the status of an OCR job"""
@@ -272,6 +392,7 @@ async def batch_ocr(request: dict):
         file_ids = request.get("file_ids", [])
         language = request.get("language", "eng")
         enhance = request.get("enhance_image", True)
+        page_spec = request.get("pages")
         
         if not file_ids:
             raise HTTPException(status_code=400, detail="No file_ids provided")
@@ -282,7 +403,8 @@ async def batch_ocr(request: dict):
                 ocr_request = OCRRequest(
                     file_id=fid,
                     language=language,
-                    enhance_image=enhance
+                    enhance_image=enhance,
+                    pages=page_spec if file_storage.get(fid, {}).get("file_type", "").lower() == "pdf" else None
                 )
                 result = await extract_text_ocr(ocr_request)
                 results.append({
@@ -331,6 +453,11 @@ async def create_searchable_pdf(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
+        try:
+            pages = await select_pages(file_info, request.get("pages"), save_storage)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         # Generate searchable PDF using Tesseract's PDF output
         searchable_id = str(uuid.uuid4())
         base_name = file_info["original_name"].rsplit('.', 1)[0]
@@ -338,7 +465,7 @@ async def create_searchable_pdf(request: dict):
         output_path = os.path.join(CONVERSIONS_DIR, f"{searchable_id}_{output_filename}")
         
         # Convert PDF pages to images and run OCR to create searchable PDF
-        images = convert_from_path(file_info["file_path"], dpi=300)
+        images = [image for _, image in render_pdf_pages(file_info["file_path"], pages)]
         
         # Create a temporary directory for processing
         with tempfile.TemporaryDirectory() as temp_dir:
@@ -366,6 +493,8 @@ async def create_searchable_pdf(request: dict):
             
             merger.write(output_path)
             merger.close()
+        loop = asyncio.get_running_loop()
+        linearized = await loop.run_in_executor(None, finalize_pdf_output, output_path, request.get("linearize"))
         
         # Store file info
         file_storage[searchable_id] = {
@@ -374,6 +503,7 @@ async def create_searchable_pdf(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow(),
             "searchable": True,
             "source_file": file_id
@@ -387,6 +517,7 @@ async def create_searchable_pdf(request: dict):
             "original_file": file_info["original_name"],
             "output_file": output_filename,
             "pages": len(images),
+            "linearized": linearized,
             "download_url": f"/api/download/{searchable_id}",
             "status": "completed"
         }
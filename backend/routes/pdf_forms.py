@@ -11,6 +11,10 @@ import aiofiles
 from datetime import datetime
 from PyPDF2 import PdfReader, PdfWriter
 from PyPDF2.generic import NameObject, TextStringObject, BooleanObject
+from pdf_index import get_pdf_index
+from pdf_cache import pdf_reader_cache
+from incremental_writer import fill_form_incremental, IncrementalUpdateUnsupported
+from pdf_signing import file_sha256
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +46,7 @@ class FormField(BaseModel):
 class FormFillRequest(BaseModel):
     file_id: str
     fields: Dict[str, Any]  # {field_name: value}
+    incremental: bool = True  # Append changes instead of rewriting the document
 
 
 @router.get("/pdf/form-fields/{file_id}")
@@ -55,10 +60,13 @@ async def get_form_fields(file_id: str):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        reader = PdfReader(file_info["file_path"])
-        
-        # Try to get fields directly - safer approach
-        fields = reader.get_fields()
+        # The structural index already knows whether there is an AcroForm
+        if (await get_pdf_index(file_info, save_storage))["has_forms"]:
+            with pdf_reader_cache.reader(file_info["file_path"]) as reader:
+                # Try to get fields directly - safer approach
+                fields = reader.get_fields()
+        else:
+            fields = None
         
         if not fields:
             return {
@@ -146,22 +154,38 @@ async def fill_pdf_form(request: FormFillRequest):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        reader = PdfReader(file_info["file_path"])
-        writer = PdfWriter()
-        
-        # Copy all pages
-        for page in reader.pages:
-            writer.add_page(page)
-        
-        # Get the form fields
-        fields = reader.get_fields()
+        with pdf_reader_cache.reader(file_info["file_path"]) as reader:
+            fields = reader.get_fields()
         if not fields:
             raise HTTPException(status_code=400, detail="This PDF does not contain fillable form fields")
         
-        # Fill the fields
-        filled_count = 0
-        for field_name, value in field_values.items():
-            if field_name in fields:
+        # Generate output file
+        fill_id = str(uuid.uuid4())
+        base_name = file_info["original_name"].rsplit('.', 1)[0]
+        filled_filename = f"{base_name}_filled.pdf"
+        output_path = os.path.join(PDF_OPERATIONS_DIR, f"{fill_id}_{filled_filename}")
+        
+        known_values = {name: value for name, value in field_values.items() if name in fields}
+        incremental = request.incremental
+        output_sha = None
+        if incremental:
+            try:
+                filled_count, output_sha = fill_form_incremental(file_info["file_path"], output_path, known_values)
+            except IncrementalUpdateUnsupported as e:
+                logger.info(f"Falling back to full rewrite for form fill: {e}")
+                incremental = False
+        
+        if not incremental:
+            reader = PdfReader(file_info["file_path"])
+            writer = PdfWriter()
+            
+            # Copy all pages
+            for page in reader.pages:
+                writer.add_page(page)
+            
+            # Fill the fields
+            filled_count = 0
+            for field_name, value in known_values.items():
                 try:
                     writer.update_page_form_field_values(
                         writer.pages[0],  # Apply to first page (fields span across pages)
@@ -170,15 +194,9 @@ async def fill_pdf_form(request: FormFillRequest):
                     filled_count += 1
                 except Exception as field_error:
                     logger.warning(f"Could not fill field {field_name}: {field_error}")
-        
-        # Generate output file
-        fill_id = str(uuid.uuid4())
-        base_name = file_info["original_name"].rsplit('.', 1)[0]
-        filled_filename = f"{base_name}_filled.pdf"
-        output_path = os.path.join(PDF_OPERATIONS_DIR, f"{fill_id}_{filled_filename}")
-        
-        with open(output_path, 'wb') as f:
-            writer.write(f)
+            
+            with open(output_path, 'wb') as f:
+                writer.write(f)
         
         # Store filled file info
         file_storage[fill_id] = {
@@ -187,9 +205,11 @@ async def fill_pdf_form(request: FormFillRequest):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": output_sha or file_sha256(output_path),
             "upload_time": datetime.utcnow(),
             "form_filled": True,
-            "fields_filled": filled_count
+            "fields_filled": filled_count,
+            "incremental_update": incremental
         }
         save_storage()
         
@@ -200,6 +220,7 @@ async def fill_pdf_form(request: FormFillRequest):
             "original_file": file_info["original_name"],
             "filled_file": filled_filename,
             "fields_filled": filled_count,
+            "incremental_update": incremental,
             "download_url": f"/api/download/{fill_id}",
             "status": "completed"
         }
@@ -250,6 +271,7 @@ async def flatten_pdf_form(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow(),
             "form_flattened": True
         }
@@ -319,6 +341,7 @@ async def create_form_field(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -6,6 +6,8 @@ from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import logging
 from datetime import datetime, timedelta
+from similarity_index import similarity_index
+from annotation_store import annotation_store
 
 logger = logging.getLogger(__name__)
 
@@ -323,6 +325,8 @@ async def delete_user_file(file_id: str, user_id: int):
         
         # Remove from storage
         del file_storage[file_id]
+        similarity_index.remove(file_id)
+        annotation_store.remove_file(file_id)
         
         logger.info(f"File {file_id} deleted by user {user_id}")
         
@@ -1,17 +1,32 @@
 """
 Document Version History routes - Track changes, view history, and revert versions
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+from urllib.parse import quote
 import os
+import zlib
 import uuid
-import json
+import asyncio
 import logging
 import aiofiles
 import shutil
+import weakref
 from datetime import datetime
-import hashlib
+from collections import OrderedDict
+from pdf_cache import pdf_reader_cache
+from pdf_signing import file_sha256
+from similarity_index import similarity_index
+from version_store import (
+    store_version, iter_version, restore_version, release_version, version_available, shared_storage, stored_bytes,
+    clone_file, prune_blobs, orphaned_deltas, rebase_deltas, rewrite_file_keyframes, STORAGE_FIELDS, VERSION_BLOB_CACHE
+)
+from version_retention import RetentionPolicy, IOThrottle, VERSION_RETENTION_INTERVAL
+from version_log import version_logs
+from document_diff import GRANULARITIES, COMPARE_MODES, unified_diff, remember_comparison, page_changes, parse_page_limit
+from document_compare import BaselineIndex, compare_candidate
+from clause_diff import clause_summary
 
 logger = logging.getLogger(__name__)
 
@@ -20,53 +35,239 @@ router = APIRouter(tags=["Version History"])
 # Storage - will be injected
 file_storage = {}
 CONVERSIONS_DIR = ""
-VERSION_STORAGE_FILE = ""
 
-# Version history storage
-version_history = {}
+# Diffs between version contents, keyed by both content hashes and the diff options
+VERSION_DIFF_CACHE_SIZE = int(os.environ.get("VERSION_DIFF_CACHE_SIZE", "64"))
+_version_diffs: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
 
+# Per document, serializes blob compaction/pruning with reverts that clone blobs; a document's
+# lock lives while anything holds or waits on it, so work on one file never queues behind another
+_blob_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
 
-def init_version_routes(f_storage, conv_dir, save_func):
+
+def _blob_lock(file_id: str) -> asyncio.Lock:
+    lock = _blob_locks.get(file_id)
+    if lock is None:
+        lock = _blob_locks[file_id] = asyncio.Lock()
+    return lock
+
+
+def init_version_routes(f_storage, conv_dir, save_func, extract_text_func, index_similarity_func):
     """Initialize routes with shared dependencies"""
-    global file_storage, CONVERSIONS_DIR, save_storage, VERSION_STORAGE_FILE
+    global file_storage, CONVERSIONS_DIR, save_storage, extract_text, index_similarity
     file_storage = f_storage
     CONVERSIONS_DIR = conv_dir
     save_storage = save_func
-    VERSION_STORAGE_FILE = os.path.join(os.path.dirname(conv_dir), "version_history.json")
-    load_version_history()
+    extract_text = extract_text_func
+    index_similarity = index_similarity_func
+    # Histories are read from their per-document logs on first use
+    storage_dir = os.path.dirname(conv_dir)
+    version_logs.init(os.path.join(storage_dir, "version_logs"), os.path.join(storage_dir, "version_history.json"))
 
 
-def load_version_history():
-    """Load version history from file"""
-    global version_history
-    try:
-        if os.path.exists(VERSION_STORAGE_FILE):
-            with open(VERSION_STORAGE_FILE, 'r') as f:
-                version_history = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading version history: {e}")
-        version_history = {}
+def current_file_hash(file_info: Dict[str, Any]) -> str:
+    """SHA-256 recorded when the file was written; hashed once for records that predate it"""
+    if not file_info.get("sha256"):
+        file_info["sha256"] = file_sha256(file_info["file_path"])
+    return file_info["sha256"]
 
 
-def save_version_history():
-    """Save version history to file"""
-    try:
-        with open(VERSION_STORAGE_FILE, 'w') as f:
-            json.dump(version_history, f, indent=2, default=str)
-    except Exception as e:
-        logger.error(f"Error saving version history: {e}")
+def _versions_dir(file_id: str) -> str:
+    return os.path.join(CONVERSIONS_DIR, "versions", file_id)
+
+
+def _blob_path(file_id: str, file_hash: str) -> str:
+    return os.path.join(_versions_dir(file_id), "blobs", file_hash)
+
 
+def _text_path(file_id: str, file_hash: str) -> str:
+    return os.path.join(_versions_dir(file_id), "texts", f"{file_hash}.txt.z")
 
-def calculate_file_hash(file_path: str) -> str:
-    """Calculate MD5 hash of a file for change detection"""
-    hash_md5 = hashlib.md5()
+
+# File types extract_text returns only a placeholder for, so their versions are compared by hash
+TEXTLESS_FILE_TYPES = ("docx",)
+
+
+def _file_type(file_id: str, original_name: str) -> str:
+    if file_id in file_storage:
+        return file_storage[file_id]["file_type"]
+    return os.path.splitext(original_name)[1].lstrip(".") or "txt"
+
+
+def cache_version_text(file_id: str, file_hash: str, source_path: str, file_type: str) -> Optional[str]:
+    """Extract a snapshot's text and keep it compressed next to the version storage"""
+    text = extract_text({"file_path": source_path, "file_type": file_type})
+    if text.startswith("Error extracting text"):
+        return None
+    path = _text_path(file_id, file_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(zlib.compress(text.encode("utf-8"), 6))
+    os.replace(temp_path, path)
+    return text
+
+
+def load_version_text(file_id: str, record: Dict[str, Any], file_type: str) -> str:
+    """Cached text of a version, extracted (and cached) first for versions that lack it"""
+    path = _text_path(file_id, record["file_hash"])
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return zlib.decompress(f.read()).decode("utf-8")
+    
+    blob = _blob_path(file_id, record["file_hash"])
+    if os.path.exists(blob):
+        text = cache_version_text(file_id, record["file_hash"], blob, file_type)
+    else:
+        rebuilt_path = os.path.join(_versions_dir(file_id), f"text-{uuid.uuid4()}.{file_type}")
+        try:
+            restore_version(record, rebuilt_path)
+            text = cache_version_text(file_id, record["file_hash"], rebuilt_path, file_type)
+        finally:
+            if os.path.exists(rebuilt_path):
+                os.remove(rebuilt_path)
+    if text is None:
+        raise ValueError(f"Could not extract text from version {record['version_number']}")
+    return text
+
+
+def _remove_unused_texts(file_id: str, history) -> int:
+    """Delete extracted texts of contents no remaining version has; returns bytes freed"""
+    texts_dir = os.path.join(_versions_dir(file_id), "texts")
+    if not os.path.isdir(texts_dir):
+        return 0
+    hashes = {v["file_hash"] for v in history.versions}
+    freed = 0
+    for entry in os.scandir(texts_dir):
+        if entry.name.endswith(".txt.z") and entry.name[:-len(".txt.z")] not in hashes:
+            freed += entry.stat().st_size
+            os.remove(entry.path)
+    return freed
+
+
+async def cache_text_in_background(file_id: str, file_hash: str, blob_path: str, file_type: str):
+    """Extract a new snapshot's text while its blob is still in place"""
+    if os.path.exists(_text_path(file_id, file_hash)):
+        return
     try:
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-    except Exception:
-        return ""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, cache_version_text, file_id, file_hash, blob_path, file_type)
+    except Exception as e:
+        logger.warning(f"Version text extraction failed for {file_id}: {e}")
+
+
+async def compact_versions(file_id: str):
+    """Move snapshots still held as blobs into keyframe/delta storage, oldest first"""
+    async with _blob_lock(file_id):
+        history = version_logs.get(file_id)
+        if not history:
+            return
+        loop = asyncio.get_running_loop()
+        compacted: Dict[str, Dict[str, Any]] = {}
+        try:
+            for record in list(history.versions):
+                if record.get("storage") != "blob":
+                    continue
+                blob = record["file_path"]
+                if blob in compacted:
+                    # Revert records sharing a blob share its compacted storage too
+                    storage = {**compacted[blob], "stored_size": 0}
+                else:
+                    versions = history.versions
+                    earlier = versions[:next(i for i, v in enumerate(versions) if v is record)]
+                    # Named by version_id: version numbers are reused once a version is deleted or expired
+                    version_path = os.path.join(_versions_dir(file_id), f"{record['version_id']}_{history.original_name}")
+                    storage = await loop.run_in_executor(None, store_version, blob, earlier, version_path)
+                    compacted[blob] = storage
+                    if history.get(record["version_id"]) is None:
+                        # Deleted while compacting
+                        release_version(storage, history.versions)
+                        continue
+                unset = () if "file_path" in storage else ("file_path",)
+                version_logs.update_version(history, record["version_id"], storage, unset=unset)
+            
+            # Keep blobs of the latest versions and the live file; the rest are rebuilt on demand
+            keep = {v["file_hash"] for v in history.versions[-VERSION_BLOB_CACHE:]} if VERSION_BLOB_CACHE else set()
+            if file_id in file_storage and file_storage[file_id].get("sha256"):
+                keep.add(file_storage[file_id]["sha256"])
+            keep.update(os.path.basename(v["file_path"]) for v in history.versions if v.get("storage") == "blob")
+            await loop.run_in_executor(None, prune_blobs, os.path.join(_versions_dir(file_id), "blobs"), keep)
+        except Exception as e:
+            logger.error(f"Version compaction error for {file_id}: {str(e)}")
+
+
+async def enforce_retention(file_id: str, policy: RetentionPolicy,
+                            throttle: Optional[IOThrottle] = None) -> Dict[str, Any]:
+    """Expire versions the policy no longer keeps, then rewrite the keyframes left without their version"""
+    summary = {"file_id": file_id, "expired_versions": 0, "rewritten_versions": 0, "freed_bytes": 0,
+               "written_bytes": 0, "remaining_versions": 0}
+    processed = 0
+    async with _blob_lock(file_id):
+        history = version_logs.get(file_id)
+        if history is None:
+            return summary
+        loop = asyncio.get_running_loop()
+        
+        # A live document keeps its current version; snapshots awaiting compaction are left alone
+        live = file_id in file_storage
+        keep = {v["version_id"] for v in history.versions if v.get("storage") == "blob"}
+        if live and history.versions:
+            keep.add(history.versions[-1]["version_id"])
+        retained = policy.retained(history.versions, keep=keep)
+        expired = [v for v in history.versions if v["version_id"] not in retained]
+        for record in expired:
+            version_logs.delete_version(history, record["version_id"])
+        for record in expired:
+            summary["freed_bytes"] += release_version(record, history.versions)
+        summary["expired_versions"] = len(expired)
+        
+        if not history.versions and not live:
+            version_logs.remove(file_id)
+            await loop.run_in_executor(None, lambda: shutil.rmtree(_versions_dir(file_id), ignore_errors=True))
+            return summary
+        
+        # Full-copy keyframes move into the chunk store; deltas whose keyframe version expired are rebased
+        updates, processed = await loop.run_in_executor(None, rewrite_file_keyframes, history.versions)
+        for deltas in orphaned_deltas(history.versions).values():
+            rebased, rebase_bytes = await loop.run_in_executor(None, rebase_deltas, deltas, _versions_dir(file_id))
+            processed += rebase_bytes
+            updates.update(zip((v["version_id"] for v in deltas), rebased))
+        replaced = []
+        for version_id, fields in updates.items():
+            record = history.get(version_id)
+            replaced.append(dict(record))
+            unset = [key for key in STORAGE_FIELDS if key in record and key not in fields]
+            version_logs.update_version(history, version_id, fields, unset=unset)
+        for record in replaced:
+            summary["freed_bytes"] += release_version(record, history.versions)
+        summary["rewritten_versions"] = len(updates)
+        summary["written_bytes"] = sum(fields["stored_size"] for fields in updates.values())
+        summary["freed_bytes"] += _remove_unused_texts(file_id, history)
+        summary["remaining_versions"] = len(history.versions)
+    
+    # Paced outside the lock so reverts and snapshot compaction are not held up
+    if throttle is not None:
+        await throttle.pace(processed)
+    return summary
+
+
+async def run_version_retention():
+    """Background compactor applying the retention policy to every version history"""
+    policy = RetentionPolicy()
+    throttle = IOThrottle()
+    while True:
+        await asyncio.sleep(VERSION_RETENTION_INTERVAL)
+        expired = rewritten = freed = 0
+        for file_id in version_logs.file_ids():
+            try:
+                summary = await enforce_retention(file_id, policy, throttle)
+                expired += summary["expired_versions"]
+                rewritten += summary["rewritten_versions"]
+                freed += summary["freed_bytes"]
+            except Exception as e:
+                logger.error(f"Version retention error for {file_id}: {str(e)}")
+        if expired or rewritten:
+            logger.info(f"Version retention expired {expired} versions, rewrote {rewritten}, freed {freed} bytes")
 
 
 class VersionInfo(BaseModel):
@@ -95,7 +296,7 @@ class RevertVersionRequest(BaseModel):
 
 
 @router.post("/versions/create")
-async def create_version(request: CreateVersionRequest):
+async def create_version(request: CreateVersionRequest, background_tasks: BackgroundTasks):
     """Create a new version snapshot of a document"""
     try:
         file_id = request.file_id
@@ -106,19 +307,13 @@ async def create_version(request: CreateVersionRequest):
         file_info = file_storage[file_id]
         
         # Initialize version history for this file if not exists
-        if file_id not in version_history:
-            version_history[file_id] = {
-                "file_id": file_id,
-                "original_name": file_info["original_name"],
-                "versions": [],
-                "current_version": 0
-            }
+        history = version_logs.get(file_id) or version_logs.create(file_id, file_info["original_name"])
         
-        # Calculate file hash
-        file_hash = calculate_file_hash(file_info["file_path"])
+        # The content digest is kept on the file record by every write path
+        file_hash = current_file_hash(file_info)
         
         # Check if file has actually changed
-        versions = version_history[file_id]["versions"]
+        versions = history.versions
         if versions:
             last_version = versions[-1]
             if last_version["file_hash"] == file_hash:
@@ -129,41 +324,44 @@ async def create_version(request: CreateVersionRequest):
                 }
         
         # Create version snapshot
-        version_number = len(versions) + 1
         version_id = str(uuid.uuid4())
         
-        # Copy file to versions directory
-        versions_dir = os.path.join(CONVERSIONS_DIR, "versions", file_id)
-        os.makedirs(versions_dir, exist_ok=True)
-        
-        version_filename = f"v{version_number}_{file_info['original_name']}"
-        version_path = os.path.join(versions_dir, version_filename)
-        
-        shutil.copy2(file_info["file_path"], version_path)
+        # Snapshot as a copy-on-write clone of the live file; compaction into a
+        # keyframe/delta happens in the background
+        blob_path = _blob_path(file_id, file_hash)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        
+        loop = asyncio.get_running_loop()
+        clone_method = "existing"
+        if not os.path.exists(blob_path):
+            clone_method = await loop.run_in_executor(None, clone_file, file_info["file_path"], blob_path)
+        storage = {
+            "storage": "blob",
+            "file_path": blob_path,
+            "stored_size": os.path.getsize(blob_path) if clone_method == "copy" else 0
+        }
         
-        # Create version record
+        # Numbered once the snapshot exists, so concurrent creates cannot take the same number
+        version_number = history.next_version_number
         version_record = {
             "version_id": version_id,
             "version_number": version_number,
-            "file_path": version_path,
-            "file_size": os.path.getsize(version_path),
+            "file_size": file_info["file_size"],
             "file_hash": file_hash,
             "created_at": datetime.utcnow().isoformat(),
             "created_by": request.created_by,
             "change_description": request.change_description,
-            "is_current": True
+            "is_current": True,
+            **storage
         }
         
-        # Mark previous versions as not current
-        for v in versions:
-            v["is_current"] = False
-        
-        versions.append(version_record)
-        version_history[file_id]["current_version"] = version_number
-        
-        save_version_history()
+        # Appending marks the previous version as not current
+        version_logs.add_version(history, version_record)
+        # Background tasks run in order, so the text is taken from the blob before compaction can prune it
+        background_tasks.add_task(cache_text_in_background, file_id, file_hash, blob_path, file_info["file_type"])
+        background_tasks.add_task(compact_versions, file_id)
         
-        logger.info(f"Version {version_number} created for file {file_id}")
+        logger.info(f"Version {version_number} created for file {file_id} ({clone_method} snapshot)")
         
         return {
             "version_id": version_id,
@@ -171,6 +369,9 @@ async def create_version(request: CreateVersionRequest):
             "version_number": version_number,
             "created_at": version_record["created_at"],
             "change_description": request.change_description,
+            "storage": storage["storage"],
+            "stored_size": storage["stored_size"],
+            "snapshot_method": clone_method,
             "status": "created"
         }
         
@@ -181,6 +382,29 @@ async def create_version(request: CreateVersionRequest):
         raise HTTPException(status_code=500, detail=f"Failed to create version: {str(e)}")
 
 
+@router.post("/versions/retention/{file_id}")
+async def apply_version_retention(file_id: str, request: Optional[Dict[str, Any]] = None):
+    """Apply the retention policy (or overrides of it) to one document's versions now"""
+    try:
+        try:
+            policy = RetentionPolicy.with_overrides(request or {})
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        if file_id not in version_logs:
+            raise HTTPException(status_code=404, detail="No version history for this file")
+        
+        summary = await enforce_retention(file_id, policy)
+        logger.info(f"Retention applied to {file_id}: {summary['expired_versions']} versions expired")
+        return {**summary, "policy": policy.to_dict()}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Version retention error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to apply retention: {str(e)}")
+
+
 # NOTE: More specific routes (/versions/stats/, /versions/download/) must be defined 
 # BEFORE the generic /versions/{file_id} route to ensure proper route matching
 
@@ -188,7 +412,8 @@ async def create_version(request: CreateVersionRequest):
 async def get_version_stats(file_id: str):
     """Get statistics about version history for a file"""
     try:
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             if file_id in file_storage:
                 return {
                     "file_id": file_id,
@@ -197,8 +422,7 @@ async def get_version_stats(file_id: str):
                 }
             raise HTTPException(status_code=404, detail="File not found")
         
-        history = version_history[file_id]
-        versions = history["versions"]
+        versions = history.versions
         
         if not versions:
             return {
@@ -207,19 +431,22 @@ async def get_version_stats(file_id: str):
                 "has_history": False
             }
         
-        # Calculate stats
-        total_storage = sum(v["file_size"] for v in versions)
+        # Calculate stats; keyframes shared by several versions are counted once
+        total_storage = stored_bytes(versions)
+        logical_size = sum(v["file_size"] for v in versions)
         authors = list(set(v["created_by"] for v in versions))
         first_version = versions[0]
         latest_version = versions[-1]
         
         return {
             "file_id": file_id,
-            "original_name": history["original_name"],
+            "original_name": history.original_name,
             "total_versions": len(versions),
-            "current_version": history["current_version"],
+            "current_version": history.current_version,
             "total_storage_bytes": total_storage,
             "total_storage_mb": round(total_storage / (1024 * 1024), 2),
+            "logical_size_bytes": logical_size,
+            "keyframes": sum(1 for v in versions if v.get("storage", "keyframe") == "keyframe"),
             "authors": authors,
             "first_version_date": first_version["created_at"],
             "latest_version_date": latest_version["created_at"],
@@ -237,7 +464,8 @@ async def get_version_stats(file_id: str):
 async def get_version_history(file_id: str):
     """Get complete version history for a document"""
     try:
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             # Check if file exists but has no versions
             if file_id in file_storage:
                 return {
@@ -250,14 +478,12 @@ async def get_version_history(file_id: str):
                 }
             raise HTTPException(status_code=404, detail="File not found")
         
-        history = version_history[file_id]
-        
         return {
             "file_id": file_id,
-            "original_name": history["original_name"],
-            "versions": history["versions"],
-            "total_versions": len(history["versions"]),
-            "current_version": history["current_version"]
+            "original_name": history.original_name,
+            "versions": history.versions,
+            "total_versions": len(history.versions),
+            "current_version": history.current_version
         }
         
     except HTTPException:
@@ -271,20 +497,19 @@ async def get_version_history(file_id: str):
 async def get_version_details(file_id: str, version_id: str):
     """Get details of a specific version"""
     try:
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             raise HTTPException(status_code=404, detail="File not found")
         
-        versions = version_history[file_id]["versions"]
-        
-        for version in versions:
-            if version["version_id"] == version_id:
-                return {
-                    "file_id": file_id,
-                    "version": version,
-                    "download_url": f"/api/versions/download/{file_id}/{version_id}"
-                }
+        version = history.get(version_id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="Version not found")
         
-        raise HTTPException(status_code=404, detail="Version not found")
+        return {
+            "file_id": file_id,
+            "version": version,
+            "download_url": f"/api/versions/download/{file_id}/{version_id}"
+        }
         
     except HTTPException:
         raise
@@ -295,27 +520,29 @@ async def get_version_details(file_id: str, version_id: str):
 
 @router.get("/versions/download/{file_id}/{version_id}")
 async def download_version(file_id: str, version_id: str):
-    """Download a specific version of a document"""
-    from fastapi.responses import FileResponse
+    """Download a specific version of a document, rebuilt from its keyframe and delta as it streams"""
+    from fastapi.responses import StreamingResponse
     
     try:
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             raise HTTPException(status_code=404, detail="File not found")
         
-        versions = version_history[file_id]["versions"]
-        
-        for version in versions:
-            if version["version_id"] == version_id:
-                if not os.path.exists(version["file_path"]):
-                    raise HTTPException(status_code=404, detail="Version file not found on disk")
-                
-                return FileResponse(
-                    path=version["file_path"],
-                    filename=f"v{version['version_number']}_{version_history[file_id]['original_name']}",
-                    media_type="application/octet-stream"
-                )
-        
-        raise HTTPException(status_code=404, detail="Version not found")
+        version = history.get(version_id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="Version not found")
+        if not version_available(version):
+            raise HTTPException(status_code=404, detail="Version file not found on disk")
+        
+        filename = f"v{version['version_number']}_{history.original_name}"
+        quoted = quote(filename)
+        disposition = (f'attachment; filename="{filename}"' if quoted == filename
+                       else f"attachment; filename*=utf-8''{quoted}")
+        return StreamingResponse(
+            iter_version(version),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": disposition, "Content-Length": str(version["file_size"])}
+        )
         
     except HTTPException:
         raise
@@ -325,28 +552,21 @@ async def download_version(file_id: str, version_id: str):
 
 
 @router.post("/versions/revert")
-async def revert_to_version(request: RevertVersionRequest):
-    """Revert document to a previous version"""
+async def revert_to_version(request: RevertVersionRequest, background_tasks: BackgroundTasks):
+    """Revert document to a previous version by cloning its snapshot blob over the live file"""
     try:
         file_id = request.file_id
         version_id = request.version_id
         
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             raise HTTPException(status_code=404, detail="File not found")
         
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="Original file not found")
         
-        history = version_history[file_id]
-        versions = history["versions"]
-        
         # Find the version to revert to
-        target_version = None
-        for version in versions:
-            if version["version_id"] == version_id:
-                target_version = version
-                break
-        
+        target_version = history.get(version_id)
         if not target_version:
             raise HTTPException(status_code=404, detail="Version not found")
         
@@ -357,40 +577,54 @@ async def revert_to_version(request: RevertVersionRequest):
             change_description=f"Auto-backup before reverting to v{target_version['version_number']}",
             created_by=request.created_by
         )
-        await create_version(backup_request)
-        
-        # Copy the target version file to replace current
-        shutil.copy2(target_version["file_path"], current_file_info["file_path"])
+        await create_version(backup_request, background_tasks)
+        
+        loop = asyncio.get_running_loop()
+        target_hash = target_version["file_hash"]
+        async with _blob_lock(file_id):
+            target_blob = _blob_path(file_id, target_hash)
+            if not os.path.exists(target_blob):
+                # Pruned (or older) snapshots are rebuilt into a blob once; later reverts reuse it
+                rebuilt_path = _blob_path(file_id, f"rebuild-{uuid.uuid4()}")
+                os.makedirs(os.path.dirname(rebuilt_path), exist_ok=True)
+                _, target_hash = await loop.run_in_executor(None, restore_version, target_version, rebuilt_path)
+                target_blob = _blob_path(file_id, target_hash)
+                os.replace(rebuilt_path, target_blob)
+            
+            # A reflink or hardlink swap takes the same time at any file size
+            clone_method = await loop.run_in_executor(
+                None, clone_file, target_blob, current_file_info["file_path"]
+            )
+        pdf_reader_cache.invalidate(current_file_info["file_path"])
         
         # Update file storage info
-        file_storage[file_id]["file_size"] = os.path.getsize(current_file_info["file_path"])
+        file_storage[file_id]["file_size"] = target_version["file_size"]
+        file_storage[file_id]["sha256"] = target_hash
+        # The old content's fingerprint must not match near-duplicates until the new one is computed
+        file_storage[file_id].pop("minhash", None)
+        similarity_index.remove(file_id)
         save_storage()
+        background_tasks.add_task(index_similarity, file_id)
         
         # Create a new version record for the revert
         revert_version_id = str(uuid.uuid4())
-        new_version_number = len(versions) + 1
+        new_version_number = history.next_version_number
         
+        # The revert record shares the target's stored data
         revert_record = {
             "version_id": revert_version_id,
             "version_number": new_version_number,
-            "file_path": target_version["file_path"],
             "file_size": target_version["file_size"],
-            "file_hash": target_version["file_hash"],
+            "file_hash": target_hash,
             "created_at": datetime.utcnow().isoformat(),
             "created_by": request.created_by,
             "change_description": f"Reverted to version {target_version['version_number']}",
             "is_current": True,
-            "reverted_from": target_version["version_id"]
+            "reverted_from": target_version["version_id"],
+            **shared_storage(target_version)
         }
         
-        # Mark all versions as not current
-        for v in versions:
-            v["is_current"] = False
-        
-        versions.append(revert_record)
-        history["current_version"] = new_version_number
-        
-        save_version_history()
+        version_logs.add_version(history, revert_record)
         
         logger.info(f"File {file_id} reverted to version {target_version['version_number']}")
         
@@ -398,6 +632,7 @@ async def revert_to_version(request: RevertVersionRequest):
             "file_id": file_id,
             "reverted_to_version": target_version["version_number"],
             "new_version_number": new_version_number,
+            "revert_method": clone_method,
             "status": "reverted",
             "message": f"Successfully reverted to version {target_version['version_number']}"
         }
@@ -409,36 +644,47 @@ async def revert_to_version(request: RevertVersionRequest):
         raise HTTPException(status_code=500, detail=f"Failed to revert: {str(e)}")
 
 
+def diff_versions(original_text: str, modified_text: str, mode: str, granularity: str,
+                  ignore_whitespace: bool) -> Dict[str, Any]:
+    """Line or clause diff between two version texts"""
+    return compare_candidate(BaselineIndex(original_text, mode), modified_text, granularity, ignore_whitespace)
+
+
 @router.post("/versions/compare")
 async def compare_versions(request: dict):
-    """Compare two versions of a document"""
+    """Compare two versions of a document, diffing their cached text"""
     try:
         file_id = request.get("file_id")
         version_id_1 = request.get("version_id_1")
         version_id_2 = request.get("version_id_2")
+        mode = request.get("mode", "lines")
+        granularity = request.get("granularity", "word")
+        ignore_whitespace = bool(request.get("ignore_whitespace", False))
+        limit = parse_page_limit(request.get("limit", 50))
         
         if not all([file_id, version_id_1, version_id_2]):
             raise HTTPException(status_code=400, detail="file_id, version_id_1, and version_id_2 are required")
         
-        if file_id not in version_history:
-            raise HTTPException(status_code=404, detail="File not found")
+        if mode not in COMPARE_MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(COMPARE_MODES)}")
         
-        versions = version_history[file_id]["versions"]
+        if granularity not in GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
         
-        version_1 = None
-        version_2 = None
+        if limit is None:
+            raise HTTPException(status_code=400, detail="limit must be an integer of at least 1")
         
-        for v in versions:
-            if v["version_id"] == version_id_1:
-                version_1 = v
-            if v["version_id"] == version_id_2:
-                version_2 = v
+        history = version_logs.get(file_id)
+        if history is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        version_1 = history.get(version_id_1)
+        version_2 = history.get(version_id_2)
         
         if not version_1 or not version_2:
             raise HTTPException(status_code=404, detail="One or both versions not found")
         
-        # Basic comparison info
-        comparison = {
+        metadata = {
             "file_id": file_id,
             "version_1": {
                 "version_number": version_1["version_number"],
@@ -462,7 +708,74 @@ async def compare_versions(request: dict):
             }
         }
         
-        return comparison
+        # Identical contents give identical diffs, whichever versions hold them
+        key = (version_1["file_hash"], version_2["file_hash"], mode, granularity, ignore_whitespace)
+        diff = _version_diffs.get(key)
+        cached = diff is not None
+        if cached:
+            _version_diffs.move_to_end(key)
+        else:
+            loop = asyncio.get_running_loop()
+            file_type = _file_type(file_id, history.original_name)
+            if file_type.lower() in TEXTLESS_FILE_TYPES:
+                return {**metadata, "text_available": False}
+            try:
+                original_text, modified_text = await asyncio.gather(
+                    loop.run_in_executor(None, load_version_text, file_id, version_1, file_type),
+                    loop.run_in_executor(None, load_version_text, file_id, version_2, file_type)
+                )
+            except ValueError as e:
+                # Encrypted or damaged files have no text to diff; fall back to size and hash
+                logger.warning(f"Version text unavailable for {file_id}: {str(e)}")
+                return {**metadata, "text_available": False}
+            diff = await loop.run_in_executor(
+                None, diff_versions, original_text, modified_text, mode, granularity, ignore_whitespace
+            )
+            _version_diffs[key] = diff
+            while len(_version_diffs) > VERSION_DIFF_CACHE_SIZE:
+                _version_diffs.popitem(last=False)
+        
+        if mode == "clauses":
+            unified = clause_summary(diff["changes"], max_lines=100)
+        else:
+            unified = unified_diff(
+                diff["original_lines"],
+                diff["modified_lines"],
+                diff["opcodes"],
+                fromfile=f"v{version_1['version_number']}",
+                tofile=f"v{version_2['version_number']}",
+                max_lines=100
+            )
+        
+        comparison_id = str(uuid.uuid4())
+        comparison = {
+            "comparison_id": comparison_id,
+            **metadata,
+            "text_available": True,
+            "mode": mode,
+            "granularity": granularity,
+            "differences": diff["differences"],
+            "similarity": diff["similarity"],
+            "diff_summary": "\n".join(unified),
+            "cached": cached
+        }
+        # Registered with the document comparisons so the full change list can be paged
+        remember_comparison(comparison_id, {
+            **comparison,
+            "original_file": f"v{version_1['version_number']}_{history.original_name}",
+            "modified_file": f"v{version_2['version_number']}_{history.original_name}",
+            "comparison_time": datetime.utcnow().isoformat(),
+            **diff
+        })
+        
+        pagination, page = page_changes(diff["changes"], 0, limit)
+        
+        return {
+            **comparison,
+            "changes": page,
+            "pagination": pagination,
+            "changes_url": f"/api/compare/{comparison_id}"
+        }
         
     except HTTPException:
         raise
@@ -475,33 +788,28 @@ async def compare_versions(request: dict):
 async def delete_version(file_id: str, version_id: str):
     """Delete a specific version (cannot delete current version)"""
     try:
-        if file_id not in version_history:
+        history = version_logs.get(file_id)
+        if history is None:
             raise HTTPException(status_code=404, detail="File not found")
         
-        versions = version_history[file_id]["versions"]
-        
-        for i, version in enumerate(versions):
-            if version["version_id"] == version_id:
-                if version["is_current"]:
-                    raise HTTPException(status_code=400, detail="Cannot delete current version")
-                
-                # Delete the file
-                if os.path.exists(version["file_path"]):
-                    os.remove(version["file_path"])
-                
-                # Remove from history
-                del versions[i]
-                save_version_history()
-                
-                logger.info(f"Version {version['version_number']} deleted from file {file_id}")
-                
-                return {
-                    "file_id": file_id,
-                    "version_id": version_id,
-                    "status": "deleted"
-                }
+        version = history.get(version_id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="Version not found")
+        if version["is_current"]:
+            raise HTTPException(status_code=400, detail="Cannot delete current version")
+        
+        # Remove from history, then delete stored files no other version is rebuilt from
+        version_logs.delete_version(history, version_id)
+        release_version(version, history.versions)
+        _remove_unused_texts(file_id, history)
+        
+        logger.info(f"Version {version['version_number']} deleted from file {file_id}")
         
-        raise HTTPException(status_code=404, detail="Version not found")
+        return {
+            "file_id": file_id,
+            "version_id": version_id,
+            "status": "deleted"
+        }
         
     except HTTPException:
         raise
@@ -1,5 +1,5 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form, Request, BackgroundTasks
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
@@ -8,19 +8,37 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, Union
 import uuid
 from datetime import datetime
 import tempfile
 import shutil
 import aiofiles
 import asyncio
-import io
 import json
+import hashlib
 from file_converter import FileConverter
 from ai_analyzer import AIAnalyzer
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+from pdf_index import build_pdf_index, get_pdf_index, validate_page_numbers, select_pages
+from pdf_cache import pdf_reader_cache
+from pdf_compressor import compress_pdf_file, QUALITY_PROFILES
+from pdf_workers import get_pdf_worker_pool, run_in_pdf_worker, shutdown_pdf_worker_pool
+from pdf_signing import render_signature_overlay, overlay_key, sign_pdf_file, file_sha256, SIGNATURE_DATE_FORMAT
+from pdf_jobs import create_job, get_job, record_result, run_job_tasks
+from pdf_encryption import encrypt_pdf_file
+from document_diff import (
+    GRANULARITIES, COMPARE_MODES, diff_documents, unified_diff, remember_comparison, remember_comparison_batch, get_comparison, page_changes,
+    parse_page_limit
+)
+from clause_diff import ClauseIndex, diff_clauses, clause_summary
+from document_compare import BaselineIndex, save_baseline, compare_candidate_file
+from redline_writer import REDLINE_FORMATS, write_redline
+from similarity_index import similarity_index, minhash_signature, encode_signature, DEFAULT_MIN_SIMILARITY
+from chunk_store import chunk_store
+from annotation_store import annotation_store
+from page_renderer import page_render_cache, parse_scale, RENDER_FORMATS
+from pdf_linearizer import finalize_pdf_output
+from range_response import ranged_file_response
 
 # Import database and Stripe webhook
 from database import db as postgres_db
@@ -32,7 +50,7 @@ from routes.pdf_forms import router as pdf_forms_router, init_pdf_forms_routes
 from routes.user_dashboard import router as dashboard_router, init_dashboard_routes
 from routes.ocr import router as ocr_router, init_ocr_routes
 from routes.collaboration import router as collaboration_router
-from routes.version_history import router as version_router, init_version_routes
+from routes.version_history import router as version_router, init_version_routes, run_version_retention
 from routes.auth import router as auth_router, init_auth_routes
 
 # Persistent storage directories
@@ -111,6 +129,8 @@ class FileUploadResponse(BaseModel):
 class ConversionRequest(BaseModel):
     file_id: str
     target_format: str
+    linearize: Optional[bool] = None  # PDF targets only; None uses the server default
+    pages: Optional[Union[str, List[Union[int, str]]]] = None  # PDF sources only, e.g. "40-55"
 
 class ConversionResponse(BaseModel):
     conversion_id: str
@@ -118,9 +138,11 @@ class ConversionResponse(BaseModel):
     download_url: str
     original_file: str
     converted_file: str
+    linearized: bool = False
 
 class AnalysisRequest(BaseModel):
     file_id: str
+    pages: Optional[Union[str, List[Union[int, str]]]] = None  # PDF sources only, e.g. "1-3, 10"
 
 class RiskAssessment(BaseModel):
     level: str
@@ -216,6 +238,12 @@ def save_storage():
 # Load existing storage on startup
 file_storage, conversion_storage = load_storage()
 analysis_storage = {}
+similarity_index.load(file_storage)
+chunk_store.load(os.path.join(STORAGE_BASE_DIR, "chunks"))
+annotation_store.open(os.path.join(STORAGE_BASE_DIR, "annotations"))
+
+# Upload types whose text is fingerprinted for near-duplicate detection
+SIMILARITY_FILE_TYPES = {"pdf", "txt", "md", "html", "xml", "rtf", "csv"}
 
 # Supported formats
 SUPPORTED_FORMATS = {
@@ -232,8 +260,48 @@ async def get_supported_formats():
     """Get list of supported input and output formats"""
     return SupportedFormats(**SUPPORTED_FORMATS)
 
+async def index_pdf_in_background(file_id: str):
+    """Build the structural index of an uploaded PDF off the request path"""
+    file_info = file_storage.get(file_id)
+    if not file_info or file_info["file_type"].lower() != "pdf":
+        return
+    
+    try:
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, build_pdf_index, file_info["file_path"])
+        # The record may have been cleaned up while indexing
+        if file_id in file_storage:
+            file_storage[file_id]["pdf_index"] = index
+            save_storage()
+            logger.info(f"PDF index built for {file_id}: {index['page_count']} pages")
+    except Exception as e:
+        logger.warning(f"PDF indexing failed for {file_id}: {e}")
+
+def compute_document_signature(file_info: Dict[str, Any]):
+    """MinHash signature of a document's extracted text, None when it has no usable text"""
+    text = extract_comparison_text(file_info)
+    if text.startswith("Error extracting text"):
+        return None
+    return minhash_signature(text)
+
+async def index_similarity_in_background(file_id: str):
+    """Fingerprint an upload for near-duplicate lookups off the request path"""
+    file_info = file_storage.get(file_id)
+    if not file_info or file_info["file_type"].lower() not in SIMILARITY_FILE_TYPES:
+        return
+    
+    try:
+        loop = asyncio.get_running_loop()
+        signature = await loop.run_in_executor(None, compute_document_signature, file_info)
+        if signature is not None and file_id in file_storage:
+            file_storage[file_id]["minhash"] = encode_signature(signature)
+            similarity_index.add(file_id, signature)
+            save_storage()
+    except Exception as e:
+        logger.warning(f"Similarity indexing failed for {file_id}: {e}")
+
 @api_router.post("/upload", response_model=FileUploadResponse)
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Upload a document for processing with enhanced error handling"""
     temp_file_path = None
     try:
@@ -286,6 +354,7 @@ async def upload_file(file: UploadFile = File(...)):
         
         # Generate unique file ID
         file_id = str(uuid.uuid4())
+        file_sha = hashlib.sha256(file_content).hexdigest()
         logger.info(f"Starting upload process for {file.filename} with ID: {file_id}")
         
         # Create file in persistent uploads directory
@@ -330,6 +399,7 @@ async def upload_file(file: UploadFile = File(...)):
             "file_path": temp_file_path,
             "file_type": file_extension,
             "file_size": file_size,
+            "sha256": file_sha,
             "upload_time": datetime.utcnow(),
             "supported_conversions": [fmt for fmt in SUPPORTED_FORMATS["output"] if fmt != file_extension]
         }
@@ -337,6 +407,10 @@ async def upload_file(file: UploadFile = File(...)):
         file_storage[file_id] = file_info
         save_storage()
         
+        if file_extension == 'pdf':
+            background_tasks.add_task(index_pdf_in_background, file_id)
+        background_tasks.add_task(index_similarity_in_background, file_id)
+        
         logger.info(f"File uploaded successfully: {file.filename} ({file_size} bytes) with ID: {file_id}")
         
         return FileUploadResponse(
@@ -380,6 +454,11 @@ async def convert_file(request: ConversionRequest):
                 detail=f"Unsupported target format. Supported formats: {', '.join(SUPPORTED_FORMATS['output'])}"
             )
         
+        try:
+            pages = await select_pages(file_info, request.pages, save_storage)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         # Generate conversion ID
         conversion_id = str(uuid.uuid4())
         
@@ -388,8 +467,13 @@ async def convert_file(request: ConversionRequest):
             file_info["file_path"],
             file_info["file_type"],
             request.target_format,
-            conversion_id
+            conversion_id,
+            pages
         )
+        linearized = False
+        if request.target_format == "pdf":
+            loop = asyncio.get_running_loop()
+            linearized = await loop.run_in_executor(None, finalize_pdf_output, converted_file_path, request.linearize)
         
         # Store conversion metadata
         converted_filename = f"{file_info['original_name'].rsplit('.', 1)[0]}.{request.target_format}"
@@ -413,6 +497,7 @@ async def convert_file(request: ConversionRequest):
             "file_path": converted_file_path,
             "file_type": request.target_format,
             "file_size": os.path.getsize(converted_file_path),
+            "sha256": file_sha256(converted_file_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -424,9 +509,12 @@ async def convert_file(request: ConversionRequest):
             status="completed",
             download_url=f"/api/download/{conversion_id}",
             original_file=file_info["original_name"],
-            converted_file=converted_filename
+            converted_file=converted_filename,
+            linearized=linearized
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error converting file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error converting file: {str(e)}")
@@ -441,6 +529,11 @@ async def analyze_document(request: AnalysisRequest):
         
         file_info = file_storage[request.file_id]
         
+        try:
+            pages = await select_pages(file_info, request.pages, save_storage)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         # Generate analysis ID
         analysis_id = str(uuid.uuid4())
         
@@ -448,7 +541,8 @@ async def analyze_document(request: AnalysisRequest):
         analysis_result = await ai_analyzer.analyze_document(
             file_info["file_path"],
             file_info["file_type"],
-            analysis_id
+            analysis_id,
+            pages
         )
         
         # Store analysis metadata
@@ -465,12 +559,14 @@ async def analyze_document(request: AnalysisRequest):
         
         return AnalysisResponse(**analysis_result)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing document: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error analyzing document: {str(e)}")
 
 @api_router.get("/download/{file_id}")
-async def download_file(file_id: str):
+async def download_file(file_id: str, request: Request):
     """Download converted file or PDF operation result"""
     try:
         # Check if it's a conversion result
@@ -481,10 +577,12 @@ async def download_file(file_id: str):
             if not os.path.exists(conversion_info["converted_file_path"]):
                 raise HTTPException(status_code=404, detail="Converted file not found")
             
-            return FileResponse(
-                path=conversion_info["converted_file_path"],
-                filename=conversion_info["converted_file"],
-                media_type='application/octet-stream'
+            return ranged_file_response(
+                conversion_info["converted_file_path"],
+                conversion_info["converted_file"],
+                'application/octet-stream',
+                request.headers.get("range"),
+                request.headers.get("if-range")
             )
         
         # Check if it's a file in file_storage (PDF operations, uploads)
@@ -495,10 +593,12 @@ async def download_file(file_id: str):
             if not os.path.exists(file_info["file_path"]):
                 raise HTTPException(status_code=404, detail="File not found")
             
-            return FileResponse(
-                path=file_info["file_path"],
-                filename=file_info["original_name"],
-                media_type='application/octet-stream'
+            return ranged_file_response(
+                file_info["file_path"],
+                file_info["original_name"],
+                'application/octet-stream',
+                request.headers.get("range"),
+                request.headers.get("if-range")
             )
         
         else:
@@ -544,6 +644,8 @@ async def cleanup_old_files():
             # Remove from memory
             for file_id in files_to_remove:
                 del file_storage[file_id]
+                similarity_index.remove(file_id)
+                annotation_store.remove_file(file_id)
             for conv_id in conversions_to_remove:
                 del conversion_storage[conv_id]
             for analysis_id in analyses_to_remove:
@@ -598,6 +700,8 @@ async def merge_pdfs(request: dict):
         
         merger.write(output_path)
         merger.close()
+        loop = asyncio.get_running_loop()
+        linearized = await loop.run_in_executor(None, finalize_pdf_output, output_path, request.get("linearize"))
         
         # Store merge result
         merge_info = {
@@ -614,6 +718,7 @@ async def merge_pdfs(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -624,6 +729,7 @@ async def merge_pdfs(request: dict):
             "merge_id": merge_id,
             "output_file": output_filename,
             "source_files": merge_info["source_files"],
+            "linearized": linearized,
             "download_url": f"/api/download/{merge_id}",
             "status": "completed"
         }
@@ -652,6 +758,17 @@ async def split_pdf(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
+        # Validate requested ranges against the structural index before parsing
+        pdf_index = await get_pdf_index(file_info, save_storage)
+        if split_type != "pages":
+            for range_info in page_ranges:
+                start = range_info.get('start', 1)
+                error = validate_page_numbers(pdf_index, [start])
+                if error:
+                    raise HTTPException(status_code=400, detail=error)
+                if range_info.get('end', start) < start:
+                    raise HTTPException(status_code=400, detail=f"Invalid page range: {start}-{range_info['end']}")
+        
         # Split PDF using PyPDF2
         from PyPDF2 import PdfReader, PdfWriter
         
@@ -684,6 +801,7 @@ async def split_pdf(request: dict):
                     "file_path": page_path,
                     "file_type": "pdf",
                     "file_size": os.path.getsize(page_path),
+                    "sha256": file_sha256(page_path),
                     "upload_time": datetime.utcnow()
                 }
                 
@@ -717,6 +835,7 @@ async def split_pdf(request: dict):
                     "file_path": range_path,
                     "file_type": "pdf",
                     "file_size": os.path.getsize(range_path),
+                    "sha256": file_sha256(range_path),
                     "upload_time": datetime.utcnow()
                 }
                 
@@ -767,33 +886,21 @@ async def encrypt_pdf(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        # Encrypt PDF using PyPDF2
-        from PyPDF2 import PdfReader, PdfWriter
-        
         encrypt_id = str(uuid.uuid4())
         base_name = file_info["original_name"].rsplit('.', 1)[0]
         encrypted_filename = f"{base_name}_encrypted.pdf"
         temp_dir = CONVERSIONS_DIR
         encrypted_path = os.path.join(temp_dir, f"{encrypt_id}_{encrypted_filename}")
         
-        # Read and encrypt the PDF
-        reader = PdfReader(file_info["file_path"])
-        writer = PdfWriter()
-        
-        # Copy all pages
-        for page in reader.pages:
-            writer.add_page(page)
-        
-        # Encrypt with password and permissions
-        writer.encrypt(
-            user_password=password,
-            owner_password=password,
-            permissions_flag=0 if not any(permissions.values()) else -1
-        )
-        
-        # Write encrypted PDF
-        with open(encrypted_path, 'wb') as output_file:
-            writer.write(output_file)
+        # AES-256 encrypt straight from the source objects to the output file
+        loop = asyncio.get_running_loop()
+        try:
+            stats = await loop.run_in_executor(
+                None, encrypt_pdf_file, file_info["file_path"], encrypted_path,
+                password, request.get("owner_password") or password, permissions
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Store encrypted file info
         file_storage[encrypt_id] = {
@@ -801,9 +908,11 @@ async def encrypt_pdf(request: dict):
             "original_name": encrypted_filename,
             "file_path": encrypted_path,
             "file_type": "pdf",
-            "file_size": os.path.getsize(encrypted_path),
+            "file_size": stats["file_size"],
+            "sha256": stats["sha256"],
             "upload_time": datetime.utcnow(),
             "encrypted": True,
+            "encryption": "AES-256",
             "permissions": permissions
         }
         save_storage()
@@ -814,6 +923,7 @@ async def encrypt_pdf(request: dict):
             "encrypt_id": encrypt_id,
             "original_file": file_info["original_name"],
             "encrypted_file": encrypted_filename,
+            "encryption": "AES-256",
             "permissions": permissions,
             "download_url": f"/api/download/{encrypt_id}",
             "status": "completed"
@@ -825,6 +935,97 @@ async def encrypt_pdf(request: dict):
         logger.error(f"PDF encryption error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"PDF encryption failed: {str(e)}")
 
+@api_router.post("/pdf/encrypt/batch")
+async def batch_encrypt_pdfs(request: dict, background_tasks: BackgroundTasks):
+    """AES-256 encrypt many PDFs in one job across the PDF worker pool"""
+    try:
+        file_ids = request.get("file_ids", [])
+        password = request.get("password")
+        owner_password = request.get("owner_password") or password
+        passwords = request.get("passwords", {})  # Optional per-file user passwords
+        permissions = request.get("permissions", {
+            "print": True,
+            "copy": False,
+            "modify": False,
+            "extract": False
+        })
+        
+        if not file_ids:
+            raise HTTPException(status_code=400, detail="No file_ids provided")
+        if not password and not all(passwords.get(fid) for fid in file_ids):
+            raise HTTPException(status_code=400, detail="password is required unless every file has its own")
+        
+        job = create_job("encrypt", len(file_ids))
+        tasks = []
+        for file_id in file_ids:
+            file_info = file_storage.get(file_id)
+            if file_info is None or file_info["file_type"].lower() != "pdf":
+                record_result(job, {
+                    "file_id": file_id,
+                    "status": "error",
+                    "error": "File not found" if file_info is None else "File must be a PDF"
+                })
+                continue
+            
+            encrypt_id = str(uuid.uuid4())
+            encrypted_filename = f"{file_info['original_name'].rsplit('.', 1)[0]}_encrypted.pdf"
+            user_password = passwords.get(file_id) or password
+            tasks.append({
+                "file_id": file_id,
+                "encrypt_id": encrypt_id,
+                "input_path": file_info["file_path"],
+                "encrypted_filename": encrypted_filename,
+                "encrypted_path": os.path.join(CONVERSIONS_DIR, f"{encrypt_id}_{encrypted_filename}"),
+                "user_password": user_password,
+                "owner_password": owner_password or user_password
+            })
+        
+        loop = asyncio.get_running_loop()
+        pool = get_pdf_worker_pool()
+        
+        async def encrypt_one(task):
+            stats = await loop.run_in_executor(
+                pool, encrypt_pdf_file, task["input_path"], task["encrypted_path"],
+                task["user_password"], task["owner_password"], permissions
+            )
+            file_storage[task["encrypt_id"]] = {
+                "file_id": task["encrypt_id"],
+                "original_name": task["encrypted_filename"],
+                "file_path": task["encrypted_path"],
+                "file_type": "pdf",
+                "file_size": stats["file_size"],
+                "sha256": stats["sha256"],
+                "upload_time": datetime.utcnow(),
+                "encrypted": True,
+                "encryption": "AES-256",
+                "permissions": permissions,
+                "batch_job_id": job["job_id"]
+            }
+            return {
+                "file_id": task["file_id"],
+                "status": "success",
+                "encrypt_id": task["encrypt_id"],
+                "encrypted_file": task["encrypted_filename"],
+                "file_size": stats["file_size"],
+                "download_url": f"/api/download/{task['encrypt_id']}"
+            }
+        
+        background_tasks.add_task(run_job_tasks, job, tasks, encrypt_one, save_storage)
+        
+        return {
+            "job_id": job["job_id"],
+            "total": job["total"],
+            "encryption": "AES-256",
+            "status": job["status"],
+            "status_url": f"/api/pdf/jobs/{job['job_id']}"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Batch encryption error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Batch encryption failed: {str(e)}")
+
 @api_router.post("/pdf/esign")
 async def esign_pdf(request: dict):
     """Add electronic signature to PDF"""
@@ -835,7 +1036,7 @@ async def esign_pdf(request: dict):
         signer_info = request.get("signer_info", {
             "name": "John Doe",
             "email": "john@example.com",
-            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "date": datetime.now().strftime(SIGNATURE_DATE_FORMAT)
         })
         
         if not file_id:
@@ -856,39 +1057,23 @@ async def esign_pdf(request: dict):
         temp_dir = PDF_OPERATIONS_DIR
         signed_path = os.path.join(temp_dir, f"{esign_id}_{signed_filename}")
         
-        # Read the original PDF
-        from PyPDF2 import PdfReader, PdfWriter
-        reader = PdfReader(file_info["file_path"])
-        writer = PdfWriter()
-        
-        # Create signature overlay
-        packet = io.BytesIO()
-        can = canvas.Canvas(packet, pagesize=letter)
-        
-        # Get signature position
+        # Create signature overlay and append it to the document
         page_num = signature_position.get("page", 1) - 1  # Convert to 0-based index
-        x = signature_position.get("x", 100)
-        y = signature_position.get("y", 100)
-        
-        # Draw signature text
-        can.setFont("Helvetica", 12)
-        can.drawString(x, y, f"Signed by: {signer_info.get('name', 'Unknown')}")
-        can.drawString(x, y - 15, f"Date: {signer_info.get('date', datetime.now().strftime('%Y-%m-%d'))}")
-        can.save()
-        
-        # Merge signature with PDF
-        packet.seek(0)
-        signature_pdf = PdfReader(packet)
-        
-        # Copy all pages and add signature to specified page
-        for i, page in enumerate(reader.pages):
-            if i == page_num and len(signature_pdf.pages) > 0:
-                page.merge_page(signature_pdf.pages[0])
-            writer.add_page(page)
-        
-        # Write signed PDF
-        with open(signed_path, 'wb') as output_file:
-            writer.write(output_file)
+        overlay = render_signature_overlay(signer_info, signature_position.get("x", 100), signature_position.get("y", 100))
+        # A linearized file cannot keep appended updates, so linearizing implies a full rewrite.
+        # Only an explicit request linearizes signed output - the server default keeps revisions intact.
+        linearize = bool(request.get("linearize", False))
+        outcome = sign_pdf_file(
+            file_info["file_path"], signed_path, overlay, page_num,
+            request.get("incremental", True) and not linearize
+        )
+        incremental = outcome["incremental"]
+        linearized = False
+        if linearize:
+            loop = asyncio.get_running_loop()
+            linearized = await loop.run_in_executor(None, finalize_pdf_output, signed_path, True)
+        if linearized:
+            outcome["sha256"] = file_sha256(signed_path)
         
         # Store signature metadata
         signature_info = {
@@ -896,7 +1081,7 @@ async def esign_pdf(request: dict):
             "signer": signer_info,
             "position": signature_position,
             "timestamp": datetime.utcnow(),
-            "verification_hash": f"sha256_{esign_id[:16]}"
+            "verification_hash": outcome["sha256"]
         }
         
         # Store signed file info
@@ -906,8 +1091,10 @@ async def esign_pdf(request: dict):
             "file_path": signed_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(signed_path),
+            "sha256": outcome["sha256"],
             "upload_time": datetime.utcnow(),
             "signed": True,
+            "incremental_update": incremental,
             "signature_info": signature_info
         }
         save_storage()
@@ -920,6 +1107,8 @@ async def esign_pdf(request: dict):
             "signed_file": signed_filename,
             "signer_info": signer_info,
             "signature_verification": signature_info["verification_hash"],
+            "incremental_update": incremental,
+            "linearized": linearized,
             "download_url": f"/api/download/{esign_id}",
             "status": "completed"
         }
@@ -930,10 +1119,127 @@ async def esign_pdf(request: dict):
         logger.error(f"PDF eSigning error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"PDF eSigning failed: {str(e)}")
 
+async def run_bulk_esign(job: Dict[str, Any], tasks: List[Dict[str, Any]], incremental: bool):
+    """Sign every file of a bulk job in the PDF worker pool"""
+    loop = asyncio.get_running_loop()
+    pool = get_pdf_worker_pool()
+    
+    async def sign_one(task):
+        outcome = await loop.run_in_executor(
+            pool, sign_pdf_file, task["input_path"], task["signed_path"], task["overlay"], task["page_index"], incremental
+        )
+        signature_info = {
+            "signature_id": task["esign_id"],
+            "signer": task["signer_info"],
+            "position": task["position"],
+            "timestamp": datetime.utcnow(),
+            "verification_hash": outcome["sha256"],
+            "bulk_job_id": job["job_id"]
+        }
+        file_storage[task["esign_id"]] = {
+            "file_id": task["esign_id"],
+            "original_name": task["signed_filename"],
+            "file_path": task["signed_path"],
+            "file_type": "pdf",
+            "file_size": os.path.getsize(task["signed_path"]),
+            "sha256": outcome["sha256"],
+            "upload_time": datetime.utcnow(),
+            "signed": True,
+            "incremental_update": outcome["incremental"],
+            "signature_info": signature_info
+        }
+        return {
+            "file_id": task["file_id"],
+            "status": "success",
+            "esign_id": task["esign_id"],
+            "signed_file": task["signed_filename"],
+            "signature_verification": outcome["sha256"],
+            "download_url": f"/api/download/{task['esign_id']}"
+        }
+    
+    await run_job_tasks(job, tasks, sign_one, save_storage)
+
+@api_router.post("/pdf/esign/bulk")
+async def bulk_esign_pdf(request: dict, background_tasks: BackgroundTasks):
+    """Sign many PDFs in one job with shared or per-file signer info"""
+    try:
+        file_ids = request.get("file_ids", [])
+        shared_signer = request.get("signer_info", {})
+        shared_position = request.get("position", {"page": 1, "x": 100, "y": 100})
+        per_file = request.get("signatures", {})  # {file_id: {"signer_info": ..., "position": ...}}
+        incremental = request.get("incremental", True)
+        
+        if not file_ids:
+            raise HTTPException(status_code=400, detail="No file_ids provided")
+        
+        job = create_job("esign", len(file_ids))
+        overlays = {}
+        tasks = []
+        for file_id in file_ids:
+            file_info = file_storage.get(file_id)
+            if file_info is None or file_info["file_type"].lower() != "pdf":
+                record_result(job, {
+                    "file_id": file_id,
+                    "status": "error",
+                    "error": "File not found" if file_info is None else "File must be a PDF"
+                })
+                continue
+            
+            overrides = per_file.get(file_id, {})
+            signer_info = {
+                "date": datetime.now().strftime(SIGNATURE_DATE_FORMAT),
+                **shared_signer,
+                **overrides.get("signer_info", {})
+            }
+            position = {**shared_position, **overrides.get("position", {})}
+            
+            # Render each distinct signature block once for the whole batch
+            key = overlay_key(signer_info, position)
+            if key not in overlays:
+                overlays[key] = render_signature_overlay(signer_info, position.get("x", 100), position.get("y", 100))
+            
+            esign_id = str(uuid.uuid4())
+            signed_filename = f"{file_info['original_name'].rsplit('.', 1)[0]}_signed.pdf"
+            tasks.append({
+                "file_id": file_id,
+                "esign_id": esign_id,
+                "input_path": file_info["file_path"],
+                "signed_filename": signed_filename,
+                "signed_path": os.path.join(PDF_OPERATIONS_DIR, f"{esign_id}_{signed_filename}"),
+                "overlay": overlays[key],
+                "page_index": position.get("page", 1) - 1,
+                "signer_info": signer_info,
+                "position": position
+            })
+        
+        background_tasks.add_task(run_bulk_esign, job, tasks, incremental)
+        
+        return {
+            "job_id": job["job_id"],
+            "total": job["total"],
+            "distinct_signatures": len(overlays),
+            "status": job["status"],
+            "status_url": f"/api/pdf/jobs/{job['job_id']}"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk eSign error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Bulk eSign failed: {str(e)}")
+
+@api_router.get("/pdf/jobs/{job_id}")
+async def get_pdf_job(job_id: str):
+    """Get progress and per-file results of a PDF batch job"""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 # New Enhanced API Endpoints
 
 @api_router.post("/batch-upload")
-async def batch_upload(files: List[UploadFile] = File(...)):
+async def batch_upload(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
     """Upload multiple files for batch processing"""
     try:
         results = []
@@ -967,11 +1273,16 @@ async def batch_upload(files: List[UploadFile] = File(...)):
                 "file_path": temp_file_path,
                 "file_type": file_extension,
                 "file_size": file_size,
+                "sha256": hashlib.sha256(file_content).hexdigest(),
                 "upload_time": datetime.utcnow()
             }
             
             file_storage[file_id] = file_info
             
+            if file_extension == 'pdf':
+                background_tasks.add_task(index_pdf_in_background, file_id)
+            background_tasks.add_task(index_similarity_in_background, file_id)
+            
             results.append({
                 "filename": file.filename,
                 "file_id": file_id,
@@ -992,6 +1303,7 @@ async def batch_convert(request: dict):
     try:
         file_ids = request.get("file_ids", [])
         target_format = request.get("target_format")
+        page_spec = request.get("pages")  # Applied to every PDF in the batch
         
         if not file_ids or not target_format:
             raise HTTPException(status_code=400, detail="Missing file_ids or target_format")
@@ -1009,13 +1321,15 @@ async def batch_convert(request: dict):
                 
                 file_info = file_storage[file_id]
                 conversion_id = str(uuid.uuid4())
+                pages = await select_pages(file_info, page_spec, save_storage) if file_info["file_type"].lower() == "pdf" else None
                 
                 # Convert file
                 converted_file_path = await file_converter.convert_file(
                     file_info["file_path"],
                     file_info["file_type"],
                     target_format,
-                    conversion_id
+                    conversion_id,
+                    pages
                 )
                 
                 # Store conversion result
@@ -1052,116 +1366,339 @@ async def batch_convert(request: dict):
         logger.error(f"Batch conversion error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Batch conversion failed: {str(e)}")
 
+MAX_COMPARE_CANDIDATES = int(os.environ.get("MAX_COMPARE_CANDIDATES", "100"))
+
+def extract_comparison_text(file_info: Dict[str, Any]) -> str:
+    """Extract text from various file types for comparison"""
+    file_path, file_type = file_info["file_path"], file_info["file_type"].lower()
+    try:
+        if file_type == 'pdf':
+            with pdf_reader_cache.reader(file_path) as reader:
+                return "".join(page.extract_text() + "\n" for page in reader.pages)
+        elif file_type in ['txt', 'text']:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        elif file_type in ['docx']:
+            # For DOCX, we'd need python-docx library
+            # For now, return a placeholder
+            return "Document comparison for DOCX files requires python-docx library"
+        else:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read()
+    except Exception as e:
+        return f"Error extracting text: {str(e)}"
+
 @api_router.post("/compare")
 async def compare_documents(request: dict):
     """Compare two documents and highlight differences"""
     try:
         original_file_id = request.get("original_file_id")
         modified_file_id = request.get("modified_file_id")
+        mode = request.get("mode", "lines")
+        granularity = request.get("granularity", "word")
+        ignore_whitespace = bool(request.get("ignore_whitespace", False))
+        limit = parse_page_limit(request.get("limit", 50))
         
         if not original_file_id or not modified_file_id:
             raise HTTPException(status_code=400, detail="Both original_file_id and modified_file_id are required")
         
+        if mode not in COMPARE_MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(COMPARE_MODES)}")
+        
+        if granularity not in GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
+        
+        if limit is None:
+            raise HTTPException(status_code=400, detail="limit must be an integer of at least 1")
+        
         if original_file_id not in file_storage or modified_file_id not in file_storage:
             raise HTTPException(status_code=404, detail="One or both files not found")
         
         original_file = file_storage[original_file_id]
         modified_file = file_storage[modified_file_id]
         
-        # Extract text content from both files
-        import difflib
-        import re
+        # Extract text from both documents off the event loop
+        loop = asyncio.get_running_loop()
+        original_text, modified_text = await asyncio.gather(
+            loop.run_in_executor(None, extract_comparison_text, original_file),
+            loop.run_in_executor(None, extract_comparison_text, modified_file)
+        )
         
-        def extract_text(file_path, file_type):
-            """Extract text from various file types"""
-            try:
-                if file_type.lower() == 'pdf':
-                    from PyPDF2 import PdfReader
-                    reader = PdfReader(file_path)
-                    text = ""
-                    for page in reader.pages:
-                        text += page.extract_text() + "\n"
-                    return text
-                elif file_type.lower() in ['txt', 'text']:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        return f.read()
-                elif file_type.lower() in ['docx']:
-                    # For DOCX, we'd need python-docx library
-                    # For now, return a placeholder
-                    return "Document comparison for DOCX files requires python-docx library"
-                else:
-                    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                        return f.read()
-            except Exception as e:
-                return f"Error extracting text: {str(e)}"
-        
-        # Extract text from both documents
-        original_text = extract_text(original_file["file_path"], original_file["file_type"])
-        modified_text = extract_text(modified_file["file_path"], modified_file["file_type"])
-        
-        # Split into lines for comparison
-        original_lines = original_text.splitlines()
-        modified_lines = modified_text.splitlines()
-        
-        # Perform diff comparison
-        differ = difflib.Differ()
-        diff = list(differ.compare(original_lines, modified_lines))
-        
-        # Analyze differences
-        insertions = []
-        deletions = []
-        modifications = []
-        
-        for i, line in enumerate(diff):
-            if line.startswith('+ '):
-                insertions.append({
-                    "type": "insertion",
-                    "location": f"line {i}",
-                    "text": line[2:].strip()
-                })
-            elif line.startswith('- '):
-                deletions.append({
-                    "type": "deletion",
-                    "location": f"line {i}",
-                    "text": line[2:].strip()
-                })
-            elif line.startswith('? '):
-                # This indicates a modification in the previous line
-                if modifications:
-                    modifications[-1]["hint"] = line[2:].strip()
-        
-        # Generate unified diff for redlining
-        unified_diff = list(difflib.unified_diff(
-            original_lines,
-            modified_lines,
-            fromfile=original_file["original_name"],
-            tofile=modified_file["original_name"],
-            lineterm=''
-        ))
+        if mode == "clauses":
+            # Clause matching so moved sections are reported as moves, not delete + insert
+            diff = await loop.run_in_executor(
+                None, lambda: diff_clauses(ClauseIndex(original_text), ClauseIndex(modified_text), granularity)
+            )
+            unified = clause_summary(diff["changes"], max_lines=100)
+        else:
+            # Line diff with word/char refinement inside changed hunks, off the event loop
+            diff = await loop.run_in_executor(
+                None, diff_documents, original_text, modified_text, granularity, ignore_whitespace
+            )
+            
+            # Unified diff summary for redlining
+            unified = unified_diff(
+                diff["original_lines"],
+                diff["modified_lines"],
+                diff["opcodes"],
+                fromfile=original_file["original_name"],
+                tofile=modified_file["original_name"],
+                max_lines=100
+            )
         
+        comparison_id = str(uuid.uuid4())
         comparison_result = {
-            "comparison_id": str(uuid.uuid4()),
+            "comparison_id": comparison_id,
             "original_file": original_file["original_name"],
             "modified_file": modified_file["original_name"],
-            "differences": {
-                "insertions": len(insertions),
-                "deletions": len(deletions),
-                "modifications": len(modifications),
-                "total_changes": len(insertions) + len(deletions) + len(modifications)
-            },
-            "changes": (insertions + deletions + modifications)[:50],  # Limit to first 50 changes
-            "diff_summary": "\n".join(unified_diff[:100]),  # Limit unified diff
+            "mode": mode,
+            "granularity": granularity,
+            "differences": diff["differences"],
+            "similarity": diff["similarity"],
+            "diff_summary": "\n".join(unified),
             "comparison_time": datetime.utcnow().isoformat()
         }
+        remember_comparison(comparison_id, {**comparison_result, **diff})
+        
+        pagination, page = page_changes(diff["changes"], 0, limit)
         
         logger.info(f"Document comparison completed: {original_file['original_name']} vs {modified_file['original_name']}")
         
-        return comparison_result
+        return {
+            **comparison_result,
+            "changes": page,
+            "pagination": pagination,
+            "changes_url": f"/api/compare/{comparison_id}"
+        }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Document comparison error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Document comparison failed: {str(e)}")
 
+@api_router.post("/compare/batch")
+async def compare_baseline_to_candidates(request: dict):
+    """Compare one baseline against many candidates and return a summary matrix"""
+    try:
+        baseline_file_id = request.get("baseline_file_id")
+        candidate_file_ids = request.get("candidate_file_ids", [])
+        mode = request.get("mode", "clauses")
+        granularity = request.get("granularity", "word")
+        ignore_whitespace = bool(request.get("ignore_whitespace", False))
+        
+        if not baseline_file_id or not candidate_file_ids:
+            raise HTTPException(status_code=400, detail="baseline_file_id and candidate_file_ids are required")
+        
+        if len(candidate_file_ids) > MAX_COMPARE_CANDIDATES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_COMPARE_CANDIDATES} candidates per request")
+        
+        if mode not in COMPARE_MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(COMPARE_MODES)}")
+        
+        if granularity not in GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"granularity must be one of: {', '.join(GRANULARITIES)}")
+        
+        if baseline_file_id not in file_storage:
+            raise HTTPException(status_code=404, detail="Baseline file not found")
+        
+        baseline_file = file_storage[baseline_file_id]
+        loop = asyncio.get_running_loop()
+        
+        # The baseline is extracted and indexed once for every candidate, and pickled once
+        # so each worker loads it from disk instead of receiving it with every task
+        baseline_text = await loop.run_in_executor(None, extract_comparison_text, baseline_file)
+        baseline = await loop.run_in_executor(None, BaselineIndex, baseline_text, mode)
+        batch_id = str(uuid.uuid4())
+        baseline_path = os.path.join(tempfile.gettempdir(), f"baseline_{batch_id}.pickle")
+        await loop.run_in_executor(None, save_baseline, baseline, baseline_path)
+        comparisons = {}
+        
+        async def compare_one(candidate_file_id):
+            candidate_file = file_storage.get(candidate_file_id)
+            if candidate_file is None:
+                return {"candidate_file_id": candidate_file_id, "status": "error", "error": "File not found"}
+            try:
+                candidate_text = await loop.run_in_executor(None, extract_comparison_text, candidate_file)
+                diff = await run_in_pdf_worker(compare_candidate_file, baseline_path, candidate_text, granularity, ignore_whitespace)
+            except Exception as e:
+                logger.error(f"Batch comparison failed for {candidate_file_id}: {str(e)}")
+                return {"candidate_file_id": candidate_file_id, "status": "error", "error": str(e)}
+            
+            comparison_id = str(uuid.uuid4())
+            comparisons[comparison_id] = {
+                "comparison_id": comparison_id,
+                "original_file": baseline_file["original_name"],
+                "modified_file": candidate_file["original_name"],
+                "mode": mode,
+                "granularity": granularity,
+                "comparison_time": datetime.utcnow().isoformat(),
+                **diff
+            }
+            return {
+                "candidate_file_id": candidate_file_id,
+                "candidate_file": candidate_file["original_name"],
+                "status": "success",
+                "comparison_id": comparison_id,
+                "similarity": diff["similarity"],
+                "differences": diff["differences"],
+                "changes_url": f"/api/compare/{comparison_id}"
+            }
+        
+        try:
+            matrix = await asyncio.gather(*(compare_one(file_id) for file_id in candidate_file_ids))
+        finally:
+            os.remove(baseline_path)
+        remember_comparison_batch(batch_id, comparisons, baseline.lines)
+        
+        logger.info(f"Batch comparison completed: {baseline_file['original_name']} vs {len(candidate_file_ids)} candidates")
+        
+        return {
+            "baseline_file": baseline_file["original_name"],
+            "mode": mode,
+            "granularity": granularity,
+            "candidates": len(candidate_file_ids),
+            "matrix": matrix,
+            "comparison_time": datetime.utcnow().isoformat()
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Batch comparison error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Batch comparison failed: {str(e)}")
+
+@api_router.get("/compare/{comparison_id}")
+async def get_comparison_changes(comparison_id: str, offset: int = 0, limit: int = 50):
+    """Page through the full change list of a recent comparison"""
+    comparison = get_comparison(comparison_id)
+    if comparison is None:
+        raise HTTPException(status_code=404, detail="Comparison not found or expired")
+    if offset < 0 or limit < 1:
+        raise HTTPException(status_code=400, detail="offset must be >= 0 and limit >= 1")
+    
+    pagination, page = page_changes(comparison["changes"], offset, limit)
+    return {
+        "comparison_id": comparison_id,
+        "differences": comparison["differences"],
+        "changes": page,
+        "pagination": pagination
+    }
+
+@api_router.post("/compare/{comparison_id}/redline")
+async def generate_redline(comparison_id: str, request: dict):
+    """Render a comparison as a downloadable DOCX, HTML or PDF redline"""
+    try:
+        fmt = request.get("format", "docx").lower()
+        author = request.get("author") or "Document Comparison"
+        
+        if fmt not in REDLINE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(REDLINE_FORMATS)}")
+        
+        comparison = get_comparison(comparison_id)
+        if comparison is None:
+            raise HTTPException(status_code=404, detail="Comparison not found or expired")
+        
+        if comparison.get("mode", "lines") != "lines":
+            raise HTTPException(status_code=400, detail="Redlines are generated from line-mode comparisons")
+        
+        redline_id = str(uuid.uuid4())
+        base_name = comparison["modified_file"].rsplit('.', 1)[0]
+        redline_filename = f"{base_name}_redline.{fmt}"
+        redline_path = os.path.join(CONVERSIONS_DIR, f"{redline_id}_{redline_filename}")
+        title = f"Redline: {comparison['original_file']} vs {comparison['modified_file']}"
+        
+        # Paragraphs are streamed to the file as they are generated
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_redline, comparison, redline_path, fmt, title, author)
+        
+        file_storage[redline_id] = {
+            "file_id": redline_id,
+            "original_name": redline_filename,
+            "file_path": redline_path,
+            "file_type": fmt,
+            "file_size": os.path.getsize(redline_path),
+            "sha256": file_sha256(redline_path),
+            "upload_time": datetime.utcnow(),
+            "redline_of": comparison_id
+        }
+        save_storage()
+        
+        logger.info(f"Redline generated for comparison {comparison_id}: {redline_filename}")
+        
+        return {
+            "redline_id": redline_id,
+            "comparison_id": comparison_id,
+            "redline_file": redline_filename,
+            "format": fmt,
+            "file_size": file_storage[redline_id]["file_size"],
+            "download_url": f"/api/download/{redline_id}"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Redline generation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Redline generation failed: {str(e)}")
+
+@api_router.get("/storage/dedup")
+async def get_dedup_stats():
+    """Deduplication ratio of the content-addressed chunk store"""
+    return chunk_store.stats()
+
+@api_router.get("/documents/{file_id}/similar")
+async def find_similar_documents(file_id: str, min_similarity: float = DEFAULT_MIN_SIMILARITY, limit: int = 20):
+    """Near-duplicates of a document by estimated Jaccard similarity of its text"""
+    try:
+        if file_id not in file_storage:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        if not 0 < min_similarity <= 1 or limit < 1:
+            raise HTTPException(status_code=400, detail="min_similarity must be in (0, 1] and limit >= 1")
+        
+        file_info = file_storage[file_id]
+        signature = similarity_index.signature(file_id)
+        if signature is None:
+            # Not fingerprinted yet (still queued, or uploaded before the index existed)
+            if file_info["file_type"].lower() not in SIMILARITY_FILE_TYPES:
+                raise HTTPException(status_code=400, detail=f"Similarity search is not supported for {file_info['file_type']} files")
+            await index_similarity_in_background(file_id)
+            signature = similarity_index.signature(file_id)
+            if signature is None:
+                raise HTTPException(status_code=400, detail="Document has no extractable text")
+        
+        matches, candidates = similarity_index.query(signature, min_similarity, limit, exclude=file_id)
+        
+        similar = []
+        for other_id, similarity in matches:
+            other = file_storage.get(other_id)
+            if other is None:
+                similarity_index.remove(other_id)
+                continue
+            upload_time = other.get("upload_time")
+            similar.append({
+                "file_id": other_id,
+                "original_name": other["original_name"],
+                "similarity": similarity,
+                "upload_time": upload_time.isoformat() if isinstance(upload_time, datetime) else upload_time,
+                # Ready-made request for reviewing what changed between the two uploads
+                "suggested_comparison": {"original_file_id": other_id, "modified_file_id": file_id}
+            })
+        
+        return {
+            "file_id": file_id,
+            "original_name": file_info["original_name"],
+            "similar": similar,
+            "candidates_checked": candidates,
+            "indexed_documents": len(similarity_index)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Similarity search error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Similarity search failed: {str(e)}")
+
 @api_router.post("/save-document")
 async def save_document(request: dict):
     """Save edited document content"""
@@ -1179,9 +1716,10 @@ async def save_document(request: dict):
         # Save content to file
         temp_dir = CONVERSIONS_DIR
         file_path = os.path.join(temp_dir, f"{file_id}_{filename}")
+        encoded = content.encode('utf-8')
         
-        async with aiofiles.open(file_path, 'w', encoding='utf-8') as f:
-            await f.write(content)
+        async with aiofiles.open(file_path, 'wb') as f:
+            await f.write(encoded)
         
         # Store file info
         file_info = {
@@ -1189,7 +1727,8 @@ async def save_document(request: dict):
             "original_name": filename,
             "file_path": file_path,
             "file_type": format_type,
-            "file_size": len(content.encode('utf-8')),
+            "file_size": len(encoded),
+            "sha256": hashlib.sha256(encoded).hexdigest(),
             "upload_time": datetime.utcnow()
         }
         
@@ -1207,8 +1746,6 @@ async def save_document(request: dict):
         logger.error(f"Document save error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to save document: {str(e)}")
 
-# Annotation storage
-annotation_storage = {}
 
 @api_router.post("/annotate")
 async def add_annotation(request: dict):
@@ -1223,10 +1760,6 @@ async def add_annotation(request: dict):
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="File not found")
         
-        # Initialize annotation storage for this file if needed
-        if file_id not in annotation_storage:
-            annotation_storage[file_id] = []
-        
         # Add annotation with unique ID
         annotation_id = str(uuid.uuid4())
         annotation_data = {
@@ -1242,7 +1775,7 @@ async def add_annotation(request: dict):
             "author": annotation.get("author", "Anonymous")
         }
         
-        annotation_storage[file_id].append(annotation_data)
+        annotation_store.add(annotation_data)
         
         logger.info(f"Annotation added to file {file_id}: {annotation_data['type']}")
         
@@ -1264,7 +1797,7 @@ async def get_annotations(file_id: str):
     try:
         # Return empty annotations if file doesn't exist or has no annotations
         # This is more user-friendly than returning 404
-        annotations = annotation_storage.get(file_id, [])
+        annotations = annotation_store.for_file(file_id)
         
         return {
             "file_id": file_id,
@@ -1280,19 +1813,16 @@ async def get_annotations(file_id: str):
 async def delete_annotation(annotation_id: str):
     """Delete a specific annotation"""
     try:
-        # Find and delete the annotation
-        for file_id, annotations in annotation_storage.items():
-            for i, annotation in enumerate(annotations):
-                if annotation["annotation_id"] == annotation_id:
-                    del annotation_storage[file_id][i]
-                    logger.info(f"Annotation {annotation_id} deleted from file {file_id}")
-                    return {
-                        "annotation_id": annotation_id,
-                        "status": "success",
-                        "message": "Annotation deleted successfully"
-                    }
-        
-        raise HTTPException(status_code=404, detail="Annotation not found")
+        annotation = annotation_store.delete(annotation_id)
+        if annotation is None:
+            raise HTTPException(status_code=404, detail="Annotation not found")
+        
+        logger.info(f"Annotation {annotation_id} deleted from file {annotation['file_id']}")
+        return {
+            "annotation_id": annotation_id,
+            "status": "success",
+            "message": "Annotation deleted successfully"
+        }
         
     except HTTPException:
         raise
@@ -1313,7 +1843,7 @@ async def export_annotations(request: dict):
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="File not found")
         
-        annotations = annotation_storage.get(file_id, [])
+        annotations = annotation_store.for_file(file_id)
         
         if export_format == "json":
             # Export as JSON
@@ -1339,6 +1869,7 @@ async def export_annotations(request: dict):
                 "file_path": export_path,
                 "file_type": "json",
                 "file_size": os.path.getsize(export_path),
+                "sha256": file_sha256(export_path),
                 "upload_time": datetime.utcnow()
             }
             save_storage()
@@ -1382,6 +1913,12 @@ async def rotate_pdf_pages(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
+        pdf_index = await get_pdf_index(file_info, save_storage)
+        if pages != "all":
+            error = validate_page_numbers(pdf_index, pages)
+            if error:
+                raise HTTPException(status_code=400, detail=error)
+        
         from PyPDF2 import PdfReader, PdfWriter
         
         rotate_id = str(uuid.uuid4())
@@ -1409,6 +1946,7 @@ async def rotate_pdf_pages(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -1441,6 +1979,9 @@ async def compress_pdf(request: dict):
         if not file_id:
             raise HTTPException(status_code=400, detail="file_id is required")
         
+        if quality not in QUALITY_PROFILES:
+            raise HTTPException(status_code=400, detail=f"Quality must be one of: {', '.join(QUALITY_PROFILES)}")
+        
         if file_id not in file_storage:
             raise HTTPException(status_code=404, detail="File not found")
         
@@ -1448,25 +1989,17 @@ async def compress_pdf(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        from PyPDF2 import PdfReader, PdfWriter
-        
         compress_id = str(uuid.uuid4())
         base_name = file_info["original_name"].rsplit('.', 1)[0]
         compressed_filename = f"{base_name}_compressed.pdf"
         output_path = os.path.join(PDF_OPERATIONS_DIR, f"{compress_id}_{compressed_filename}")
         
-        reader = PdfReader(file_info["file_path"])
-        writer = PdfWriter()
-        
-        for page in reader.pages:
-            page.compress_content_streams()
-            writer.add_page(page)
-        
-        # Remove unused objects
-        writer.remove_links()
-        
-        with open(output_path, 'wb') as f:
-            writer.write(f)
+        # Page-level work runs in a thread, image re-encoding fans out to the worker pool
+        loop = asyncio.get_running_loop()
+        compression_stats = await loop.run_in_executor(
+            None, compress_pdf_file, file_info["file_path"], output_path, quality, get_pdf_worker_pool()
+        )
+        linearized = await loop.run_in_executor(None, finalize_pdf_output, output_path, request.get("linearize"))
         
         original_size = file_info["file_size"]
         compressed_size = os.path.getsize(output_path)
@@ -1478,6 +2011,7 @@ async def compress_pdf(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": compressed_size,
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -1491,6 +2025,10 @@ async def compress_pdf(request: dict):
             "original_size": original_size,
             "compressed_size": compressed_size,
             "reduction_percent": round(reduction, 1),
+            "quality": quality,
+            "images_recompressed": compression_stats["images_recompressed"],
+            "duplicate_images": compression_stats["duplicate_images"],
+            "linearized": linearized,
             "download_url": f"/api/download/{compress_id}",
             "status": "completed"
         }
@@ -1570,6 +2108,8 @@ async def add_watermark(request: dict):
         
         with open(output_path, 'wb') as f:
             writer.write(f)
+        loop = asyncio.get_running_loop()
+        linearized = await loop.run_in_executor(None, finalize_pdf_output, output_path, request.get("linearize"))
         
         file_storage[watermark_id] = {
             "file_id": watermark_id,
@@ -1577,6 +2117,7 @@ async def add_watermark(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -1589,6 +2130,7 @@ async def add_watermark(request: dict):
             "watermarked_file": watermarked_filename,
             "watermark_text": watermark_text,
             "position": position,
+            "linearized": linearized,
             "download_url": f"/api/download/{watermark_id}",
             "status": "completed"
         }
@@ -1650,6 +2192,7 @@ async def remove_pages(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -1692,6 +2235,14 @@ async def reorder_pages(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
+        # Validate new_order against the structural index before parsing
+        if len(set(new_order)) != len(new_order):
+            raise HTTPException(status_code=400, detail="Page numbers in order must be unique")
+        
+        error = validate_page_numbers(await get_pdf_index(file_info, save_storage), new_order)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        
         from PyPDF2 import PdfReader, PdfWriter
         
         reorder_id = str(uuid.uuid4())
@@ -1702,15 +2253,7 @@ async def reorder_pages(request: dict):
         reader = PdfReader(file_info["file_path"])
         writer = PdfWriter()
         
-        total_pages = len(reader.pages)
-        
-        # Validate new_order
-        if len(set(new_order)) != len(new_order):
-            raise HTTPException(status_code=400, detail="Page numbers in order must be unique")
-        
         for page_num in new_order:
-            if page_num < 1 or page_num > total_pages:
-                raise HTTPException(status_code=400, detail=f"Invalid page number: {page_num}. PDF has {total_pages} pages.")
             writer.add_page(reader.pages[page_num - 1])
         
         with open(output_path, 'wb') as f:
@@ -1722,6 +2265,7 @@ async def reorder_pages(request: dict):
             "file_path": output_path,
             "file_type": "pdf",
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
@@ -1745,10 +2289,11 @@ async def reorder_pages(request: dict):
 
 @api_router.post("/pdf/extract-text")
 async def extract_text_from_pdf(request: dict):
-    """Extract all text from a PDF"""
+    """Extract text from a PDF, optionally only from selected pages"""
     try:
         file_id = request.get("file_id")
         output_format = request.get("format", "txt")  # "txt" or "json"
+        page_spec = request.get("pages")  # e.g. "40-55", "1-3, 10-" or [1, 2, "5-7"]
         
         if not file_id:
             raise HTTPException(status_code=400, detail="file_id is required")
@@ -1760,24 +2305,27 @@ async def extract_text_from_pdf(request: dict):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        from PyPDF2 import PdfReader
+        try:
+            selected_pages = await select_pages(file_info, page_spec, save_storage)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         extract_id = str(uuid.uuid4())
         base_name = file_info["original_name"].rsplit('.', 1)[0]
         
-        reader = PdfReader(file_info["file_path"])
-        
         pages_text = []
         full_text = ""
         
-        for i, page in enumerate(reader.pages):
-            page_text = page.extract_text() or ""
-            pages_text.append({
-                "page_number": i + 1,
-                "text": page_text,
-                "word_count": len(page_text.split())
-            })
-            full_text += page_text + "\n\n"
+        with pdf_reader_cache.reader(file_info["file_path"]) as reader:
+            # Only the selected pages' content streams are parsed
+            for page_number in selected_pages or range(1, len(reader.pages) + 1):
+                page_text = reader.pages[page_number - 1].extract_text() or ""
+                pages_text.append({
+                    "page_number": page_number,
+                    "text": page_text,
+                    "word_count": len(page_text.split())
+                })
+                full_text += page_text + "\n\n"
         
         if output_format == "json":
             output_filename = f"{base_name}_text.json"
@@ -1786,7 +2334,7 @@ async def extract_text_from_pdf(request: dict):
             with open(output_path, 'w', encoding='utf-8') as f:
                 json.dump({
                     "source_file": file_info["original_name"],
-                    "total_pages": len(reader.pages),
+                    "total_pages": len(pages_text),
                     "total_words": len(full_text.split()),
                     "pages": pages_text
                 }, f, indent=2, ensure_ascii=False)
@@ -1807,17 +2355,18 @@ async def extract_text_from_pdf(request: dict):
             "file_path": output_path,
             "file_type": file_type,
             "file_size": os.path.getsize(output_path),
+            "sha256": file_sha256(output_path),
             "upload_time": datetime.utcnow()
         }
         save_storage()
         
-        logger.info(f"PDF text extracted: {len(reader.pages)} pages, {len(full_text.split())} words")
+        logger.info(f"PDF text extracted: {len(pages_text)} pages, {len(full_text.split())} words")
         
         return {
             "extract_id": extract_id,
             "original_file": file_info["original_name"],
             "output_file": output_filename,
-            "total_pages": len(reader.pages),
+            "total_pages": len(pages_text),
             "total_words": len(full_text.split()),
             "download_url": f"/api/download/{extract_id}",
             "status": "completed"
@@ -1829,6 +2378,75 @@ async def extract_text_from_pdf(request: dict):
         logger.error(f"PDF text extraction error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"PDF text extraction failed: {str(e)}")
 
+def _page_window(total_pages: int, page_start: int, limit: Optional[int]):
+    """Validate a page_start/limit cursor and return (pages, next_page_start)"""
+    if page_start < 1 or page_start > total_pages:
+        raise HTTPException(status_code=400, detail=f"Invalid page_start: {page_start}. PDF has {total_pages} pages.")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    end = total_pages if limit is None else min(total_pages, page_start + limit - 1)
+    return list(range(page_start, end + 1)), (end + 1 if end < total_pages else None)
+
+def _extract_page_text(file_path: str, page_number: int) -> str:
+    # The reader is held per page so a long stream does not block other requests
+    with pdf_reader_cache.reader(file_path) as reader:
+        return reader.pages[page_number - 1].extract_text() or ""
+
+@api_router.get("/pdf/extract-text/{file_id}/stream")
+async def stream_pdf_text(file_id: str, page_start: int = 1, limit: Optional[int] = None, format: str = "ndjson"):
+    """Stream extracted text page by page as NDJSON or plain text"""
+    if file_id not in file_storage:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    file_info = file_storage[file_id]
+    if file_info["file_type"].lower() != "pdf":
+        raise HTTPException(status_code=400, detail="File must be a PDF")
+    if format not in ("ndjson", "text"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or text")
+    
+    pdf_index = await get_pdf_index(file_info, save_storage)
+    if pdf_index["page_count"] is None:
+        raise HTTPException(status_code=400, detail="Encrypted PDFs cannot be extracted")
+    total_pages = pdf_index["page_count"]
+    pages, next_page_start = _page_window(total_pages, page_start, limit)
+    file_path = file_info["file_path"]
+    
+    async def generate():
+        loop = asyncio.get_running_loop()
+        for page_number in pages:
+            try:
+                page_text = await loop.run_in_executor(None, _extract_page_text, file_path, page_number)
+            except Exception as e:
+                logger.error(f"Streamed extraction failed on page {page_number}: {str(e)}")
+                if format == "ndjson":
+                    yield json.dumps({"type": "error", "page_number": page_number, "error": str(e)}) + "\n"
+                return
+            if format == "ndjson":
+                yield json.dumps({
+                    "type": "page",
+                    "page_number": page_number,
+                    "text": page_text,
+                    "word_count": len(page_text.split())
+                }, ensure_ascii=False) + "\n"
+            else:
+                yield page_text + "\n\n"
+        if format == "ndjson":
+            yield json.dumps({
+                "type": "summary",
+                "pages_returned": len(pages),
+                "total_pages": total_pages,
+                "next_page_start": next_page_start
+            }) + "\n"
+    
+    headers = {"X-Total-Pages": str(total_pages)}
+    if next_page_start is not None:
+        headers["X-Next-Page-Start"] = str(next_page_start)
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson" if format == "ndjson" else "text/plain; charset=utf-8",
+        headers=headers
+    )
+
 @api_router.get("/pdf/info/{file_id}")
 async def get_pdf_info(file_id: str):
     """Get detailed information about a PDF file"""
@@ -1840,39 +2458,28 @@ async def get_pdf_info(file_id: str):
         if file_info["file_type"].lower() != "pdf":
             raise HTTPException(status_code=400, detail="File must be a PDF")
         
-        from PyPDF2 import PdfReader
-        
-        reader = PdfReader(file_info["file_path"])
+        # Served from the structural index built at upload time
+        pdf_index = await get_pdf_index(file_info, save_storage)
         
-        # Get metadata
-        metadata = reader.metadata
-        
-        # Get page info
-        pages_info = []
-        for i, page in enumerate(reader.pages):
-            media_box = page.mediabox
-            pages_info.append({
-                "page_number": i + 1,
-                "width": float(media_box.width),
-                "height": float(media_box.height),
-                "rotation": page.get("/Rotate", 0)
-            })
+        pages_info = [
+            {
+                "page_number": page["page_number"],
+                "width": page["width"],
+                "height": page["height"],
+                "rotation": page["rotation"]
+            }
+            for page in pdf_index["pages"]
+        ]
         
         return {
             "file_id": file_id,
             "filename": file_info["original_name"],
             "file_size": file_info["file_size"],
-            "total_pages": len(reader.pages),
-            "metadata": {
-                "title": metadata.get("/Title", "N/A") if metadata else "N/A",
-                "author": metadata.get("/Author", "N/A") if metadata else "N/A",
-                "subject": metadata.get("/Subject", "N/A") if metadata else "N/A",
-                "creator": metadata.get("/Creator", "N/A") if metadata else "N/A",
-                "producer": metadata.get("/Producer", "N/A") if metadata else "N/A",
-                "creation_date": str(metadata.get("/CreationDate", "N/A")) if metadata else "N/A",
-                "modification_date": str(metadata.get("/ModDate", "N/A")) if metadata else "N/A"
-            },
-            "is_encrypted": reader.is_encrypted,
+            "total_pages": pdf_index["page_count"] if pdf_index["page_count"] is not None else 0,
+            "metadata": pdf_index["metadata"],
+            "is_encrypted": pdf_index["is_encrypted"],
+            "has_text_layer": pdf_index["has_text_layer"],
+            "has_forms": pdf_index["has_forms"],
             "pages": pages_info
         }
         
@@ -1882,15 +2489,79 @@ async def get_pdf_info(file_id: str):
         logger.error(f"PDF info error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get PDF info: {str(e)}")
 
+@api_router.get("/pdf/render/{file_id}/{page}")
+async def render_pdf_page(file_id: str, page: int, scale: str = "1x", format: str = "png",
+                          tile_size: Optional[int] = None, tile_x: int = 0, tile_y: int = 0, prefetch: int = 2):
+    """Render one PDF page (or one tile of it) as an image for the viewer"""
+    try:
+        if file_id not in file_storage:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        file_info = file_storage[file_id]
+        if file_info["file_type"].lower() != "pdf":
+            raise HTTPException(status_code=400, detail="File must be a PDF")
+        
+        render_scale = parse_scale(scale)
+        if render_scale is None:
+            raise HTTPException(status_code=400, detail=f"Invalid scale: {scale}. Use thumbnail, 1x, 2x or 0.1-4.0")
+        if format not in RENDER_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid format: {format}. Use png or jpeg")
+        if tile_size is not None and not 64 <= tile_size <= 2048:
+            raise HTTPException(status_code=400, detail="tile_size must be between 64 and 2048")
+        if tile_x < 0 or tile_y < 0:
+            raise HTTPException(status_code=400, detail="tile_x and tile_y must not be negative")
+        
+        # Page bounds come from the structural index, so the document is never parsed here
+        pdf_index = await get_pdf_index(file_info, save_storage)
+        if pdf_index["page_count"] is None:
+            raise HTTPException(status_code=400, detail="Encrypted PDFs cannot be rendered")
+        error = validate_page_numbers(pdf_index, [page])
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        
+        loop = asyncio.get_running_loop()
+        file_path = file_info["file_path"]
+        try:
+            if tile_size is None:
+                data, cache_hit = await loop.run_in_executor(
+                    None, page_render_cache.page_image, file_path, page, render_scale, format
+                )
+            else:
+                data, cache_hit = await loop.run_in_executor(
+                    None, page_render_cache.tile_image, file_path, page, render_scale, format, tile_size, tile_x, tile_y
+                )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Warm the cache for the pages the viewer is likely to show next; tiles are cut from PNG renders
+        neighbours = [p for p in range(page - 1, page + max(0, min(prefetch, 10)) + 1)
+                      if p != page and 1 <= p <= pdf_index["page_count"]]
+        page_render_cache.prefetch(file_path, neighbours, render_scale, format if tile_size is None else "png")
+        
+        return Response(
+            content=data,
+            media_type=RENDER_FORMATS[format][1],
+            headers={
+                "Cache-Control": "private, max-age=3600",
+                "X-Render-Cache": "hit" if cache_hit else "miss"
+            }
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"PDF render error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to render page: {str(e)}")
+
 # Include the router in the main app
 app.include_router(api_router)
 
 # Initialize and include new routers
-init_annotation_routes(annotation_storage, file_storage, CONVERSIONS_DIR, save_storage)
+init_annotation_routes(annotation_store, file_storage, CONVERSIONS_DIR, save_storage)
 init_pdf_forms_routes(file_storage, PDF_OPERATIONS_DIR, save_storage)
 init_dashboard_routes(postgres_db, file_storage)
 init_ocr_routes(file_storage, CONVERSIONS_DIR, save_storage)
-init_version_routes(file_storage, CONVERSIONS_DIR, save_storage)
+init_version_routes(file_storage, CONVERSIONS_DIR, save_storage, extract_comparison_text, index_similarity_in_background)
 init_auth_routes(postgres_db)
 
 app.include_router(annotations_router, prefix="/api", tags=["Annotations"])
@@ -1920,10 +2591,17 @@ async def startup_event():
     await postgres_db.connect()
     # Start file cleanup task
     asyncio.create_task(cleanup_old_files())
+    # Expire and compact document versions per the retention policy
+    asyncio.create_task(run_version_retention())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     # Close MongoDB connection
     client.close()
+    # Stop PDF worker processes and page prefetching
+    shutdown_pdf_worker_pool()
+    page_render_cache.shutdown()
+    # Write out queued annotation changes
+    annotation_store.close()
     # Close PostgreSQL connection
     await postgres_db.disconnect()
\ No newline at end of file
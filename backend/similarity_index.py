@@ -0,0 +1,140 @@
+"""
+Near-duplicate detection across uploaded documents - MinHash signatures of word
+shingles kept in a banded LSH table, so lookups only touch colliding buckets
+"""
+import os
+import re
+import zlib
+import base64
+import logging
+import threading
+from typing import Dict, Any, List, Optional, Set, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MINHASH_PERMUTATIONS = int(os.environ.get("MINHASH_PERMUTATIONS", "128"))
+# Bands x rows must equal the permutation count; 32 x 4 catches pairs above ~0.4 Jaccard
+LSH_BANDS = int(os.environ.get("LSH_BANDS", "32"))
+SIMILARITY_SHINGLE_WORDS = int(os.environ.get("SIMILARITY_SHINGLE_WORDS", "5"))
+DEFAULT_MIN_SIMILARITY = 0.5
+
+# Largest prime below 2**32: (a * x + b) % p with a, b, x < p never overflows uint64
+_PRIME = np.uint64(4294967291)
+_WORDS = re.compile(r"\w+")
+
+# Fixed seed: signatures are persisted on file records and must stay comparable across restarts
+_random = np.random.RandomState(20240601)
+_PERM_A = _random.randint(1, int(_PRIME), size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _random.randint(0, int(_PRIME), size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def shingle_ids(text: str, size: int = SIMILARITY_SHINGLE_WORDS) -> np.ndarray:
+    """Distinct ids (below the hashing prime) of every run of `size` consecutive words"""
+    words = _WORDS.findall(text.lower())
+    if len(words) < size:
+        shingles = {" ".join(words)} if words else set()
+    else:
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    ids = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ids % _PRIME
+
+
+def minhash_signature(text: str) -> Optional[np.ndarray]:
+    """MinHash signature of a text's shingles, or None for text without words"""
+    ids = shingle_ids(text)
+    if not len(ids):
+        return None
+    signature = np.empty(MINHASH_PERMUTATIONS, dtype=np.uint32)
+    # One universal hash (a * x + b) mod p per permutation, over bounded chunks of shingles
+    for start in range(0, len(ids), 4096):
+        chunk = ids[start:start + 4096]
+        hashed = ((np.outer(_PERM_A, chunk) + _PERM_B[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+        signature = hashed if start == 0 else np.minimum(signature, hashed)
+    return signature
+
+
+def encode_signature(signature: np.ndarray) -> str:
+    return base64.b64encode(signature.astype("<u4").tobytes()).decode("ascii")
+
+
+def decode_signature(encoded: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(encoded), dtype="<u4").astype(np.uint32)
+
+
+def estimate_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.count_nonzero(a == b)) / len(a)
+
+
+class MinHashLSH:
+    """Banded LSH over MinHash signatures; documents sharing any band bucket are candidates"""
+
+    def __init__(self, bands: int = LSH_BANDS, permutations: int = MINHASH_PERMUTATIONS):
+        if permutations % bands:
+            raise ValueError("MINHASH_PERMUTATIONS must be a multiple of LSH_BANDS")
+        self.bands = bands
+        self.rows = permutations // bands
+        self._buckets: List[Dict[bytes, Set[str]]] = [{} for _ in range(bands)]
+        self._signatures: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, key: str, signature: np.ndarray):
+        with self._lock:
+            self._remove(key)
+            self._signatures[key] = signature
+            for band, band_key in enumerate(self._band_keys(signature)):
+                self._buckets[band].setdefault(band_key, set()).add(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band, band_key in enumerate(self._band_keys(signature)):
+            bucket = self._buckets[band].get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+
+    def signature(self, key: str) -> Optional[np.ndarray]:
+        return self._signatures.get(key)
+
+    def query(self, signature: np.ndarray, min_similarity: float = DEFAULT_MIN_SIMILARITY,
+              limit: int = 20, exclude: Optional[str] = None) -> Tuple[List[Tuple[str, float]], int]:
+        """(key, estimated Jaccard) pairs above min_similarity, best first, and the candidate count"""
+        with self._lock:
+            candidates: Set[str] = set()
+            for band, band_key in enumerate(self._band_keys(signature)):
+                candidates.update(self._buckets[band].get(band_key, ()))
+            candidates.discard(exclude)
+            scored = [(key, estimate_jaccard(signature, self._signatures[key])) for key in candidates]
+        scored = [(key, round(score, 3)) for key, score in scored if score >= min_similarity]
+        scored.sort(key=lambda item: -item[1])
+        return scored[:limit], len(candidates)
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def load(self, file_storage: Dict[str, Dict[str, Any]]):
+        """Rebuild the table from signatures persisted on file records"""
+        loaded = 0
+        for file_id, file_info in file_storage.items():
+            encoded = file_info.get("minhash")
+            if encoded:
+                try:
+                    self.add(file_id, decode_signature(encoded))
+                    loaded += 1
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable MinHash signature for {file_id}: {e}")
+        if loaded:
+            logger.info(f"Loaded {loaded} MinHash signatures into the similarity index")
+
+
+similarity_index = MinHashLSH()
@@ -0,0 +1,104 @@
+"""
+Benchmark the /api/compare diff engine on synthetic 10k-100k line contracts
+
+Run from backend/:  python tests/benchmark_document_diff.py [--sizes 10000 50000 100000] [--mode clauses] [--difflib]
+"""
+import os
+import sys
+import time
+import random
+import difflib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_diff import diff_documents  # noqa: E402
+from clause_diff import ClauseIndex, diff_clauses  # noqa: E402
+
+WORDS = ("party", "agreement", "shall", "pursuant", "to", "the", "obligations", "herein", "term",
+         "notice", "indemnify", "liability", "confidential", "section", "provided", "that", "any")
+
+
+def make_contract(lines: int, rng: random.Random):
+    """Sections of numbered sub-clauses; a wide vocabulary keeps clauses distinguishable"""
+    vocabulary = WORDS + tuple(
+        "".join(rng.choice("bcdfghklmnprstvw") + rng.choice("aeiou") for _ in range(rng.randint(2, 4)))
+        for _ in range(3000)
+    )
+    text = []
+    for number in range(lines):
+        section, line = divmod(number, 40)
+        if line == 0:
+            text.append(f"Section {section + 1}.")
+        elif line == 39:
+            text.append("")
+        else:
+            prefix = f"{section + 1}.{line // 4 + 1} " if line % 4 == 1 else ""
+            text.append(prefix + " ".join(rng.choice(vocabulary) for _ in range(rng.randint(6, 14))) + ".")
+    return text
+
+
+def move_sections(lines, rng: random.Random, moves: int):
+    """Cut whole sections and paste them elsewhere, as contract redlines often do"""
+    sections = [lines[start:start + 40] for start in range(0, len(lines), 40)]
+    for _ in range(moves):
+        section = sections.pop(rng.randrange(len(sections)))
+        sections.insert(rng.randrange(len(sections) + 1), section)
+    return [line for section in sections for line in section]
+
+
+def edit_contract(lines, rng: random.Random, edit_rate: float):
+    edited = list(lines)
+    for _ in range(int(len(lines) * edit_rate)):
+        position = rng.randrange(len(edited))
+        action = rng.random()
+        if action < 0.5:
+            words = edited[position].split()
+            if words:
+                words[rng.randrange(len(words))] = rng.choice(WORDS)
+                edited[position] = " ".join(words)
+        elif action < 0.75:
+            edited.insert(position, "The parties further agree to the amended term.")
+        else:
+            del edited[position]
+    return edited
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000])
+    parser.add_argument("--edit-rate", type=float, default=0.01)
+    parser.add_argument("--granularity", default="word")
+    parser.add_argument("--mode", choices=("lines", "clauses"), default="lines")
+    parser.add_argument("--moves", type=int, default=5, help="sections moved in clauses mode")
+    parser.add_argument("--difflib", action="store_true", help="also time the old difflib.Differ comparison")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'lines':>8} {'engine s':>9} {'changes':>8} {'mods':>6}" + (f" {'difflib s':>10}" if args.difflib else ""))
+    for size in args.sizes:
+        original = make_contract(size, rng)
+        modified = edit_contract(original, rng, args.edit_rate)
+        if args.mode == "clauses":
+            modified = move_sections(modified, rng, args.moves)
+        original_text, modified_text = "\n".join(original), "\n".join(modified)
+
+        start = time.perf_counter()
+        if args.mode == "clauses":
+            result = diff_clauses(ClauseIndex(original_text), ClauseIndex(modified_text), args.granularity)
+        else:
+            result = diff_documents(original_text, modified_text, args.granularity)
+        elapsed = time.perf_counter() - start
+        row = f"{size:>8} {elapsed:>9.3f} {len(result['changes']):>8} {result['differences']['modifications']:>6}"
+        if args.mode == "clauses":
+            row += f" moves={result['differences']['moves']}"
+
+        if args.difflib:
+            start = time.perf_counter()
+            list(difflib.Differ().compare(original, modified))
+            row += f" {time.perf_counter() - start:>10.3f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
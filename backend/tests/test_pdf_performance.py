@@ -0,0 +1,1547 @@
+"""
+Test PDF performance features: structural index backed PDF info and page validation
+"""
+import pytest
+import requests
+import os
+import io
+import sys
+import shutil
+
+# Some classes test backend modules in-process rather than over HTTP
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://legal-converter-pro.preview.emergentagent.com').rstrip('/')
+
+
+def make_test_pdf(pages=3, text="Test page"):
+    """Create a small multi-page PDF in memory"""
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    for i in range(pages):
+        c.drawString(100, 750, f"{text} {i + 1}")
+        c.showPage()
+    c.save()
+    buffer.seek(0)
+    return buffer
+
+
+def upload_pdf(name="perf_test.pdf", pages=3, text="Test page"):
+    """Upload a generated PDF and return the response data"""
+    files = {"file": (name, make_test_pdf(pages, text), "application/pdf")}
+    response = requests.post(f"{BASE_URL}/api/upload", files=files)
+    print(f"Upload response: {response.status_code}")
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+def upload_text(name, text):
+    """Upload a plain-text document and return the response data"""
+    files = {"file": (name, io.BytesIO(text.encode("utf-8")), "text/plain")}
+    response = requests.post(f"{BASE_URL}/api/upload", files=files)
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+class TestPDFStructuralIndex:
+    """Test /api/pdf/info and page validation served from the structural index"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(pages=4)
+
+    def test_pdf_info_from_index(self, uploaded_pdf):
+        """Test PDF info reports page count, boxes and text layer"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/pdf/info/{uploaded_pdf['file_id']}")
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["total_pages"] == 4
+        assert len(data["pages"]) == 4
+        assert data["pages"][0]["width"] == 612
+        assert data["has_text_layer"] is True
+        assert data["has_forms"] is False
+        assert data["is_encrypted"] is False
+        print(f"PDF info: {data['total_pages']} pages")
+
+    def test_stale_index_is_rebuilt_and_saved(self, tmp_path):
+        """Test a missing or stale index is rebuilt once and persisted, a current one is reused"""
+        import asyncio
+        from pdf_index import get_pdf_index
+
+        path = tmp_path / "indexed.pdf"
+        path.write_bytes(make_test_pdf(pages=2).getvalue())
+        file_info = {"file_path": str(path)}
+        saves = []
+
+        index = asyncio.run(get_pdf_index(file_info, lambda: saves.append(1)))
+        assert index["page_count"] == 2
+        assert file_info["pdf_index"] is index
+        assert asyncio.run(get_pdf_index(file_info, lambda: saves.append(1))) is index
+        assert len(saves) == 1
+
+        path.write_bytes(make_test_pdf(pages=5).getvalue())
+        assert asyncio.run(get_pdf_index(file_info, lambda: saves.append(1)))["page_count"] == 5
+        assert len(saves) == 2
+
+    def test_reorder_rejects_out_of_range_page(self, uploaded_pdf):
+        """Test reorder validates page numbers against the index"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/reorder", json={
+            "file_id": uploaded_pdf["file_id"],
+            "order": [1, 9]
+        })
+        assert response.status_code == 400
+        assert "PDF has 4 pages" in response.json()["detail"]
+
+    def test_rotate_rejects_out_of_range_page(self, uploaded_pdf):
+        """Test rotate validates page numbers against the index"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/rotate", json={
+            "file_id": uploaded_pdf["file_id"],
+            "rotation": 90,
+            "pages": [5]
+        })
+        assert response.status_code == 400
+
+    def test_split_rejects_out_of_range_start(self, uploaded_pdf):
+        """Test split validates range starts against the index"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/split", json={
+            "file_id": uploaded_pdf["file_id"],
+            "split_type": "ranges",
+            "page_ranges": [{"start": 7, "end": 8}]
+        })
+        assert response.status_code == 400
+
+
+class TestPdfReaderCache:
+    """Test the shared PdfReader cache in-process: hits, stamp invalidation and eviction"""
+
+    @staticmethod
+    def write_pdf(path, pages):
+        with open(path, "wb") as f:
+            f.write(make_test_pdf(pages=pages).getvalue())
+
+    def test_repeat_reads_hit_the_cache(self, tmp_path):
+        """Test a second read of an unchanged file reuses the parsed reader"""
+        from pdf_cache import PdfReaderCache
+
+        cache = PdfReaderCache()
+        path = str(tmp_path / "cached.pdf")
+        self.write_pdf(path, 2)
+        with cache.reader(path) as first:
+            assert len(first.pages) == 2
+        with cache.reader(path) as second:
+            assert second is first
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_changed_file_is_parsed_again(self, tmp_path):
+        """Test a new mtime or size makes the cached reader stale"""
+        from pdf_cache import PdfReaderCache
+
+        cache = PdfReaderCache()
+        path = str(tmp_path / "changing.pdf")
+        self.write_pdf(path, 2)
+        with cache.reader(path) as reader:
+            assert len(reader.pages) == 2
+        self.write_pdf(path, 5)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        with cache.reader(path) as reader:
+            assert len(reader.pages) == 5
+        assert cache.stats()["entries"] == 1
+
+    def test_invalidate_after_revert(self, tmp_path):
+        """Test invalidate drops a reader whose file was swapped without changing its stamp"""
+        from pdf_cache import PdfReaderCache
+
+        cache = PdfReaderCache()
+        path = str(tmp_path / "current.pdf")
+        current = make_test_pdf(pages=1, text="Current").getvalue()
+        earlier = make_test_pdf(pages=1, text="Earlier").getvalue()
+        # A revert clones an earlier snapshot over the file; make it carry the same (mtime, size)
+        size = max(len(current), len(earlier))
+        with open(path, "wb") as f:
+            f.write(current.ljust(size, b"\n"))
+        with cache.reader(path) as reader:
+            assert "Current" in reader.pages[0].extract_text()
+        stamp = os.stat(path)
+        with open(path, "wb") as f:
+            f.write(earlier.ljust(size, b"\n"))
+        os.utime(path, ns=(stamp.st_atime_ns, stamp.st_mtime_ns))
+
+        with cache.reader(path) as stale:
+            assert "Current" in stale.pages[0].extract_text()
+        cache.invalidate(path)
+        with cache.reader(path) as fresh:
+            assert "Earlier" in fresh.pages[0].extract_text()
+
+    def test_least_recently_used_is_evicted(self, tmp_path):
+        """Test the entry and byte bounds evict the least recently used reader first"""
+        from pdf_cache import PdfReaderCache
+
+        cache = PdfReaderCache(max_entries=2)
+        paths = [str(tmp_path / f"doc{i}.pdf") for i in range(3)]
+        for path in paths:
+            self.write_pdf(path, 1)
+        with cache.reader(paths[0]):
+            pass
+        with cache.reader(paths[1]):
+            pass
+        with cache.reader(paths[0]):
+            pass
+        with cache.reader(paths[2]):
+            pass
+        assert cache.stats()["entries"] == 2
+        with cache.reader(paths[0]):
+            pass
+        assert cache.stats()["hits"] == 2
+        with cache.reader(paths[1]):
+            pass
+        assert cache.stats()["misses"] == 4
+
+        small = PdfReaderCache(max_bytes=os.path.getsize(paths[0]) * 3)
+        for path in paths:
+            with small.reader(path):
+                pass
+        assert small.stats()["entries"] == 1
+        assert small.stats()["estimated_bytes"] <= small.max_bytes
+
+
+class TestPDFCompression:
+    """Test image-aware /api/pdf/compress quality profiles"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(name="compress_test.pdf", pages=2)
+
+    def test_compress_rejects_unknown_quality(self, uploaded_pdf):
+        """Test compress validates the quality profile"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/compress", json={
+            "file_id": uploaded_pdf["file_id"],
+            "quality": "ultra"
+        })
+        assert response.status_code == 400
+
+    def test_compress_never_grows_file(self, uploaded_pdf):
+        """Test compress reports stats and does not inflate text-only PDFs"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/compress", json={
+            "file_id": uploaded_pdf["file_id"],
+            "quality": "low"
+        })
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["quality"] == "low"
+        assert data["compressed_size"] <= data["original_size"]
+        assert "images_recompressed" in data
+        print(f"Compression: {data['reduction_percent']}% reduction")
+
+    @staticmethod
+    def make_shared_resources_pdf():
+        """Two pages drawing different images from one shared XObject dict that also holds an unused image"""
+        import numpy as np
+        from PIL import Image
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.utils import ImageReader
+        from PyPDF2 import PdfReader, PdfWriter
+        from PyPDF2.generic import NameObject, DictionaryObject
+
+        noise = np.random.RandomState(7)
+        buffer = io.BytesIO()
+        c = canvas.Canvas(buffer)
+        for _ in range(3):
+            image = Image.fromarray(noise.randint(0, 255, (300, 300, 3), dtype=np.uint8))
+            c.drawImage(ImageReader(image), 50, 300, 300, 300)
+            c.showPage()
+        c.save()
+
+        reader = PdfReader(io.BytesIO(buffer.getvalue()))
+        writer = PdfWriter()
+        for page in reader.pages[:2]:
+            writer.add_page(page)
+        shared = DictionaryObject()
+        for page in writer.pages:
+            xobjects = page["/Resources"]["/XObject"]
+            for name in xobjects:
+                shared[name] = xobjects.raw_get(name)
+        unused = reader.pages[2]["/Resources"]["/XObject"]
+        for name in unused:
+            shared[name] = writer._add_object(unused[name])
+        shared_ref = writer._add_object(shared)
+        for page in writer.pages:
+            page["/Resources"][NameObject("/XObject")] = shared_ref
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+
+    def test_shared_xobjects_survive_pruning(self, tmp_path):
+        """Test images one page paints are kept when another page shares its resources"""
+        import re
+        from PyPDF2 import PdfReader
+        from pdf_compressor import compress_pdf_file
+
+        input_path, output_path = str(tmp_path / "shared.pdf"), str(tmp_path / "shared_compressed.pdf")
+        with open(input_path, "wb") as f:
+            f.write(self.make_shared_resources_pdf())
+
+        stats = compress_pdf_file(input_path, output_path, "low")
+        assert stats["unused_images_removed"] == 1
+        assert stats["images_found"] == 2
+
+        painted = set()
+        for page in PdfReader(output_path).pages:
+            xobjects = page["/Resources"]["/XObject"].get_object()
+            names = {"/" + n.decode() for n in re.findall(rb"/(\S+)\s+Do", page.get_contents().get_data())}
+            assert names and names <= set(xobjects)
+            for name in names:
+                assert xobjects[name].get_data()
+            painted |= names
+        assert len(painted) == 2
+        assert len(xobjects) == 2
+
+
+class TestIncrementalUpdates:
+    """Test eSign saves as an incremental update over the original bytes"""
+
+    def test_esign_appends_to_original(self):
+        """Test the signed PDF starts with the unmodified original"""
+        original = make_test_pdf(pages=2, text="Agreement").getvalue()
+        files = {"file": ("incremental_test.pdf", io.BytesIO(original), "application/pdf")}
+        upload = requests.post(f"{BASE_URL}/api/upload", files=files)
+        if upload.status_code != 200:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/esign", json={
+            "file_id": upload.json()["file_id"],
+            "position": {"page": 2, "x": 100, "y": 100},
+            "signer_info": {"name": "Jane Smith", "date": "2024-01-01"}
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["incremental_update"] is True
+
+        download = requests.get(f"{BASE_URL}{data['download_url']}")
+        assert download.status_code == 200
+        assert download.content.startswith(original)
+        assert len(download.content) > len(original)
+
+
+class TestBulkESign:
+    """Test /api/pdf/esign/bulk jobs and real verification hashes"""
+
+    def test_bulk_esign_job(self):
+        """Test a bulk job signs every PDF and reports per-file SHA-256"""
+        import time
+        import hashlib
+
+        uploads = [upload_pdf(name=f"bulk_{i}.pdf", pages=1) for i in range(3)]
+        if not all(uploads):
+            pytest.skip("PDF upload failed")
+
+        file_ids = [u["file_id"] for u in uploads] + ["missing-file"]
+        response = requests.post(f"{BASE_URL}/api/pdf/esign/bulk", json={
+            "file_ids": file_ids,
+            "signer_info": {"name": "Jane Smith", "date": "2024-01-01"},
+            "signatures": {file_ids[0]: {"signer_info": {"name": "John Doe"}}}
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 4
+        assert data["distinct_signatures"] == 2
+
+        for _ in range(60):
+            job = requests.get(f"{BASE_URL}{data['status_url']}").json()
+            if job["finished_at"]:
+                break
+            time.sleep(0.5)
+
+        assert job["status"] == "completed"
+        assert job["succeeded"] == 3
+        assert job["failed"] == 1
+
+        signed = next(r for r in job["results"] if r["status"] == "success")
+        download = requests.get(f"{BASE_URL}{signed['download_url']}")
+        assert hashlib.sha256(download.content).hexdigest() == signed["signature_verification"]
+
+    def test_bulk_esign_requires_files(self):
+        """Test bulk eSign rejects an empty file list"""
+        response = requests.post(f"{BASE_URL}/api/pdf/esign/bulk", json={"file_ids": []})
+        assert response.status_code == 400
+
+
+def decrypted_page_texts(content, password):
+    """Open an encrypted PDF with its user password and return each page's text"""
+    from PyPDF2 import PdfReader
+
+    reader = PdfReader(io.BytesIO(content))
+    assert reader.is_encrypted
+    assert reader.decrypt(password)
+    return [page.extract_text() for page in reader.pages]
+
+
+class TestBatchEncryption:
+    """Test AES-256 encryption and /api/pdf/encrypt/batch jobs"""
+
+    def test_encrypt_uses_aes256(self):
+        """Test single-file encryption writes an AES-256 security handler"""
+        uploaded = upload_pdf(name="encrypt_single.pdf", pages=2)
+        if not uploaded:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/encrypt", json={
+            "file_id": uploaded["file_id"],
+            "password": "secret"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["encryption"] == "AES-256"
+
+        download = requests.get(f"{BASE_URL}{data['download_url']}")
+        assert download.content.startswith(b"%PDF")
+        assert b"/AESV3" in download.content
+        texts = decrypted_page_texts(download.content, "secret")
+        assert ["Test page 1" in texts[0], "Test page 2" in texts[1]] == [True, True]
+
+    def test_batch_encrypt_job(self):
+        """Test a batch job encrypts every PDF and reports per-file progress"""
+        import time
+
+        uploads = [upload_pdf(name=f"encrypt_batch_{i}.pdf", pages=2) for i in range(3)]
+        if not all(uploads):
+            pytest.skip("PDF upload failed")
+
+        file_ids = [u["file_id"] for u in uploads] + ["missing-file"]
+        response = requests.post(f"{BASE_URL}/api/pdf/encrypt/batch", json={
+            "file_ids": file_ids,
+            "password": "secret",
+            "passwords": {file_ids[0]: "other-secret"}
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 4
+        assert data["encryption"] == "AES-256"
+
+        for _ in range(60):
+            job = requests.get(f"{BASE_URL}{data['status_url']}").json()
+            if job["finished_at"]:
+                break
+            time.sleep(0.5)
+
+        assert job["status"] == "completed"
+        assert job["succeeded"] == 3
+        assert job["failed"] == 1
+        assert job["progress"] == 100.0
+
+        encrypted = next(r for r in job["results"] if r["status"] == "success")
+        download = requests.get(f"{BASE_URL}{encrypted['download_url']}")
+        assert len(download.content) == encrypted["file_size"]
+        assert b"/AESV3" in download.content
+        password = "other-secret" if encrypted["file_id"] == file_ids[0] else "secret"
+        assert "Test page 1" in decrypted_page_texts(download.content, password)[0]
+
+    def test_batch_encrypt_requires_files(self):
+        """Test batch encryption rejects an empty file list"""
+        response = requests.post(f"{BASE_URL}/api/pdf/encrypt/batch", json={"file_ids": [], "password": "secret"})
+        assert response.status_code == 400
+
+
+class TestPageRender:
+    """Test /api/pdf/render request validation"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(name="render_test.pdf", pages=3)
+
+    def test_render_rejects_out_of_range_page(self, uploaded_pdf):
+        """Test render validates the page against the index"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/pdf/render/{uploaded_pdf['file_id']}/4")
+        assert response.status_code == 400
+        assert "PDF has 3 pages" in response.json()["detail"]
+
+    def test_render_rejects_invalid_scale(self, uploaded_pdf):
+        """Test render rejects scales outside the supported range"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/pdf/render/{uploaded_pdf['file_id']}/1", params={"scale": "12"})
+        assert response.status_code == 400
+
+    def test_render_unknown_file(self):
+        """Test render returns 404 for unknown files"""
+        response = requests.get(f"{BASE_URL}/api/pdf/render/does-not-exist/1")
+        assert response.status_code == 404
+
+    def test_render_rejects_negative_tile(self, uploaded_pdf):
+        """Test tile coordinates must not be negative"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/pdf/render/{uploaded_pdf['file_id']}/1",
+                                params={"tile_size": 256, "tile_x": -1, "tile_y": 0})
+        assert response.status_code == 400
+
+    @pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="poppler is not installed")
+    def test_render_page_and_tile(self, uploaded_pdf):
+        """Test a page renders at the requested scale, is cached, and tiles are clipped at the edge"""
+        from PIL import Image
+
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+        url = f"{BASE_URL}/api/pdf/render/{uploaded_pdf['file_id']}/2"
+
+        first = requests.get(url, params={"scale": "1x", "prefetch": 0})
+        assert first.status_code == 200
+        assert first.headers["content-type"] == "image/png"
+        with Image.open(io.BytesIO(first.content)) as page:
+            assert page.size == (612, 792)
+        again = requests.get(url, params={"scale": "1x", "prefetch": 0})
+        assert again.headers["X-Render-Cache"] == "hit"
+        assert again.content == first.content
+
+        tile = requests.get(url, params={"scale": "1x", "format": "jpeg", "tile_size": 512, "tile_x": 1, "tile_y": 1})
+        assert tile.status_code == 200
+        assert tile.headers["content-type"] == "image/jpeg"
+        with Image.open(io.BytesIO(tile.content)) as image:
+            assert image.size == (612 - 512, 792 - 512)
+        outside = requests.get(url, params={"tile_size": 512, "tile_x": 2, "tile_y": 0})
+        assert outside.status_code == 400
+
+
+class TestRangeDownloads:
+    """Test byte-range downloads used with linearized PDFs"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(name="range_test.pdf", pages=2)
+
+    def test_full_download_advertises_ranges(self, uploaded_pdf):
+        """Test plain downloads advertise byte-range support"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/download/{uploaded_pdf['file_id']}")
+        assert response.status_code == 200
+        assert response.headers["accept-ranges"] == "bytes"
+        assert response.content.startswith(b"%PDF")
+
+    def test_partial_download(self, uploaded_pdf):
+        """Test a byte range returns 206 with the requested slice"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        url = f"{BASE_URL}/api/download/{uploaded_pdf['file_id']}"
+        full = requests.get(url).content
+
+        response = requests.get(url, headers={"Range": "bytes=0-99"})
+        assert response.status_code == 206
+        assert response.content == full[:100]
+        assert response.headers["content-range"] == f"bytes 0-99/{len(full)}"
+
+        response = requests.get(url, headers={"Range": "bytes=-50"})
+        assert response.status_code == 206
+        assert response.content == full[-50:]
+
+    def test_unsatisfiable_range(self, uploaded_pdf):
+        """Test a range past the end returns 416"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(
+            f"{BASE_URL}/api/download/{uploaded_pdf['file_id']}",
+            headers={"Range": "bytes=99999999-"}
+        )
+        assert response.status_code == 416
+
+
+class TestPageRanges:
+    """Test the pages parameter on extraction and conversion"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(name="ranges_test.pdf", pages=6, text="Transcript page")
+
+    def test_extract_text_page_range(self, uploaded_pdf):
+        """Test extract-text only returns the selected pages"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/extract-text", json={
+            "file_id": uploaded_pdf["file_id"],
+            "format": "json",
+            "pages": "2-3, 6"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total_pages"] == 3
+
+        content = requests.get(f"{BASE_URL}{data['download_url']}").json()
+        assert [p["page_number"] for p in content["pages"]] == [2, 3, 6]
+        assert "Transcript page 6" in content["pages"][2]["text"]
+
+    def test_extract_text_rejects_bad_range(self, uploaded_pdf):
+        """Test extract-text validates the range against the page count"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/pdf/extract-text", json={
+            "file_id": uploaded_pdf["file_id"],
+            "pages": "5-9"
+        })
+        assert response.status_code == 400
+        assert "PDF has 6 pages" in response.json()["detail"]
+
+    def test_convert_open_ended_range(self, uploaded_pdf):
+        """Test conversion honours an open-ended page range"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/convert", json={
+            "file_id": uploaded_pdf["file_id"],
+            "target_format": "txt",
+            "pages": "5-"
+        })
+        assert response.status_code == 200
+
+        text = requests.get(f"{BASE_URL}{response.json()['download_url']}").text
+        assert "Transcript page 5" in text
+        assert "Transcript page 6" in text
+        assert "Transcript page 4" not in text
+
+
+class TestStreamedExtraction:
+    """Test NDJSON streamed, cursor-paginated text extraction"""
+
+    @pytest.fixture(scope="class")
+    def uploaded_pdf(self):
+        return upload_pdf(name="stream_test.pdf", pages=5, text="Streamed page")
+
+    def test_stream_ndjson_window(self, uploaded_pdf):
+        """Test a page window streams one line per page plus a cursor"""
+        import json
+
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(
+            f"{BASE_URL}/api/pdf/extract-text/{uploaded_pdf['file_id']}/stream",
+            params={"page_start": 2, "limit": 2},
+            stream=True
+        )
+        assert response.status_code == 200
+        assert response.headers["x-next-page-start"] == "4"
+
+        records = [json.loads(line) for line in response.iter_lines() if line]
+        assert [r["page_number"] for r in records if r["type"] == "page"] == [2, 3]
+        assert "Streamed page 2" in records[0]["text"]
+        assert records[-1] == {"type": "summary", "pages_returned": 2, "total_pages": 5, "next_page_start": 4}
+
+    def test_stream_plain_text_to_end(self, uploaded_pdf):
+        """Test plain text streaming of the last pages has no next cursor"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(
+            f"{BASE_URL}/api/pdf/extract-text/{uploaded_pdf['file_id']}/stream",
+            params={"page_start": 4, "format": "text"}
+        )
+        assert response.status_code == 200
+        assert "x-next-page-start" not in response.headers
+        assert "Streamed page 4" in response.text
+        assert "Streamed page 5" in response.text
+        assert "Streamed page 3" not in response.text
+
+    def test_stream_rejects_bad_cursor(self, uploaded_pdf):
+        """Test page_start outside the document is rejected"""
+        if not uploaded_pdf:
+            pytest.skip("PDF upload failed")
+
+        response = requests.get(
+            f"{BASE_URL}/api/pdf/extract-text/{uploaded_pdf['file_id']}/stream",
+            params={"page_start": 6}
+        )
+        assert response.status_code == 400
+
+
+class TestDocumentCompare:
+    """Test /api/compare hunk pairing, word-level refinement and pagination"""
+
+    @pytest.fixture(scope="class")
+    def compared_pair(self):
+        original = [f"Clause {i}: the Buyer shall pay within 30 days." for i in range(120)]
+        modified = list(original)
+        for i in range(0, 120, 4):
+            modified[i] = f"Clause {i}: the Purchaser shall pay within 45 days."
+        modified.insert(60, "Clause 60a: a new obligation.")
+        original_upload = upload_text("compare_original.txt", "\n".join(original))
+        modified_upload = upload_text("compare_modified.txt", "\n".join(modified))
+        if not original_upload or not modified_upload:
+            return None
+        return original_upload["file_id"], modified_upload["file_id"]
+
+    def test_compare_pairs_modifications(self, compared_pair):
+        """Test replaced lines are counted as modifications with word segments"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": compared_pair[0],
+            "modified_file_id": compared_pair[1],
+            "limit": 10
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["differences"]["modifications"] == 30
+        assert data["differences"]["insertions"] == 1
+        assert data["differences"]["deletions"] == 0
+
+        modification = next(c for c in data["changes"] if c["type"] == "modification")
+        assert {"op": "delete", "text": "Buyer"} in modification["segments"]
+        assert {"op": "insert", "text": "Purchaser"} in modification["segments"]
+
+    def test_compare_changes_are_paginated(self, compared_pair):
+        """Test the full change list can be paged through"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        data = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": compared_pair[0],
+            "modified_file_id": compared_pair[1],
+            "limit": 10
+        }).json()
+        assert len(data["changes"]) == 10
+        total = data["pagination"]["total"]
+        assert total > 10
+
+        collected = list(data["changes"])
+        offset = data["pagination"]["next_offset"]
+        while offset is not None:
+            page = requests.get(f"{BASE_URL}{data['changes_url']}", params={"offset": offset, "limit": 10}).json()
+            collected.extend(page["changes"])
+            offset = page["pagination"]["next_offset"]
+        assert len(collected) == total
+
+    def test_compare_rejects_invalid_granularity(self, compared_pair):
+        """Test granularity is validated"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": compared_pair[0],
+            "modified_file_id": compared_pair[1],
+            "granularity": "sentence"
+        })
+        assert response.status_code == 400
+
+    def test_compare_rejects_non_integer_limit(self, compared_pair):
+        """Test a limit that is not an integer is a client error"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        for limit in ("ten", None, 0):
+            response = requests.post(f"{BASE_URL}/api/compare", json={
+                "original_file_id": compared_pair[0],
+                "modified_file_id": compared_pair[1],
+                "limit": limit
+            })
+            assert response.status_code == 400
+
+    def test_clause_mode_reports_moves(self):
+        """Test a moved section is reported as a move rather than delete plus insert"""
+        clauses = [f"{n}. Clause {n}: party {n} shall deliver goods lot {n * 7} within {n + 10} days." for n in range(1, 9)]
+        moved = clauses[:1] + clauses[3:6] + clauses[1:3] + clauses[6:]
+        moved[-1] = moved[-1].replace("within 18 days", "within 28 days")
+        original_upload = upload_text("clauses_original.txt", "\n".join(clauses))
+        modified_upload = upload_text("clauses_modified.txt", "\n".join(moved))
+        if not original_upload or not modified_upload:
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": original_upload["file_id"],
+            "modified_file_id": modified_upload["file_id"],
+            "mode": "clauses"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["differences"]["moves"] == 2
+        assert data["differences"]["moved_blocks"] == 1
+        assert data["differences"]["modifications"] == 1
+        assert data["differences"]["insertions"] == 0
+        assert data["differences"]["deletions"] == 0
+
+        move = next(c for c in data["changes"] if c["type"] == "move")
+        assert move["similarity"] == 1.0
+        assert move["original_location"] == "line 2"
+
+    def test_batch_compare_matrix(self):
+        """Test one baseline against several candidates returns a row per candidate"""
+        clauses = [f"{n}. Clause {n}: party {n} shall deliver goods lot {n * 7} within {n + 10} days." for n in range(1, 7)]
+        edited = list(clauses)
+        edited[2] = edited[2].replace("within 13 days", "within 30 days")
+        uploads = [
+            upload_text("batch_baseline.txt", "\n".join(clauses)),
+            upload_text("batch_identical.txt", "\n".join(clauses)),
+            upload_text("batch_edited.txt", "\n".join(edited))
+        ]
+        if not all(uploads):
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare/batch", json={
+            "baseline_file_id": uploads[0]["file_id"],
+            "candidate_file_ids": [uploads[1]["file_id"], uploads[2]["file_id"], "missing-file"]
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["candidates"] == 3
+        identical, edited_row, missing = data["matrix"]
+
+        assert identical["similarity"] == 1.0
+        assert identical["differences"]["total_changes"] == 0
+        assert edited_row["differences"]["modifications"] == 1
+        assert edited_row["similarity"] < 1.0
+        assert missing["status"] == "error"
+
+        detail = requests.get(f"{BASE_URL}{edited_row['changes_url']}").json()
+        assert detail["changes"][0]["type"] == "modification"
+
+    def test_large_batch_keeps_all_changes(self):
+        """Test every comparison of a batch larger than the single-comparison store stays retrievable"""
+        baseline = upload_text("batch_large_baseline.txt", "Clause 1: the Buyer shall pay.\nClause 2: notice is due.")
+        candidate = upload_text("batch_large_candidate.txt", "Clause 1: the Purchaser shall pay.\nClause 2: notice is due.")
+        if not baseline or not candidate:
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare/batch", json={
+            "baseline_file_id": baseline["file_id"],
+            "candidate_file_ids": [candidate["file_id"]] * 60
+        })
+        assert response.status_code == 200
+        matrix = response.json()["matrix"]
+        assert all(row["status"] == "success" for row in matrix)
+        for row in (matrix[0], matrix[-1]):
+            assert requests.get(f"{BASE_URL}{row['changes_url']}").status_code == 200
+
+    def test_line_mode_batch_shares_baseline_lines(self):
+        """Test line-mode batch results keep the baseline lines once per batch and still render redlines"""
+        baseline = upload_text("batch_lines_baseline.txt", "The Buyer shall pay.\nNotice is due.")
+        candidate = upload_text("batch_lines_candidate.txt", "The Purchaser shall pay.\nNotice is due.")
+        if not baseline or not candidate:
+            pytest.skip("Upload failed")
+
+        response = requests.post(f"{BASE_URL}/api/compare/batch", json={
+            "baseline_file_id": baseline["file_id"],
+            "candidate_file_ids": [candidate["file_id"]] * 2,
+            "mode": "lines"
+        })
+        assert response.status_code == 200
+        for row in response.json()["matrix"]:
+            redline = requests.post(f"{BASE_URL}/api/compare/{row['comparison_id']}/redline", json={"format": "html"})
+            assert redline.status_code == 200
+            html = requests.get(f"{BASE_URL}{redline.json()['download_url']}").content
+            assert b"<del>Buyer</del><ins>Purchaser</ins>" in html
+
+    def test_batch_compare_requires_candidates(self):
+        """Test batch comparison validates its inputs"""
+        response = requests.post(f"{BASE_URL}/api/compare/batch", json={"baseline_file_id": "x", "candidate_file_ids": []})
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize("fmt,signature", [("docx", b"PK"), ("html", b"<!DOCTYPE html>"), ("pdf", b"%PDF")])
+    def test_redline_download(self, compared_pair, fmt, signature):
+        """Test a comparison renders as a downloadable redline"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        comparison = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": compared_pair[0],
+            "modified_file_id": compared_pair[1]
+        }).json()
+        response = requests.post(f"{BASE_URL}/api/compare/{comparison['comparison_id']}/redline", json={"format": fmt})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["redline_file"].endswith(f"_redline.{fmt}")
+
+        download = requests.get(f"{BASE_URL}{data['download_url']}")
+        assert download.status_code == 200
+        assert download.content.startswith(signature)
+        assert len(download.content) == data["file_size"]
+        if fmt == "html":
+            assert b"<del>Buyer</del><ins>Purchaser</ins>" in download.content
+
+    def test_pdf_redline_is_written_in_page_windows(self, tmp_path, monkeypatch):
+        """Test a long PDF redline is rendered a few pages per canvas and merged in order"""
+        import redline_writer
+        from PyPDF2 import PdfReader
+
+        monkeypatch.setattr(redline_writer, "REDLINE_PDF_CHUNK_PAGES", 2)
+        paragraphs = ([("equal", f"Clause {n} stays.")] if n % 3 else [("insert", f"Clause {n} added.")]
+                      for n in range(300))
+        output_path = str(tmp_path / "long_redline.pdf")
+        pages = redline_writer.write_pdf_redline(paragraphs, output_path, "Long redline")
+
+        reader = PdfReader(output_path)
+        assert pages == len(reader.pages) > 4
+        assert "Clause 0 added." in reader.pages[0].extract_text()
+        assert "Clause 299 stays." in reader.pages[-1].extract_text()
+        assert reader.metadata.title == "Long redline"
+        assert os.listdir(tmp_path) == ["long_redline.pdf"]
+
+    def test_redline_rejects_unknown_format(self, compared_pair):
+        """Test redline format validation"""
+        if not compared_pair:
+            pytest.skip("Upload failed")
+
+        comparison = requests.post(f"{BASE_URL}/api/compare", json={
+            "original_file_id": compared_pair[0],
+            "modified_file_id": compared_pair[1]
+        }).json()
+        response = requests.post(f"{BASE_URL}/api/compare/{comparison['comparison_id']}/redline", json={"format": "odt"})
+        assert response.status_code == 400
+
+    def test_unknown_comparison_returns_404(self):
+        """Test paging an unknown comparison"""
+        response = requests.get(f"{BASE_URL}/api/compare/nonexistent-comparison")
+        assert response.status_code == 404
+
+
+class TestSimilarDocuments:
+    """Test /api/documents/{file_id}/similar near-duplicate lookups"""
+
+    def test_finds_near_duplicate(self):
+        """Test a lightly edited re-upload is found and an unrelated document is not"""
+        import random
+
+        rng = random.Random(7)
+        vocabulary = [f"term{i}" for i in range(2000)]
+        words = [rng.choice(vocabulary) for _ in range(1500)]
+        edited = list(words)
+        for position in range(0, 1500, 150):
+            edited[position] = "amended"
+        unrelated = [rng.choice(vocabulary) for _ in range(1500)]
+
+        original = upload_text("similar_original.txt", " ".join(words))
+        duplicate = upload_text("similar_renamed_copy.txt", " ".join(edited))
+        other = upload_text("similar_unrelated.txt", " ".join(unrelated))
+        if not all([original, duplicate, other]):
+            pytest.skip("Upload failed")
+
+        response = requests.get(f"{BASE_URL}/api/documents/{original['file_id']}/similar")
+        assert response.status_code == 200
+        data = response.json()
+        found = {item["file_id"]: item for item in data["similar"]}
+
+        assert duplicate["file_id"] in found
+        assert other["file_id"] not in found
+        match = found[duplicate["file_id"]]
+        assert match["similarity"] >= 0.7
+        assert match["suggested_comparison"] == {
+            "original_file_id": duplicate["file_id"],
+            "modified_file_id": original["file_id"]
+        }
+
+    def test_revert_refreshes_signature(self):
+        """Test a reverted document is fingerprinted again from its restored content"""
+        import random
+        import time
+
+        rng = random.Random(13)
+        text = " ".join(rng.choice([f"word{i}" for i in range(2000)]) for _ in range(1500))
+        original = upload_text("similar_reverted.txt", text)
+        copy = upload_text("similar_reverted_copy.txt", text)
+        if not original or not copy:
+            pytest.skip("Upload failed")
+        version = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": copy["file_id"]}).json()
+        reverted = requests.post(f"{BASE_URL}/api/versions/revert", json={
+            "file_id": copy["file_id"], "version_id": version["version_id"]
+        })
+        assert reverted.status_code == 200
+
+        deadline = time.time() + 10
+        while True:
+            similar = requests.get(f"{BASE_URL}/api/documents/{original['file_id']}/similar").json()["similar"]
+            if copy["file_id"] in {item["file_id"] for item in similar} or time.time() > deadline:
+                break
+            time.sleep(0.2)
+        assert copy["file_id"] in {item["file_id"] for item in similar}
+
+    def test_similar_unknown_file_returns_404(self):
+        """Test similarity search for a missing file"""
+        response = requests.get(f"{BASE_URL}/api/documents/nonexistent-file/similar")
+        assert response.status_code == 404
+
+
+def wait_for_compaction(file_id, timeout=15):
+    """Poll a version history until background compaction has stored every snapshot"""
+    import time
+
+    deadline = time.time() + timeout
+    while True:
+        history = requests.get(f"{BASE_URL}/api/versions/{file_id}").json()
+        if all(v.get("storage") != "blob" for v in history["versions"]) or time.time() > deadline:
+            return history
+        time.sleep(0.2)
+
+
+class TestVersionStorage:
+    """Test version snapshots stored as keyframes/deltas and streamed back on download"""
+
+    def test_version_download_round_trip(self):
+        """Test a snapshot downloads byte-for-byte and is reported in storage stats"""
+        text = "\n".join(f"{n}. The Supplier shall deliver item {n} on time." for n in range(2000))
+        uploaded = upload_text("versioned_contract.txt", text)
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+
+        created = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id})
+        assert created.status_code == 200
+        version = created.json()
+        assert version["storage"] == "blob"
+        assert version["snapshot_method"] in ("reflink", "hardlink", "copy")
+
+        download = requests.get(f"{BASE_URL}/api/versions/download/{file_id}/{version['version_id']}")
+        assert download.status_code == 200
+        assert download.content == text.encode("utf-8")
+        assert "versioned_contract.txt" in download.headers["content-disposition"]
+
+        history = wait_for_compaction(file_id)
+        assert history["versions"][0]["storage"] == "keyframe"
+        compacted = requests.get(f"{BASE_URL}/api/versions/download/{file_id}/{version['version_id']}")
+        assert compacted.content == text.encode("utf-8")
+
+        stats = requests.get(f"{BASE_URL}/api/versions/stats/{file_id}").json()
+        assert stats["keyframes"] == 1
+        assert stats["logical_size_bytes"] == len(text.encode("utf-8"))
+        assert 0 < stats["total_storage_bytes"] < stats["logical_size_bytes"]
+
+    def test_change_check_uses_ingest_digest(self):
+        """Test versions carry the SHA-256 taken at upload and unchanged files are not snapshotted twice"""
+        import hashlib
+
+        content = "Schedule A.\nPayment is due within 30 days.\n"
+        uploaded = upload_text("hashed_contract.txt", content)
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+
+        first = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id})
+        assert first.status_code == 200
+        second = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+        assert second["message"] == "No changes detected since last version"
+
+        history = requests.get(f"{BASE_URL}/api/versions/{file_id}").json()
+        assert history["versions"][0]["file_hash"] == hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def test_revert_shares_stored_version(self):
+        """Test reverting reuses the target's stored files instead of another copy"""
+        uploaded = upload_text("reverted_contract.txt", "Clause one.\nClause two.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        version = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+
+        response = requests.post(f"{BASE_URL}/api/versions/revert", json={
+            "file_id": file_id, "version_id": version["version_id"]
+        })
+        assert response.status_code == 200
+        assert response.json()["revert_method"] in ("reflink", "hardlink", "copy")
+        current = requests.get(f"{BASE_URL}/api/download/{file_id}")
+        assert current.content == b"Clause one.\nClause two.\n"
+
+        history = wait_for_compaction(file_id)
+        revert = history["versions"][-1]
+        assert revert["reverted_from"] == version["version_id"]
+        assert revert["stored_size"] == 0
+
+        # Deleting the original snapshot must keep the files the revert record still needs
+        deleted = requests.delete(f"{BASE_URL}/api/versions/{file_id}/{version['version_id']}")
+        assert deleted.status_code == 200
+        download = requests.get(f"{BASE_URL}/api/versions/download/{file_id}/{revert['version_id']}")
+        assert download.status_code == 200
+        assert download.content == b"Clause one.\nClause two.\n"
+
+    def test_shared_boilerplate_is_stored_once(self):
+        """Test a second document's snapshot only writes chunks the store does not already hold"""
+        import random
+
+        rng = random.Random(11)
+        boilerplate = "\n".join(
+            f"{n}. " + " ".join(rng.choice(["party", "term", "notice", "indemnify", "hereof", "shall"])
+                                 for _ in range(12)) for n in range(4000)
+        )
+        first = upload_text("boilerplate_a.txt", f"Master agreement between Acme and Beta.\n{boilerplate}")
+        second = upload_text("boilerplate_b.txt", f"Master agreement between Gamma and Delta.\n{boilerplate}")
+        if not first or not second:
+            pytest.skip("Upload failed")
+
+        requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": first["file_id"]})
+        wait_for_compaction(first["file_id"])
+        requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": second["file_id"]})
+        version = wait_for_compaction(second["file_id"])["versions"][0]
+        assert version["storage"] == "keyframe"
+        assert version["stored_size"] < len(boilerplate) * 0.05
+
+        stats = requests.get(f"{BASE_URL}/api/storage/dedup").json()
+        assert stats["files"] >= 2
+        assert stats["dedup_ratio"] > 1
+
+    def test_version_lookups_after_revert_and_delete(self):
+        """Test version lookups, the current marker and deletes across appended history entries"""
+        uploaded = upload_text("logged_contract.txt", "Term one.\nTerm two.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        first = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+        for _ in range(2):
+            reverted = requests.post(f"{BASE_URL}/api/versions/revert", json={
+                "file_id": file_id, "version_id": first["version_id"]
+            })
+            assert reverted.status_code == 200
+
+        history = wait_for_compaction(file_id)
+        versions = history["versions"]
+        assert history["current_version"] == versions[-1]["version_number"]
+        assert [v["is_current"] for v in versions] == [False] * (len(versions) - 1) + [True]
+        for version in versions:
+            details = requests.get(f"{BASE_URL}/api/versions/{file_id}/{version['version_id']}")
+            assert details.status_code == 200
+            assert details.json()["version"]["version_number"] == version["version_number"]
+
+        current = requests.delete(f"{BASE_URL}/api/versions/{file_id}/{versions[-1]['version_id']}")
+        assert current.status_code == 400
+        deleted = requests.delete(f"{BASE_URL}/api/versions/{file_id}/{versions[1]['version_id']}")
+        assert deleted.status_code == 200
+        missing = requests.get(f"{BASE_URL}/api/versions/{file_id}/{versions[1]['version_id']}")
+        assert missing.status_code == 404
+        remaining = requests.get(f"{BASE_URL}/api/versions/{file_id}").json()["versions"]
+        assert [v["version_id"] for v in remaining] == [v["version_id"] for i, v in enumerate(versions) if i != 1]
+
+    def test_compare_versions_returns_memoized_content_diff(self):
+        """Test version comparison diffs the versions' text and reuses the diff for the same contents"""
+        uploaded = upload_text("compared_contract.txt", "1. Scope.\n2. Payment terms.\n3. Termination.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        first = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+        requests.post(f"{BASE_URL}/api/versions/revert", json={"file_id": file_id, "version_id": first["version_id"]})
+        last = wait_for_compaction(file_id)["versions"][-1]
+
+        request = {"file_id": file_id, "version_id_1": first["version_id"], "version_id_2": last["version_id"]}
+        response = requests.post(f"{BASE_URL}/api/versions/compare", json=request)
+        assert response.status_code == 200
+        comparison = response.json()
+        assert comparison["files_identical"] is True
+        assert comparison["differences"]["total_changes"] == 0
+        assert comparison["similarity"] == 1.0
+        assert requests.get(f"{BASE_URL}{comparison['changes_url']}").status_code == 200
+
+        repeated = requests.post(f"{BASE_URL}/api/versions/compare", json=request).json()
+        assert repeated["cached"] is True
+        assert repeated["differences"] == comparison["differences"]
+
+        clauses = requests.post(f"{BASE_URL}/api/versions/compare", json={**request, "mode": "clauses"})
+        assert clauses.status_code == 200
+        assert clauses.json()["differences"]["unchanged"] == 3
+
+        invalid = requests.post(f"{BASE_URL}/api/versions/compare", json={**request, "mode": "pages"})
+        assert invalid.status_code == 400
+
+    def test_compare_versions_without_text_falls_back_to_hashes(self):
+        """Test versions whose text cannot be extracted are compared by size and hash"""
+        from PyPDF2 import PdfReader, PdfWriter
+
+        writer = PdfWriter()
+        for page in PdfReader(make_test_pdf(2)).pages:
+            writer.add_page(page)
+        writer.encrypt("owner-only")
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        files = {"file": ("locked_contract.pdf", io.BytesIO(buffer.getvalue()), "application/pdf")}
+        uploaded = requests.post(f"{BASE_URL}/api/upload", files=files)
+        if uploaded.status_code != 200:
+            pytest.skip("Upload failed")
+        file_id = uploaded.json()["file_id"]
+        first = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+        requests.post(f"{BASE_URL}/api/versions/revert", json={"file_id": file_id, "version_id": first["version_id"]})
+        last = wait_for_compaction(file_id)["versions"][-1]
+
+        request = {"file_id": file_id, "version_id_1": first["version_id"], "version_id_2": last["version_id"]}
+        response = requests.post(f"{BASE_URL}/api/versions/compare", json=request)
+        assert response.status_code == 200
+        comparison = response.json()
+        assert comparison["text_available"] is False
+        assert comparison["files_identical"] is True
+        assert "similarity" not in comparison
+
+        invalid = requests.post(f"{BASE_URL}/api/versions/compare", json={**request, "limit": "ten"})
+        assert invalid.status_code == 400
+
+    def test_retention_keeps_newest_version_per_day(self):
+        """Test applying a daily-only retention policy expires older same-day versions but keeps their data for reverts"""
+        content = b"Retention clause one.\nRetention clause two.\n"
+        uploaded = upload_text("retained_contract.txt", content.decode("utf-8"))
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        first = requests.post(f"{BASE_URL}/api/versions/create", json={"file_id": file_id}).json()
+        for _ in range(2):
+            requests.post(f"{BASE_URL}/api/versions/revert", json={"file_id": file_id, "version_id": first["version_id"]})
+        versions = wait_for_compaction(file_id)["versions"]
+        assert len(versions) == 3
+
+        response = requests.post(f"{BASE_URL}/api/versions/retention/{file_id}", json={"keep_all_days": 0})
+        assert response.status_code == 200
+        summary = response.json()
+        assert summary["expired_versions"] == 2
+        assert summary["remaining_versions"] == 1
+        assert summary["policy"]["keep_all_days"] == 0
+
+        remaining = requests.get(f"{BASE_URL}/api/versions/{file_id}").json()["versions"]
+        assert [v["version_id"] for v in remaining] == [versions[-1]["version_id"]]
+        download = requests.get(f"{BASE_URL}/api/versions/download/{file_id}/{versions[-1]['version_id']}")
+        assert download.content == content
+
+        # Expired versions keep their numbers
+        reverted = requests.post(f"{BASE_URL}/api/versions/revert", json={
+            "file_id": file_id, "version_id": versions[-1]["version_id"]
+        }).json()
+        assert reverted["new_version_number"] == versions[-1]["version_number"] + 1
+
+        invalid = requests.post(f"{BASE_URL}/api/versions/retention/{file_id}", json={"keep_all_days": 40})
+        assert invalid.status_code == 400
+        missing = requests.post(f"{BASE_URL}/api/versions/retention/nonexistent-file", json={})
+        assert missing.status_code == 404
+
+
+class TestVersionLog:
+    """Test per-document version logs in-process"""
+
+    @staticmethod
+    def record(number):
+        return {"version_id": f"v{number}", "version_number": number, "file_hash": f"hash{number}"}
+
+    def test_appends_through_an_evicted_history_reach_the_log(self, tmp_path, monkeypatch):
+        """Test a history evicted while held still appends to the cached copy, and log rewrites keep everything"""
+        import version_log
+        from version_log import VersionLogStore
+
+        monkeypatch.setattr(version_log, "LOG_COMPACTION_SLACK", 0)
+        store = VersionLogStore(cache_size=1)
+        store.init(str(tmp_path))
+        held = store.create("held", "held.txt")
+        store.add_version(held, self.record(1))
+        store.create("other", "other.txt")
+        reloaded = store.get("held")
+        assert reloaded is not held
+
+        store.add_version(held, self.record(2))
+        for _ in range(4):
+            store.update_version(held, "v2", {"note": "kept"})
+        assert [v["version_id"] for v in reloaded.versions] == ["v1", "v2"]
+        assert [v["version_id"] for v in held.versions] == ["v1", "v2"]
+
+        fresh = VersionLogStore()
+        fresh.init(str(tmp_path))
+        replayed = fresh.get("held")
+        assert [v["version_id"] for v in replayed.versions] == ["v1", "v2"]
+        assert replayed.get("v2")["note"] == "kept"
+        assert replayed.next_version_number == 3
+
+
+class TestAnnotationIndex:
+    """Test annotation lookups served from the id, page and reply indexes"""
+
+    @staticmethod
+    def add_comment(file_id, page, text, reply_to=None):
+        response = requests.post(f"{BASE_URL}/api/annotations/visual", json={
+            "file_id": file_id, "type": "comment", "text": text,
+            "position": {"page": page, "x": 10, "y": 20}, "reply_to": reply_to
+        })
+        assert response.status_code == 200
+        return response.json()["annotation_id"]
+
+    def test_page_queries_follow_updates_and_deletes(self):
+        """Test page listings stay correct when annotations move page or are deleted"""
+        uploaded = upload_text("annotated_contract.txt", "Annotated text.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        first = self.add_comment(file_id, 1, "Check the parties")
+        second = self.add_comment(file_id, 2, "Check the dates")
+
+        moved = requests.put(f"{BASE_URL}/api/annotations/{second}", json={"position": {"page": 1, "x": 5, "y": 5}})
+        assert moved.status_code == 200
+        page_one = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1").json()
+        assert [a["annotation_id"] for a in page_one["annotations"]] == [first, second]
+        assert requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/2").json()["total"] == 0
+
+        deleted = requests.delete(f"{BASE_URL}/api/annotations/{first}")
+        assert deleted.status_code == 200
+        assert requests.delete(f"{BASE_URL}/api/annotations/{first}").status_code == 404
+        assert requests.put(f"{BASE_URL}/api/annotations/{first}", json={"text": "x"}).status_code == 404
+        remaining = requests.get(f"{BASE_URL}/api/annotations/{file_id}").json()
+        assert [a["annotation_id"] for a in remaining["annotations"]] == [second]
+
+    def test_update_keeps_listing_order(self):
+        """Test editing an annotation that is not the newest leaves every listing in its original order"""
+        uploaded = upload_text("edited_contract.txt", "Edited text.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        root = self.add_comment(file_id, 1, "Who signs?")
+        ids = [self.add_comment(file_id, 1, f"Note {i}", reply_to=root) for i in range(3)]
+
+        edited = requests.put(f"{BASE_URL}/api/annotations/{ids[0]}", json={
+            "text": "Note 0, revised", "position": {"page": 1, "x": 12, "y": 22}
+        })
+        assert edited.status_code == 200
+        expected = [root] + ids
+        listed = requests.get(f"{BASE_URL}/api/annotations/{file_id}").json()["annotations"]
+        assert [a["annotation_id"] for a in listed] == expected
+        page = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1").json()["annotations"]
+        assert [a["annotation_id"] for a in page] == expected
+        viewport = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1/viewport",
+                                params={"x": 0, "y": 0, "width": 100, "height": 100}).json()["annotations"]
+        assert [a["annotation_id"] for a in viewport] == expected
+        replies = requests.get(f"{BASE_URL}/api/annotations/{root}/replies").json()["replies"]
+        assert [a["annotation_id"] for a in replies] == ids
+
+    def test_threaded_replies(self):
+        """Test direct replies and the nested thread below a comment"""
+        uploaded = upload_text("discussed_contract.txt", "Discussed text.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        root = self.add_comment(file_id, 1, "Is this clause enforceable?")
+        reply = self.add_comment(file_id, 1, "Probably not", reply_to=root)
+        nested = self.add_comment(file_id, 1, "Agreed", reply_to=reply)
+        other = self.add_comment(file_id, 1, "Ask counsel", reply_to=root)
+
+        direct = requests.get(f"{BASE_URL}/api/annotations/{root}/replies").json()
+        assert [a["annotation_id"] for a in direct["replies"]] == [reply, other]
+        thread = requests.get(f"{BASE_URL}/api/annotations/{root}/replies", params={"nested": True}).json()
+        assert [a["annotation_id"] for a in thread["replies"]] == [reply, nested, other]
+        assert requests.get(f"{BASE_URL}/api/annotations/nonexistent/replies").status_code == 404
+
+    def test_burst_of_strokes_is_kept_in_order(self):
+        """Test a burst of drawing strokes and an import are all listed once, in order"""
+        uploaded = upload_text("sketched_contract.txt", "Sketched text.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        strokes = []
+        for i in range(20):
+            response = requests.post(f"{BASE_URL}/api/annotations/visual", json={
+                "file_id": file_id, "type": "drawing", "position": {"page": 1, "x": i, "y": i},
+                "drawing_path": {"points": [{"x": i, "y": j} for j in range(50)]}
+            })
+            assert response.status_code == 200
+            strokes.append(response.json()["annotation_id"])
+        imported = requests.post(f"{BASE_URL}/api/annotations/import", json={
+            "file_id": file_id, "annotations": [{"type": "comment", "text": f"Note {i}", "position": {"page": 2}} for i in range(30)]
+        })
+        assert imported.status_code == 200
+
+        listed = requests.get(f"{BASE_URL}/api/annotations/{file_id}").json()
+        assert listed["total"] == 50
+        assert [a["annotation_id"] for a in listed["annotations"][:20]] == strokes
+        assert requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/2").json()["total"] == 30
+
+    def test_viewport_query_and_simplified_strokes(self):
+        """Test viewport queries return only overlapping annotations and zoom simplifies strokes"""
+        uploaded = upload_text("marked_up_contract.txt", "Marked up text.\n")
+        if not uploaded:
+            pytest.skip("Upload failed")
+        file_id = uploaded["file_id"]
+        stroke_points = [{"x": 300 + i * 0.5, "y": 400 + i * 0.25} for i in range(200)]
+        stroke = requests.post(f"{BASE_URL}/api/annotations/visual", json={
+            "file_id": file_id, "type": "drawing", "position": {"page": 1, "x": 300, "y": 400},
+            "drawing_path": {"points": stroke_points, "stroke_width": 2}
+        }).json()["annotation_id"]
+        note = self.add_comment(file_id, 1, "Top of page")
+
+        viewport = {"x": 280, "y": 380, "width": 200, "height": 200}
+        found = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1/viewport", params=viewport).json()
+        assert [a["annotation_id"] for a in found["annotations"]] == [stroke]
+        assert found["annotations"][0]["drawing_path"]["points"] == stroke_points
+        top = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1/viewport",
+                           params={"x": 0, "y": 0, "width": 50, "height": 50}).json()
+        assert [a["annotation_id"] for a in top["annotations"]] == [note]
+
+        zoomed = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1/viewport",
+                              params={**viewport, "zoom": 1}).json()
+        assert zoomed["annotations"][0]["drawing_path"]["points"] == [stroke_points[0], stroke_points[-1]]
+        page = requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1", params={"zoom": 1}).json()
+        assert page["total"] == 2
+        assert requests.get(f"{BASE_URL}/api/annotations/{file_id}/page/1", params={"zoom": 0}).status_code == 400
+
+
+class TestAnnotationJournal:
+    """Test AnnotationStore persistence in-process: recovery on reopen, torn journal tails and compaction"""
+
+    @staticmethod
+    def comment(annotation_id, page=1, text="", reply_to=None):
+        return {"annotation_id": annotation_id, "file_id": "journaled", "type": "comment", "text": text,
+                "position": {"page": page, "x": 10, "y": 20}, "reply_to": reply_to}
+
+    def test_reopen_recovers_every_change(self, tmp_path):
+        """Test adds, updates and deletes written before close are all there after reopening"""
+        from annotation_store import AnnotationStore
+
+        store = AnnotationStore()
+        store.open(str(tmp_path))
+        store.add(self.comment("a0", text="First"))
+        store.add({"annotation_id": "a1", "file_id": "journaled", "type": "drawing", "position": {"page": 2},
+                   "drawing_path": {"points": [{"x": 1, "y": 2}, {"x": 30, "y": 40}], "stroke_width": 2}})
+        store.add(self.comment("a2", text="Reply", reply_to="a0"))
+        store.add(self.comment("a3", text="Gone"))
+        store.update("a0", {"text": "First, revised"})
+        store.delete("a3")
+        written = store.for_file("journaled")
+        store.close()
+
+        reopened = AnnotationStore()
+        reopened.open(str(tmp_path))
+        try:
+            assert reopened.for_file("journaled") == written
+            assert [a["annotation_id"] for a in reopened.for_file("journaled")] == ["a0", "a1", "a2"]
+            assert reopened.get("a0")["text"] == "First, revised"
+            assert reopened.get("a3") is None
+            assert [a["annotation_id"] for a in reopened.replies("a0")] == ["a2"]
+            assert reopened.for_page("journaled", 2)[0]["drawing_path"]["points"] == [{"x": 1, "y": 2}, {"x": 30, "y": 40}]
+        finally:
+            reopened.close()
+
+    def test_torn_final_entry_is_discarded(self, tmp_path):
+        """Test a half-written last journal line is cut off on open and later writes still replay"""
+        from annotation_store import AnnotationStore, JOURNAL_FILE
+
+        store = AnnotationStore()
+        store.open(str(tmp_path))
+        store.add(self.comment("a0"))
+        store.add(self.comment("a1"))
+        store.close()
+        journal = tmp_path / JOURNAL_FILE
+        intact = journal.read_bytes()
+        with open(journal, "ab") as f:
+            f.write(b'{"op": "put", "annotation": {"annotation_id": "a2", "fi')
+
+        reopened = AnnotationStore()
+        reopened.open(str(tmp_path))
+        assert len(reopened) == 2
+        assert journal.read_bytes() == intact
+        reopened.add(self.comment("a2"))
+        reopened.close()
+
+        recovered = AnnotationStore()
+        recovered.open(str(tmp_path))
+        try:
+            assert [a["annotation_id"] for a in recovered.for_file("journaled")] == ["a0", "a1", "a2"]
+        finally:
+            recovered.close()
+
+    def test_compaction_folds_journal_into_snapshot(self, tmp_path, monkeypatch):
+        """Test a long journal is replaced by a snapshot holding the same annotations"""
+        import annotation_store
+        from annotation_store import AnnotationStore, JOURNAL_FILE, SNAPSHOT_FILE
+
+        monkeypatch.setattr(annotation_store, "ANNOTATION_COMPACT_ENTRIES", 5)
+        store = AnnotationStore()
+        store.open(str(tmp_path))
+        for i in range(3):
+            store.add(self.comment(f"a{i}"))
+        for revision in range(3):
+            for i in range(3):
+                store.update(f"a{i}", {"text": f"Revision {revision}"})
+        store.flush()
+        assert (tmp_path / SNAPSHOT_FILE).exists()
+        # The writer may have compacted after an earlier part of the burst, leaving the rest journaled
+        assert len((tmp_path / JOURNAL_FILE).read_bytes().splitlines()) < 12
+        store.update("a1", {"text": "After compaction"})
+        written = store.for_file("journaled")
+        store.close()
+
+        reopened = AnnotationStore()
+        reopened.open(str(tmp_path))
+        try:
+            assert reopened.for_file("journaled") == written
+            assert reopened.get("a1")["text"] == "After compaction"
+            assert reopened.get("a2")["text"] == "Revision 2"
+        finally:
+            reopened.close()
+
+    def test_failed_journal_write_is_retried(self, tmp_path, monkeypatch):
+        """Test changes whose write fails stay queued, leave nothing half-written and land on the next flush"""
+        import annotation_store
+        from annotation_store import AnnotationStore, JOURNAL_FILE
+
+        store = AnnotationStore()
+        store.open(str(tmp_path))
+        fsync = os.fsync
+        failing = [True]
+
+        def flaky_fsync(fd):
+            if failing[0]:
+                raise OSError(28, "No space left on device")
+            fsync(fd)
+
+        monkeypatch.setattr(annotation_store.os, "fsync", flaky_fsync)
+        store.add(self.comment("a0"))
+        with pytest.raises(OSError):
+            store.flush()
+        assert (tmp_path / JOURNAL_FILE).stat().st_size == 0
+        failing[0] = False
+        store.close()
+
+        reopened = AnnotationStore()
+        reopened.open(str(tmp_path))
+        try:
+            assert reopened.get("a0") is not None
+        finally:
+            reopened.close()
+
+    def test_remove_file_is_journaled(self, tmp_path):
+        """Test dropping a deleted file's annotations survives a reopen and leaves other files alone"""
+        from annotation_store import AnnotationStore
+
+        store = AnnotationStore()
+        store.open(str(tmp_path))
+        store.add(self.comment("a0"))
+        store.add(self.comment("a1", reply_to="a0"))
+        store.add({**self.comment("b0"), "file_id": "kept"})
+        assert store.remove_file("journaled") == 2
+        assert store.remove_file("journaled") == 0
+        store.close()
+
+        reopened = AnnotationStore()
+        reopened.open(str(tmp_path))
+        try:
+            assert reopened.for_file("journaled") == []
+            assert reopened.replies("a0") == []
+            assert [a["annotation_id"] for a in reopened.for_file("kept")] == ["b0"]
+        finally:
+            reopened.close()
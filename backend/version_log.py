@@ -0,0 +1,243 @@
+"""
+Per-document version logs - each document's history is an append-only JSON-lines
+file replayed on first access into an in-memory version_id index. Creating,
+updating or deleting a version appends one line instead of rewriting every history.
+"""
+import os
+import re
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Histories kept in memory; the rest are replayed from their logs when next used
+VERSION_LOG_CACHE_SIZE = int(os.environ.get("VERSION_LOG_CACHE_SIZE", "1024"))
+# A log is rewritten once it holds this many more lines than live versions
+LOG_COMPACTION_SLACK = 64
+
+_FILE_ID = re.compile(r"^[\w-]+$")
+
+
+class VersionHistory:
+    """One document's versions in order, indexed by version_id"""
+
+    def __init__(self, file_id: str, original_name: str):
+        self.file_id = file_id
+        self.original_name = original_name
+        self.versions: List[Dict[str, Any]] = []
+        self.current_version = 0
+        # Never reused: deleted and expired versions keep their numbers
+        self.next_version_number = 1
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._current: Optional[Dict[str, Any]] = None
+        self.log_lines = 0
+
+    def get(self, version_id: str) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(version_id)
+
+    def apply(self, entry: Dict[str, Any]):
+        """Apply one log entry"""
+        op = entry["op"]
+        if op == "add":
+            record = entry["record"]
+            if self._current is not None:
+                self._current["is_current"] = False
+            record["is_current"] = True
+            self.versions.append(record)
+            self._by_id[record["version_id"]] = record
+            self._current = record
+            self.current_version = record["version_number"]
+            self.next_version_number = max(self.next_version_number, record["version_number"] + 1)
+        elif op == "update":
+            record = self._by_id[entry["version_id"]]
+            record.update(entry.get("fields", {}))
+            for key in entry.get("unset", ()):
+                record.pop(key, None)
+        elif op == "delete":
+            record = self._by_id.pop(entry["version_id"])
+            self.versions.remove(record)
+
+    def needs_rewrite(self) -> bool:
+        """Whether superseded entries dominate the log"""
+        return self.log_lines > 2 * (len(self.versions) + 1) + LOG_COMPACTION_SLACK
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "file_id": self.file_id,
+            "original_name": self.original_name,
+            "versions": self.versions,
+            "current_version": self.current_version
+        }
+
+
+class VersionLogStore:
+    """Version histories stored as one log per document under a directory"""
+
+    def __init__(self, cache_size: int = VERSION_LOG_CACHE_SIZE):
+        self.root = ""
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, VersionHistory]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def init(self, root: str, legacy_file: Optional[str] = None):
+        """Point the store at its directory; a legacy single-file history is split into logs once"""
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        with self._lock:
+            self._cache.clear()
+        if legacy_file and os.path.exists(legacy_file):
+            self._migrate(legacy_file)
+
+    def _migrate(self, legacy_file: str):
+        try:
+            with open(legacy_file, "r") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading legacy version history {legacy_file}: {e}")
+            return
+        for file_id, data in legacy.items():
+            if not _FILE_ID.match(file_id) or os.path.exists(self._log_path(file_id)):
+                continue
+            history = VersionHistory(file_id, data.get("original_name", ""))
+            for record in data.get("versions", []):
+                history.apply({"op": "add", "record": record})
+            self._rewrite(history)
+        os.replace(legacy_file, legacy_file + ".migrated")
+        logger.info(f"Migrated {len(legacy)} version histories to per-document logs")
+
+    def _log_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{file_id}.jsonl")
+
+    def _load(self, file_id: str) -> Optional[VersionHistory]:
+        path = self._log_path(file_id)
+        if not _FILE_ID.match(file_id) or not os.path.exists(path):
+            return None
+        history: Optional[VersionHistory] = None
+        torn = False
+        with open(path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Only a crash mid-append can leave a torn line; the rewrite below drops it
+                    logger.warning(f"Ignoring torn line {number} in version log {file_id}")
+                    torn = True
+                    continue
+                if entry["op"] == "create":
+                    history = VersionHistory(file_id, entry["original_name"])
+                    history.next_version_number = entry.get("next_version_number", 1)
+                elif history is not None:
+                    history.apply(entry)
+                if history is not None:
+                    history.log_lines += 1
+        if history is not None and (torn or history.needs_rewrite()):
+            self._rewrite(history)
+        return history
+
+    def _remember(self, history: VersionHistory):
+        self._cache[history.file_id] = history
+        self._cache.move_to_end(history.file_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, file_id: str) -> Optional[VersionHistory]:
+        """A document's history, replayed from its log on first use"""
+        with self._lock:
+            history = self._cache.get(file_id)
+            if history is not None:
+                self._cache.move_to_end(file_id)
+                return history
+            history = self._load(file_id)
+            if history is not None:
+                self._remember(history)
+            return history
+
+    def __contains__(self, file_id: str) -> bool:
+        with self._lock:
+            return file_id in self._cache or (bool(_FILE_ID.match(file_id)) and os.path.exists(self._log_path(file_id)))
+
+    def file_ids(self) -> List[str]:
+        """Every document with a version log"""
+        if not os.path.isdir(self.root):
+            return []
+        return [name[:-len(".jsonl")] for name in os.listdir(self.root) if name.endswith(".jsonl")]
+
+    def remove(self, file_id: str):
+        """Forget a document's history entirely"""
+        with self._lock:
+            self._cache.pop(file_id, None)
+            path = self._log_path(file_id)
+            if _FILE_ID.match(file_id) and os.path.exists(path):
+                os.remove(path)
+
+    def create(self, file_id: str, original_name: str) -> VersionHistory:
+        if not _FILE_ID.match(file_id):
+            raise ValueError(f"Invalid file id: {file_id}")
+        with self._lock:
+            history = VersionHistory(file_id, original_name)
+            self._append(history, {"op": "create", "original_name": original_name})
+            self._remember(history)
+            return history
+
+    def add_version(self, history: VersionHistory, record: Dict[str, Any]):
+        self._append(history, {"op": "add", "record": record})
+
+    def update_version(self, history: VersionHistory, version_id: str, fields: Dict[str, Any],
+                       unset: Iterable[str] = ()):
+        entry: Dict[str, Any] = {"op": "update", "version_id": version_id, "fields": fields}
+        unset = list(unset)
+        if unset:
+            entry["unset"] = unset
+        self._append(history, entry)
+
+    def delete_version(self, history: VersionHistory, version_id: str):
+        self._append(history, {"op": "delete", "version_id": version_id})
+
+    def _cached(self, history: VersionHistory) -> VersionHistory:
+        """The cached history of a document, replayed again if it was evicted while a caller held it"""
+        cached = self._cache.get(history.file_id)
+        if cached is None:
+            cached = self._load(history.file_id)
+            if cached is None:
+                return history
+            self._remember(cached)
+        return cached
+
+    def _append(self, history: VersionHistory, entry: Dict[str, Any]):
+        """Apply an entry and append it to the log as a single write
+
+        Entries always go to the cached history, so a caller still holding an evicted copy across
+        an await cannot fork the log; that copy is given the entry too.
+        """
+        line = json.dumps(entry, default=str) + "\n"
+        with self._lock:
+            current = history if entry["op"] == "create" else self._cached(history)
+            current.apply(entry)
+            if current is not history:
+                try:
+                    history.apply(entry)
+                except (KeyError, ValueError):
+                    # The stale copy lacks a version added since it was evicted
+                    pass
+            with open(self._log_path(history.file_id), "a", encoding="utf-8") as f:
+                f.write(line)
+            current.log_lines += 1
+            if current.needs_rewrite():
+                self._rewrite(current)
+
+    def _rewrite(self, history: VersionHistory):
+        """Replace a log with one line per live version"""
+        path = self._log_path(history.file_id)
+        lines = [json.dumps({"op": "create", "original_name": history.original_name,
+                             "next_version_number": history.next_version_number})]
+        lines.extend(json.dumps({"op": "add", "record": record}, default=str) for record in history.versions)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+        history.log_lines = len(lines)
+
+
+version_logs = VersionLogStore()
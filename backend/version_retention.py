@@ -0,0 +1,91 @@
+"""
+Version retention - every version from the last few days is kept, then the newest
+per day, then the newest per week, each tier capped at a number of versions; anything
+older is expired. Background work is paced to a byte rate so it yields to requests.
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Set
+
+VERSION_KEEP_ALL_DAYS = int(os.environ.get("VERSION_KEEP_ALL_DAYS", "7"))
+VERSION_KEEP_DAILY_DAYS = int(os.environ.get("VERSION_KEEP_DAILY_DAYS", "30"))
+VERSION_KEEP_WEEKLY_DAYS = int(os.environ.get("VERSION_KEEP_WEEKLY_DAYS", "365"))
+# Most versions kept in any one tier
+VERSION_TIER_CAP = int(os.environ.get("VERSION_TIER_CAP", "50"))
+# Seconds between background retention passes
+VERSION_RETENTION_INTERVAL = int(os.environ.get("VERSION_RETENTION_INTERVAL", "3600"))
+# Read/write budget of the background compactor
+VERSION_COMPACTION_RATE_MB = float(os.environ.get("VERSION_COMPACTION_RATE_MB", "8"))
+
+
+class RetentionPolicy:
+    """Age limits of the all/daily/weekly tiers and the per-tier version cap"""
+
+    def __init__(self, keep_all_days: int = VERSION_KEEP_ALL_DAYS, keep_daily_days: int = VERSION_KEEP_DAILY_DAYS,
+                 keep_weekly_days: int = VERSION_KEEP_WEEKLY_DAYS, tier_cap: int = VERSION_TIER_CAP):
+        if not 0 <= keep_all_days <= keep_daily_days <= keep_weekly_days:
+            raise ValueError("Retention days must satisfy 0 <= keep_all_days <= keep_daily_days <= keep_weekly_days")
+        if tier_cap < 1:
+            raise ValueError("tier_cap must be at least 1")
+        self.keep_all_days = keep_all_days
+        self.keep_daily_days = keep_daily_days
+        self.keep_weekly_days = keep_weekly_days
+        self.tier_cap = tier_cap
+
+    @classmethod
+    def with_overrides(cls, overrides: Dict[str, Any]) -> "RetentionPolicy":
+        fields = ("keep_all_days", "keep_daily_days", "keep_weekly_days", "tier_cap")
+        unknown = set(overrides) - set(fields)
+        if unknown:
+            raise ValueError(f"Unknown retention settings: {', '.join(sorted(unknown))}")
+        defaults = cls()
+        return cls(**{name: int(overrides.get(name, getattr(defaults, name))) for name in fields})
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "keep_all_days": self.keep_all_days,
+            "keep_daily_days": self.keep_daily_days,
+            "keep_weekly_days": self.keep_weekly_days,
+            "tier_cap": self.tier_cap
+        }
+
+    def _bucket(self, created_at: datetime, now: datetime, version_id: str) -> Optional[tuple]:
+        """(tier, bucket) a version competes in, or None once it is past every tier"""
+        age = now - created_at
+        if age <= timedelta(days=self.keep_all_days):
+            return ("all", version_id)
+        if age <= timedelta(days=self.keep_daily_days):
+            return ("daily", created_at.date())
+        if age <= timedelta(days=self.keep_weekly_days):
+            return ("weekly", created_at.isocalendar()[:2])
+        return None
+
+    def retained(self, versions: List[Dict[str, Any]], now: Optional[datetime] = None,
+                 keep: Iterable[str] = ()) -> Set[str]:
+        """version_ids the policy keeps: the newest version of each bucket, up to the cap per tier"""
+        now = now or datetime.utcnow()
+        kept = set(keep)
+        seen: Set[tuple] = set()
+        per_tier: Dict[str, int] = {}
+        for record in sorted(versions, key=lambda v: v["created_at"], reverse=True):
+            bucket = self._bucket(datetime.fromisoformat(record["created_at"]), now, record["version_id"])
+            if bucket is None or bucket in seen:
+                continue
+            seen.add(bucket)
+            tier = bucket[0]
+            if per_tier.get(tier, 0) < self.tier_cap:
+                per_tier[tier] = per_tier.get(tier, 0) + 1
+                kept.add(record["version_id"])
+        return kept
+
+
+class IOThrottle:
+    """Paces background reads and writes to a byte rate by sleeping after each unit of work"""
+
+    def __init__(self, rate_mb: float = VERSION_COMPACTION_RATE_MB):
+        self.bytes_per_second = rate_mb * 1024 * 1024
+
+    async def pace(self, processed_bytes: int):
+        if self.bytes_per_second > 0 and processed_bytes > 0:
+            await asyncio.sleep(processed_bytes / self.bytes_per_second)
@@ -0,0 +1,442 @@
+"""
+Version snapshot storage - periodic full keyframes plus compressed binary deltas
+against the latest keyframe. Keyframes live in the chunk store, so successive
+keyframes (and boilerplate shared with other documents) cost only their new chunks;
+a delta copies every chunk the keyframe already has and inlines the rest. Any
+version is rebuilt by streaming one delta over one keyframe.
+
+Snapshots start out as immutable blobs cloned copy-on-write from the live file and
+are compacted into keyframes/deltas afterwards; recent blobs are kept so reverting
+to them is a clone rather than a rebuild.
+"""
+import os
+import zlib
+import uuid
+import shutil
+import struct
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no reflinks, hardlinks and copies still work
+    fcntl = None
+
+from chunk_store import chunk_store
+from content_chunking import iter_chunks, chunk_digest, mapped_file
+
+logger = logging.getLogger(__name__)
+
+# A full keyframe is written at least every this many versions
+VERSION_KEYFRAME_INTERVAL = int(os.environ.get("VERSION_KEYFRAME_INTERVAL", "10"))
+# A delta bigger than this fraction of the file is not worth it; a keyframe is stored instead
+MAX_DELTA_RATIO = float(os.environ.get("VERSION_MAX_DELTA_RATIO", "0.5"))
+# Most recent snapshots kept as blobs after compaction, so reverting to them is a clone
+VERSION_BLOB_CACHE = int(os.environ.get("VERSION_BLOB_CACHE", "2"))
+READ_CHUNK_SIZE = 64 * 1024
+# Linux FICLONE ioctl: share a file's extents copy-on-write (btrfs, XFS, bcachefs, ...)
+_FICLONE = 0x40049409
+
+_DELTA_MAGIC = b"LDCDELTA1\n"
+_INDEX_ENTRY = struct.Struct("<16sQI")  # chunk digest, offset, length
+_COPY = struct.Struct("<cQQ")  # b"C", keyframe offset, length
+_INSERT = struct.Struct("<cI")  # b"I", length, followed by the literal bytes
+
+# Stored data a version depends on: ("manifest", manifest id) or ("file", path)
+Ref = Tuple[str, str]
+# Record fields that locate a version's stored data
+STORAGE_FIELDS = ("file_path", "manifest_id", "base_manifest_id", "base_path", "base_version_id")
+
+
+def keyframe_ref(record: Dict[str, Any]) -> Ref:
+    """The keyframe a version is rebuilt from (itself unless it is a delta)"""
+    if record.get("storage") == "delta":
+        if record.get("base_manifest_id"):
+            return ("manifest", record["base_manifest_id"])
+        return ("file", record["base_path"])
+    if record.get("manifest_id"):
+        return ("manifest", record["manifest_id"])
+    # Versions stored before the chunk store are plain full copies
+    return ("file", record["file_path"])
+
+
+def version_refs(record: Dict[str, Any]) -> List[Ref]:
+    """Everything needed to rebuild a version"""
+    if record.get("storage") == "delta":
+        return [("file", record["file_path"]), keyframe_ref(record)]
+    return [keyframe_ref(record)]
+
+
+def _ref_exists(ref: Ref) -> bool:
+    kind, value = ref
+    return chunk_store.has_manifest(value) if kind == "manifest" else os.path.exists(value)
+
+
+def version_available(record: Dict[str, Any]) -> bool:
+    return all(_ref_exists(ref) for ref in version_refs(record))
+
+
+def shared_storage(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Storage fields for a new record that reuses another version's stored data"""
+    fields = {key: record[key] for key in ("storage",) + STORAGE_FIELDS if key in record}
+    fields.setdefault("storage", "keyframe")
+    fields["stored_size"] = 0
+    return fields
+
+
+def _chunk_index_path(keyframe_path: str) -> str:
+    return keyframe_path + ".chunks"
+
+
+def _load_file_chunk_index(keyframe_path: str) -> Dict[bytes, Tuple[int, int]]:
+    """Chunk digest -> (offset, length) in a legacy full-copy keyframe, cached beside it"""
+    index_path = _chunk_index_path(keyframe_path)
+    if not os.path.exists(index_path):
+        with mapped_file(keyframe_path) as data, open(index_path + ".tmp", "wb") as out:
+            for offset, chunk in iter_chunks(data, chunk_store.avg_size):
+                out.write(_INDEX_ENTRY.pack(chunk_digest(chunk), offset, len(chunk)))
+                chunk.release()
+        os.replace(index_path + ".tmp", index_path)
+    with open(index_path, "rb") as f:
+        return {digest: (offset, length) for digest, offset, length in _INDEX_ENTRY.iter_unpack(f.read())}
+
+
+def _chunk_index(ref: Ref) -> Dict[bytes, Tuple[int, int]]:
+    kind, value = ref
+    return chunk_store.chunk_index(value) if kind == "manifest" else _load_file_chunk_index(value)
+
+
+def write_delta(source_path: str, keyframe: Ref, delta_path: str) -> Optional[int]:
+    """Store the source as a delta against a keyframe; None when the delta would be too large"""
+    index = _chunk_index(keyframe)
+    temp_path = delta_path + ".tmp"
+    compressor = zlib.compressobj(6)
+    written = len(_DELTA_MAGIC)
+    copy: Optional[List[int]] = None
+
+    with mapped_file(source_path) as data, open(temp_path, "wb") as out:
+        limit = len(data) * MAX_DELTA_RATIO
+
+        def emit(payload) -> bool:
+            nonlocal written
+            compressed = compressor.compress(payload)
+            out.write(compressed)
+            written += len(compressed)
+            return written <= limit
+
+        out.write(_DELTA_MAGIC)
+        within_limit = True
+        chunks = iter_chunks(data, chunk_store.avg_size)
+        for _, chunk in chunks:
+            match = index.get(chunk_digest(chunk))
+            if match and match[1] == len(chunk):
+                # Runs of chunks that are also adjacent in the keyframe become one copy
+                if copy and copy[0] + copy[1] == match[0]:
+                    copy[1] += match[1]
+                else:
+                    if copy:
+                        emit(_COPY.pack(b"C", *copy))
+                    copy = [match[0], match[1]]
+            else:
+                if copy:
+                    emit(_COPY.pack(b"C", *copy))
+                    copy = None
+                within_limit = emit(_INSERT.pack(b"I", len(chunk))) and emit(chunk)
+            chunk.release()
+            if not within_limit:
+                break
+        chunks.close()
+        if within_limit:
+            if copy:
+                emit(_COPY.pack(b"C", *copy))
+            out.write(compressor.flush())
+
+    if not within_limit:
+        os.remove(temp_path)
+        return None
+    os.replace(temp_path, delta_path)
+    return os.path.getsize(delta_path)
+
+
+@contextmanager
+def _keyframe_ranges(keyframe: Ref):
+    """A function streaming (offset, length) ranges of a keyframe"""
+    kind, value = keyframe
+    if kind == "manifest":
+        yield chunk_store.open_manifest(value).iter_range
+        return
+    with open(value, "rb") as f:
+        def iter_range(offset: int, length: int) -> Iterator[bytes]:
+            f.seek(offset)
+            while length:
+                data = f.read(min(length, READ_CHUNK_SIZE))
+                if not data:
+                    return
+                length -= len(data)
+                yield data
+        yield iter_range
+
+
+def _iter_decompressed(delta_file) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj()
+    while True:
+        compressed = delta_file.read(READ_CHUNK_SIZE)
+        if not compressed:
+            break
+        data = decompressor.decompress(compressed)
+        if data:
+            yield data
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def _iter_delta(delta_path: str, keyframe: Ref) -> Iterator[bytes]:
+    with open(delta_path, "rb") as delta, _keyframe_ranges(keyframe) as keyframe_range:
+        if delta.read(len(_DELTA_MAGIC)) != _DELTA_MAGIC:
+            raise ValueError(f"Not a version delta: {delta_path}")
+        stream = _iter_decompressed(delta)
+        buffer, position = b"", 0
+
+        def take(size: int) -> bytes:
+            nonlocal buffer, position
+            while len(buffer) - position < size:
+                data = next(stream, None)
+                if data is None:
+                    raise ValueError(f"Truncated version delta: {delta_path}")
+                buffer, position = buffer[position:] + data, 0
+            position += size
+            return buffer[position - size:position]
+
+        while True:
+            if position == len(buffer):
+                data = next(stream, None)
+                if data is None:
+                    return
+                buffer, position = data, 0
+            if buffer[position:position + 1] == b"C":
+                _, offset, length = _COPY.unpack(take(_COPY.size))
+                for data in keyframe_range(offset, length):
+                    length -= len(data)
+                    yield data
+                if length:
+                    raise ValueError(f"Keyframe shorter than delta expects: {delta_path}")
+            else:
+                _, length = _INSERT.unpack(take(_INSERT.size))
+                yield take(length)
+
+
+def iter_version(record: Dict[str, Any]) -> Iterator[bytes]:
+    """Stream a version's bytes, rebuilding deltas on the fly"""
+    if record.get("storage") == "delta":
+        yield from _iter_delta(record["file_path"], keyframe_ref(record))
+        return
+    kind, value = keyframe_ref(record)
+    if kind == "manifest":
+        yield from chunk_store.iter_file(value)
+        return
+    with open(value, "rb") as f:
+        for data in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+            yield data
+
+
+def restore_version(record: Dict[str, Any], output_path: str) -> Tuple[int, str]:
+    """Atomically replace output_path with a version's content; returns its size and SHA-256"""
+    temp_path = f"{output_path}.restore.tmp"
+    size = 0
+    digest = hashlib.sha256()
+    try:
+        with open(temp_path, "wb") as out:
+            for data in iter_version(record):
+                out.write(data)
+                digest.update(data)
+                size += len(data)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return size, digest.hexdigest()
+
+
+def clone_file(source_path: str, destination_path: str) -> str:
+    """Atomically make destination a copy of source; returns "reflink", "hardlink" or "copy"
+
+    Hardlinks are safe because stored files are only ever replaced, never rewritten in place.
+    """
+    if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+        return "hardlink"
+    temp_path = f"{destination_path}.clone.tmp"
+    try:
+        try:
+            if fcntl is None:
+                raise OSError("reflinks unsupported")
+            with open(source_path, "rb") as source, open(temp_path, "wb") as destination:
+                fcntl.ioctl(destination.fileno(), _FICLONE, source.fileno())
+            method = "reflink"
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            try:
+                os.link(source_path, temp_path)
+                method = "hardlink"
+            except OSError:
+                shutil.copyfile(source_path, temp_path)
+                method = "copy"
+        os.replace(temp_path, destination_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return method
+
+
+def prune_blobs(blobs_dir: str, keep: Set[str]) -> int:
+    """Delete snapshot blobs whose names are not in keep; returns bytes actually freed"""
+    freed = 0
+    if not os.path.isdir(blobs_dir):
+        return freed
+    for entry in os.scandir(blobs_dir):
+        if entry.name in keep:
+            continue
+        stat = entry.stat()
+        # A blob still hardlinked to a live file frees nothing
+        if stat.st_nlink == 1:
+            freed += stat.st_size
+        os.remove(entry.path)
+    return freed
+
+
+def store_version(source_path: str, versions: List[Dict[str, Any]], version_path: str) -> Dict[str, Any]:
+    """Compact a snapshot into keyframe/delta storage after the given versions; returns its storage fields"""
+    versions = [record for record in versions if record.get("storage") != "blob"]
+    if versions:
+        keyframe = keyframe_ref(versions[-1])
+        since_keyframe = 0
+        for record in reversed(versions):
+            if keyframe_ref(record) != keyframe:
+                break
+            since_keyframe += 1
+        if since_keyframe < VERSION_KEYFRAME_INTERVAL and _ref_exists(keyframe):
+            delta_path = version_path + ".delta"
+            stored_size = write_delta(source_path, keyframe, delta_path)
+            if stored_size is not None:
+                base_version_id = next(
+                    (record["version_id"] for record in versions
+                     if record.get("storage") != "delta" and keyframe_ref(record) == keyframe), None
+                )
+                fields = {"file_path": delta_path, "storage": "delta", "stored_size": stored_size,
+                          "base_version_id": base_version_id}
+                fields["base_manifest_id" if keyframe[0] == "manifest" else "base_path"] = keyframe[1]
+                return fields
+
+    manifest_id, written = chunk_store.put_file(source_path)
+    return {"storage": "keyframe", "manifest_id": manifest_id, "stored_size": written}
+
+
+def release_version(record: Dict[str, Any], remaining: List[Dict[str, Any]]) -> int:
+    """Delete a removed version's stored data that no remaining version needs; returns bytes freed"""
+    needed: Set[Ref] = set()
+    for other in remaining:
+        needed.update(version_refs(other))
+    freed = 0
+    for ref in version_refs(record):
+        kind, value = ref
+        if ref in needed or not _ref_exists(ref):
+            continue
+        if kind == "manifest":
+            freed += chunk_store.release(value)
+            continue
+        freed += os.path.getsize(value)
+        os.remove(value)
+        if os.path.exists(_chunk_index_path(value)):
+            os.remove(_chunk_index_path(value))
+    return freed
+
+
+def orphaned_deltas(versions: List[Dict[str, Any]]) -> Dict[Ref, List[Dict[str, Any]]]:
+    """Deltas grouped by keyframe, for keyframes whose own version is gone"""
+    owned = {keyframe_ref(record) for record in versions if record.get("storage") not in ("delta", "blob")}
+    groups: Dict[Ref, List[Dict[str, Any]]] = {}
+    for record in versions:
+        if record.get("storage") == "delta" and keyframe_ref(record) not in owned:
+            groups.setdefault(keyframe_ref(record), []).append(record)
+    return groups
+
+
+def rebase_deltas(deltas: List[Dict[str, Any]], scratch_dir: str) -> Tuple[List[Dict[str, Any]], int]:
+    """New storage for deltas of an orphaned keyframe: the oldest becomes a keyframe, the rest
+    are re-encoded against it. Returns storage fields per delta and the bytes processed."""
+    results: List[Dict[str, Any]] = []
+    rebased: Dict[str, Dict[str, Any]] = {}
+    keyframe: Optional[Ref] = None
+    base_version_id = None
+    processed = 0
+    try:
+        for record in deltas:
+            if record["file_path"] in rebased:
+                # Revert records sharing a delta share its new storage too
+                results.append({**rebased[record["file_path"]], "stored_size": 0})
+                continue
+            rebuilt_path = os.path.join(scratch_dir, f"rebase-{uuid.uuid4().hex}")
+            try:
+                size, _ = restore_version(record, rebuilt_path)
+                processed += size
+                fields = None
+                if keyframe is not None:
+                    delta_path = f"{os.path.splitext(record['file_path'])[0]}.{uuid.uuid4().hex[:8]}.delta"
+                    stored_size = write_delta(rebuilt_path, keyframe, delta_path)
+                    if stored_size is not None:
+                        fields = {"storage": "delta", "file_path": delta_path, "stored_size": stored_size,
+                                  "base_manifest_id": keyframe[1], "base_version_id": base_version_id}
+                if fields is None:
+                    manifest_id, written = chunk_store.put_file(rebuilt_path)
+                    fields = {"storage": "keyframe", "manifest_id": manifest_id, "stored_size": written}
+                    if keyframe is None:
+                        keyframe, base_version_id = ("manifest", manifest_id), record["version_id"]
+                processed += fields["stored_size"]
+            finally:
+                if os.path.exists(rebuilt_path):
+                    os.remove(rebuilt_path)
+            rebased[record["file_path"]] = fields
+            results.append(fields)
+    except Exception:
+        # Nothing points at the new storage yet
+        for fields in rebased.values():
+            release_version(fields, [])
+        raise
+    return results, processed
+
+
+def rewrite_file_keyframes(versions: List[Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Move full-copy keyframes from before the chunk store into it. Deltas keep their bytes and are
+    repointed at the stored copy. Returns new storage fields by version_id and the bytes processed."""
+    manifests: Dict[str, str] = {}
+    updates: Dict[str, Dict[str, Any]] = {}
+    processed = 0
+    for record in versions:
+        kind, path = keyframe_ref(record)
+        if kind != "file" or record.get("storage") == "blob" or not os.path.exists(path):
+            continue
+        written = 0
+        if path not in manifests:
+            manifests[path], written = chunk_store.put_file(path)
+            processed += os.path.getsize(path) + written
+        if record.get("storage") == "delta":
+            updates[record["version_id"]] = {
+                "storage": "delta", "file_path": record["file_path"], "stored_size": record.get("stored_size", 0),
+                "base_manifest_id": manifests[path], "base_version_id": record.get("base_version_id")
+            }
+        else:
+            updates[record["version_id"]] = {"storage": "keyframe", "manifest_id": manifests[path],
+                                             "stored_size": written}
+    return updates, processed
+
+
+def stored_bytes(versions: List[Dict[str, Any]]) -> int:
+    """Bytes on disk behind a version history; keyframe chunks shared between versions count once"""
+    refs: Set[Ref] = set()
+    for record in versions:
+        refs.update(version_refs(record))
+    files = sum(os.path.getsize(value) for kind, value in refs if kind == "file" and os.path.exists(value))
+    return files + chunk_store.stored_size(value for kind, value in refs if kind == "manifest")